@@ -33,6 +33,7 @@ setup(name='feat',
       packages=(find_packages(where='src') +
                 find_packages('src/feat/extern/paisley')),
       scripts=['bin/feat',
+               'bin/feat-compact-journal',
                'bin/feat-couchpy',
                'bin/feat-dbload',
                'bin/feat-locate',
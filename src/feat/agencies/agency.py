@@ -185,9 +185,15 @@ class AgencyAgent(log.LogProxy, log.Logger, manhole.Manhole,
             self._descriptor.doc_id, self._instance_id,
             factory, self.snapshot())
 
+    def get_entries_since_snapshot(self):
+        return self._entries_since_snapshot
+
+    def should_snapshot(self):
+        return self._entries_since_snapshot > MIN_ENTRIES_PER_SNAPSHOT
+
     def check_if_should_snapshot(self, force=False):
-        if force or self._entries_since_snapshot > MIN_ENTRIES_PER_SNAPSHOT:
-            self.journal_snapshot()
+        if force or self.should_snapshot():
+            return self.journal_snapshot()
         else:
             self.log('Skipping snapshot, number of entries %d < %d',
                      self._entries_since_snapshot, MIN_ENTRIES_PER_SNAPSHOT)
@@ -197,7 +203,7 @@ class AgencyAgent(log.LogProxy, log.Logger, manhole.Manhole,
         # so that snapshot contains full objects not just the references
         agent_id = self._descriptor.doc_id
         self._entries_since_snapshot = 0
-        self.agency.journal_agent_snapshot(
+        return self.agency.journal_agent_snapshot(
             agent_id, self._instance_id, self.snapshot_agent())
 
     def journal_protocol_created(self, *args, **kwargs):
@@ -823,20 +829,25 @@ class AgencyAgent(log.LogProxy, log.Logger, manhole.Manhole,
         return d
 
     def _next_update(self):
+        '''Applies all the pending updates to the descriptor and saves it
+        once. An update raising an exception is discarded without affecting
+        the other ones.'''
 
-        def saved(desc, result, d):
+        def saved(desc, results):
             self.log("Updating descriptor: %r", desc)
             self._descriptor = desc
-            d.callback(result)
+            for d, result in results:
+                d.callback(result)
 
-        def error_handler(failure, d):
+        def error_handler(failure, results):
             if failure.check(ConflictError):
                 self.warning('Descriptor update conflict, killing the agent.')
                 self.call_next(self.terminate_hard)
             else:
                 self.error("Failed updating descriptor: %s",
                            failure.getErrorMessage())
-            d.errback(failure)
+            for d, _ in results:
+                d.errback(failure)
 
         def next_update(any=None):
             self._updating = False
@@ -851,19 +862,35 @@ class AgencyAgent(log.LogProxy, log.Logger, manhole.Manhole,
             # No more pending updates
             return
 
-        d, fun, args, kwargs = self._update_queue.pop(0)
+        updates, self._update_queue = self._update_queue, []
         self._updating = True
-        try:
-            desc = self.get_descriptor()
-            result = fun(desc, *args, **kwargs)
-            assert not isinstance(result, (defer.Deferred, fiber.Fiber))
-            save_d = self.save_document(desc)
-            save_d.addCallbacks(callback=saved, callbackArgs=(result, d),
-                                errback=error_handler, errbackArgs=(d, ))
-            save_d.addBoth(next_update)
-        except Exception as e:
-            d.errback(e)
+
+        desc = None
+        results = []
+        for d, fun, args, kwargs in updates:
+            # Each update works on its own copy so a failing one
+            # does not leave the descriptor half-modified
+            if desc is None:
+                candidate = self.get_descriptor()
+            else:
+                candidate = copy.deepcopy(desc)
+            try:
+                result = fun(candidate, *args, **kwargs)
+                assert not isinstance(result, (defer.Deferred, fiber.Fiber))
+            except Exception as e:
+                d.errback(e)
+                continue
+            desc = candidate
+            results.append((d, result))
+
+        if desc is None:
             next_update()
+            return
+
+        save_d = self.save_document(desc)
+        save_d.addCallbacks(callback=saved, callbackArgs=(results, ),
+                            errback=error_handler, errbackArgs=(results, ))
+        save_d.addBoth(next_update)
 
     def _terminate_procedure(self, body):
         assert callable(body)
@@ -1050,6 +1077,8 @@ class Agency(log.LogProxy, log.Logger, manhole.Manhole,
         common.ConnectionManager.__init__(self)
 
         self._agents = []
+        # agent_id -> AgencyAgent, the first registered one wins
+        self._agents_by_id = {}
 
         self.registry = weakref.WeakValueDictionary()
         # IJournaler
@@ -1109,10 +1138,7 @@ class Agency(log.LogProxy, log.Logger, manhole.Manhole,
         return None
 
     def get_agent(self, agent_id):
-        for agent in self._agents:
-            if agent.get_agent_id() == agent_id:
-                return agent
-        return None
+        return self._agents_by_id.get(agent_id)
 
     @manhole.expose()
     def start_agent(self, descriptor, **kwargs):
@@ -1161,11 +1187,18 @@ class Agency(log.LogProxy, log.Logger, manhole.Manhole,
 
     def register_agent(self, medium):
         self._agents.append(medium)
+        self._agents_by_id.setdefault(medium.get_agent_id(), medium)
 
     def unregister_agent(self, medium):
         agent_id = medium.get_descriptor().doc_id
         self.debug('Unregistering agent id: %r', agent_id)
         self._agents.remove(medium)
+        if self._agents_by_id.get(agent_id) is medium:
+            del self._agents_by_id[agent_id]
+            other = first(x for x in self._agents
+                          if x.get_agent_id() == agent_id)
+            if other is not None:
+                self._agents_by_id[agent_id] = other
 
         # FIXME: This shouldn't be necessary! Here we are manually getting
         # rid of things which should just be garbage collected (self.registry
@@ -1247,7 +1280,7 @@ class Agency(log.LogProxy, log.Logger, manhole.Manhole,
     def journal_agent_snapshot(self, agent_id, instance_id, snapshot):
         self.log("Storing agents snapshot. Agent_id: %r, Instance_id: %r.",
                  agent_id, instance_id)
-        self._jourconn.snapshot(agent_id, instance_id, snapshot)
+        return self._jourconn.snapshot(agent_id, instance_id, snapshot)
 
     ### IExternalizer Methods ###
 
@@ -1276,9 +1309,7 @@ class Agency(log.LogProxy, log.Logger, manhole.Manhole,
                     if isinstance(desc, descriptor.Descriptor)
                     else desc)
         self.log("I'm trying to find the agent with id: %s", agent_id)
-        result = first(x for x in self._agents
-                       if x._descriptor.doc_id == agent_id)
-        return defer.succeed(result)
+        return defer.succeed(self._agents_by_id.get(agent_id))
 
     @manhole.expose()
     def snapshot_agents(self, force=False):
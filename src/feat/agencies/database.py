@@ -21,6 +21,7 @@
 # Headers in this file shall remain intact.
 # -*- Mode: Python -*-
 # vi:si:et:sw=4:sts=4:ts=4
+import collections
 import uuid
 
 from twisted.internet import reactor
@@ -29,17 +30,93 @@ from zope.interface import implements
 from feat.common import log, container, defer, time
 from feat.common.serialization import json
 from feat.agents.base import document
+from feat.agencies import common
 
-from feat.agencies.interface import IDatabaseClient, IDatabaseDriver
+from feat.agencies.interface import (IDatabaseClient, IDatabaseDriver,
+                                     ConflictError, NotFoundError, )
 from feat.interface.generic import *
 from feat.interface.view import *
 
 
+class DocumentCache(common.Statistics):
+    '''
+    LRU cache of the raw documents fetched by the connections of a driver.
+    Entries are evicted when a change notification reports a revision
+    different from the cached one, the driver should only enable the cache
+    while it is receiving the notifications.
+    '''
+
+    def __init__(self, size):
+        common.Statistics.__init__(self)
+        self.size = size
+        self.enabled = False
+        # doc_id -> raw document, from the least recently used one
+        self._documents = collections.OrderedDict()
+        # doc_id -> [fetches in progress, minimal revision number accepted]
+        self._pending = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self._documents.clear()
+
+    def get(self, doc_id):
+        doc = self._documents.pop(doc_id, None)
+        if doc is None:
+            self.increase_stat('misses')
+            return None
+        self._documents[doc_id] = doc
+        self.increase_stat('hits')
+        return doc
+
+    def fetching(self, doc_id):
+        '''Should be called before fetching a missing document,
+        the fetch has to be finished with fetched().'''
+        pending = self._pending.setdefault(doc_id, [0, 0])
+        pending[0] += 1
+
+    def fetched(self, doc_id, doc=None):
+        pending = self._pending[doc_id]
+        pending[0] -= 1
+        if pending[0] == 0:
+            del self._pending[doc_id]
+        if doc is None or not self.enabled:
+            return
+        # a notification may have been received while fetching the document
+        if _revision_number(doc.get('_rev')) < pending[1]:
+            return
+        self._documents[doc_id] = doc
+        while len(self._documents) > self.size:
+            self._documents.popitem(last=False)
+
+    def forget(self, doc_id):
+        self._documents.pop(doc_id, None)
+
+    def changed(self, doc_id, rev):
+        pending = self._pending.get(doc_id)
+        if pending is not None:
+            pending[1] = max(pending[1], _revision_number(rev))
+        doc = self._documents.get(doc_id)
+        if doc is not None and doc.get('_rev') != rev:
+            del self._documents[doc_id]
+            self.increase_stat('invalidations')
+
+    def format_stats(self):
+        stats = dict(self.get_stats())
+        return "cache: %d/%d (hits: %d, misses: %d, invalidations: %d)" % (
+            len(self._documents), self.size, stats.get('hits', 0),
+            stats.get('misses', 0), stats.get('invalidations', 0))
+
+
 class ChangeListener(log.Logger):
     '''
     Base class for .net.database.Database and emu.database.Database.
     '''
 
+    document_cache = None
+
     def __init__(self, logger):
         log.Logger.__init__(self, logger)
         # id -> [(callback, listener_id)]
@@ -70,6 +147,8 @@ class ChangeListener(log.Logger):
                     if len(value) > 0)
 
     def _trigger_change(self, doc_id, rev):
+        if self.document_cache is not None:
+            self.document_cache.changed(doc_id, rev)
         listeners = self._listeners.get(doc_id, list())
         for cb, _ in listeners:
             reactor.callLater(0, cb, doc_id, rev)
@@ -80,9 +159,10 @@ class Connection(log.Logger):
 
     implements(IDatabaseClient, ITimeProvider)
 
-    def __init__(self, database):
+    def __init__(self, database, cache=None):
         log.Logger.__init__(self, database)
         self.database = IDatabaseDriver(database)
+        self.cache = cache
         self.serializer = json.Serializer()
         self.unserializer = json.PaisleyUnserializer()
 
@@ -103,14 +183,21 @@ class Connection(log.Logger):
 
     def save_document(self, doc):
         serialized = self.serializer.convert(doc)
+        self._forget_documents([doc])
         d = self.database.save_doc(serialized, doc.doc_id)
         d.addCallback(self._update_id_and_rev, doc)
         return d
 
     def get_document(self, id):
+        if self.cache is not None:
+            cached = self.cache.get(id)
+            if cached is not None:
+                return defer.succeed(self._unserialize_document(cached))
+            self.cache.fetching(id)
         d = self.database.open_doc(id)
-        d.addCallback(self.unserializer.convert)
-        d.addCallback(self._notice_doc_revision)
+        if self.cache is not None:
+            d.addBoth(self._cache_document, id)
+        d.addCallback(self._unserialize_document)
         return d
 
     def reload_document(self, doc):
@@ -119,10 +206,31 @@ class Connection(log.Logger):
 
     def delete_document(self, doc):
         assert isinstance(doc, document.Document)
+        self._forget_documents([doc])
         d = self.database.delete_doc(doc.doc_id, doc.rev)
         d.addCallback(self._update_id_and_rev, doc)
         return d
 
+    def save_documents(self, docs):
+        serialized = [self._serialize_bulk_document(doc) for doc in docs]
+        self._forget_documents(docs)
+        d = self.database.save_docs(serialized)
+        d.addCallback(self._update_ids_and_revs, docs)
+        return d
+
+    def get_documents(self, ids):
+        d = self.database.open_docs(ids)
+        d.addCallback(self._unserialize_documents, ids)
+        return d
+
+    def delete_documents(self, docs):
+        assert all(isinstance(doc, document.Document) for doc in docs)
+        self._forget_documents(docs)
+        d = self.database.delete_docs([(doc.doc_id, doc.rev)
+                                       for doc in docs])
+        d.addCallback(self._update_ids_and_revs, docs)
+        return d
+
     def changes_listener(self, doc_ids, callback):
         assert isinstance(doc_ids, (tuple, list, ))
         assert callable(callback)
@@ -174,9 +282,72 @@ class Connection(log.Logger):
         self._notice_doc_revision(doc)
         return doc
 
+    def _serialize_bulk_document(self, doc):
+        serialized = self.serializer.convert(doc)
+        if isinstance(doc.doc_id, str):
+            # the bulk request takes the identifiers from the documents
+            # bodies, byte strings are serialized as encoded values
+            body = json.json.loads(serialized)
+            body['_id'] = doc.doc_id.decode('utf-8')
+            serialized = json.json.dumps(body)
+        return serialized
+
+    def _update_ids_and_revs(self, responses, docs):
+        result = list()
+        for resp, doc in zip(responses, docs):
+            if 'error' in resp:
+                result.append(self._bulk_error(resp))
+            else:
+                result.append(self._update_id_and_rev(resp, doc))
+        return result
+
+    def _unserialize_documents(self, docs, ids):
+        result = list()
+        for doc, doc_id in zip(docs, ids):
+            if doc is None:
+                result.append(NotFoundError("missing: %s" % (doc_id, )))
+            else:
+                result.append(self._unserialize_document(doc))
+        return result
+
+    def _unserialize_document(self, doc):
+        doc = self.unserializer.convert(doc)
+        return self._notice_doc_revision(doc)
+
+    def _cache_document(self, result, doc_id):
+        if isinstance(result, dict):
+            self.cache.fetched(doc_id, result)
+        else:
+            self.cache.fetched(doc_id)
+        return result
+
+    def _forget_documents(self, docs):
+        if self.cache is not None:
+            for doc in docs:
+                if doc.doc_id is not None:
+                    self.cache.forget(doc.doc_id)
+
+    def _bulk_error(self, resp):
+        error = resp.get('error', None)
+        reason = resp.get('reason', None) or error
+        if error == 'conflict':
+            return ConflictError(reason)
+        if error == 'not_found':
+            return NotFoundError(reason)
+        return ValueError("%s: %s" % (error, reason))
+
     def _notice_doc_revision(self, doc):
         self.log('Storing knowledge about doc rev. ID: %r, REV: %r',
                  doc.doc_id, doc.rev)
         self.known_revisions.set((doc.doc_id, doc.rev, ), True,
                                  expiration=5, relative=True)
         return doc
+
+
+### Private module stuff ###
+
+
+def _revision_number(rev):
+    if not rev:
+        return 0
+    return int(rev.split('-', 1)[0])
@@ -21,6 +21,7 @@
 # Headers in this file shall remain intact.
 # -*- Mode: Python -*-
 # vi:si:et:sw=4:sts=4:ts=4
+import bisect
 import copy
 import uuid
 import json
@@ -30,7 +31,7 @@ from twisted.internet import defer
 from zope.interface import implements
 
 from feat.common import log
-from feat.agencies.database import Connection, ChangeListener
+from feat.agencies.database import Connection, ChangeListener, DocumentCache
 from feat.agencies import common
 
 from feat.agencies.interface import IDbConnectionFactory, IDatabaseDriver
@@ -49,16 +50,23 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
 
     log_category = "emu-database"
 
-    def __init__(self):
+    def __init__(self, cache_size=None):
         common.ConnectionManager.__init__(self)
         log.LogProxy.__init__(self, log.FluLogKeeper())
         ChangeListener.__init__(self, self)
         common.Statistics.__init__(self)
 
+        if cache_size:
+            # changes are always notified synchronously
+            self.document_cache = DocumentCache(cache_size)
+            self.document_cache.enable()
+
         # id -> document
         self._documents = {}
         # id -> view_name -> (key, value)
         self._view_cache = {}
+        # view_name -> ViewIndex
+        self._view_indexes = {}
 
         self._on_connected()
 
@@ -69,7 +77,7 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
     ### IDbConnectionFactory
 
     def get_connection(self):
-        return Connection(self)
+        return Connection(self, self.document_cache)
 
     ### IDatabaseDriver
 
@@ -81,96 +89,151 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
         d = defer.Deferred()
 
         try:
-            if not isinstance(doc, (str, unicode, )):
-                raise ValueError('Doc should be either str or unicode')
-            doc = json.loads(doc)
-            doc = self._set_id_and_revision(doc, doc_id)
-
-            self.increase_stat('save_doc')
-
-            self._documents[doc['_id']] = doc
-            self._expire_cache(doc['_id'])
-
-            r = Response(ok=True, id=doc['_id'], rev=doc['_rev'])
-            self._trigger_change(doc['_id'], doc['_rev'])
-            d.callback(r)
+            doc = self._parse_doc(doc)
+            d.callback(self._save_doc(doc, doc_id))
         except (ConflictError, ValueError, ) as e:
             d.errback(e)
 
         return d
 
+    def save_docs(self, docs):
+        '''Imitates sending a _bulk_docs request to CouchDB server'''
+        self.log("save_docs called for %d documents", len(docs))
+        try:
+            docs = map(self._parse_doc, docs)
+        except ValueError as e:
+            return defer.fail(e)
+
+        result = list()
+        for doc in docs:
+            try:
+                result.append(self._save_doc(doc))
+            except ConflictError as e:
+                result.append(Response(id=doc.get('_id', None),
+                                       error='conflict', reason=str(e)))
+        return defer.succeed(result)
+
     def open_doc(self, doc_id):
         '''Imitated fetching the document from the database.
         Doesnt implement options from paisley to get the old revision or
         get the list of revision.
         '''
         d = defer.Deferred()
-        self.increase_stat('open_doc')
         try:
-            doc = self._get_doc(doc_id)
-            doc = copy.deepcopy(doc)
-            if doc.get('_deleted', None):
-                raise NotFoundError('deleted')
-            d.callback(Response(doc))
+            d.callback(self._open_doc(doc_id))
         except NotFoundError as e:
             d.errback(e)
 
         return d
 
+    def open_docs(self, doc_ids):
+        '''Imitates fetching documents with a _all_docs request
+        including them, missing and deleted documents are given as None.'''
+        result = list()
+        for doc_id in doc_ids:
+            try:
+                result.append(self._open_doc(doc_id))
+            except NotFoundError:
+                result.append(None)
+        return defer.succeed(result)
+
     def delete_doc(self, doc_id, revision):
         '''Imitates sending DELETE request to CouchDB server'''
         d = defer.Deferred()
-
-        self.increase_stat('delete_doc')
-
         try:
-            doc = self._get_doc(doc_id)
-            if doc['_rev'] != revision:
-                raise ConflictError("Document update conflict.")
-            if doc.get('_deleted', None):
-                raise NotFoundError('deleted')
-            doc['_rev'] = self._generate_rev(doc)
-            doc['_deleted'] = True
-            self._expire_cache(doc['_id'])
-            self.log('Marking document %r as deleted', doc_id)
-            self._trigger_change(doc['_id'], doc['_rev'])
-            d.callback(Response(ok=True, id=doc_id, rev=doc['_rev']))
+            d.callback(self._delete_doc(doc_id, revision))
         except (ConflictError, NotFoundError, ) as e:
             d.errback(e)
 
         return d
 
+    def delete_docs(self, docs):
+        '''Imitates deleting a list of (doc_id, revision) with
+        a _bulk_docs request to CouchDB server'''
+        result = list()
+        for doc_id, revision in docs:
+            try:
+                result.append(self._delete_doc(doc_id, revision))
+            except ConflictError as e:
+                result.append(Response(id=doc_id, error='conflict',
+                                       reason=str(e)))
+            except NotFoundError as e:
+                result.append(Response(id=doc_id, error='not_found',
+                                       reason=str(e)))
+        return defer.succeed(result)
+
     def query_view(self, factory, **options):
+        '''Supports the key, startkey, endkey, inclusive_end, descending,
+        skip, limit, reduce, group and group_level options.'''
         factory = IViewFactory(factory)
         use_reduce = factory.use_reduce and options.get('reduce', True)
-        iterator = (self._perform_map(doc, factory)
-                    for doc in self._iterdocs())
-        d = defer.succeed(iterator)
-        d.addCallback(self._flatten, **options)
-        if use_reduce:
-            d.addCallback(self._perform_reduce, factory)
-        return d
+        try:
+            index = self._get_view_index(factory)
+            rows = index.query(**options)
+            if use_reduce:
+                rows = self._perform_reduce(rows, factory,
+                                            options.get('group', False),
+                                            options.get('group_level', None))
+        except Exception:
+            return defer.fail()
+        skip = options.get('skip', 0)
+        limit = options.get('limit', None)
+        if limit is not None:
+            rows = rows[skip:skip + limit]
+        elif skip:
+            rows = rows[skip:]
+        return defer.succeed(rows)
 
     ### private
 
-    def _matches_filter(self, tup, **filter_options):
-        # We only support filtering by key at the moment
-        if 'key' in filter_options:
-            if filter_options['key'] != tup[0]:
-                return False
-        return True
+    def _parse_doc(self, doc):
+        if not isinstance(doc, (str, unicode, )):
+            raise ValueError('Doc should be either str or unicode')
+        return json.loads(doc)
 
-    def _flatten(self, iterator, **filter_options):
-        '''
-        iterator here gives as lists of tuples. Method flattens the structure
-        to a single list of tuples.
-        '''
-        resp = list()
-        for entry in iterator:
-            for tup in entry:
-                if self._matches_filter(tup, **filter_options):
-                    resp.append(tup)
-        return resp
+    def _save_doc(self, doc, doc_id=None):
+        doc = self._set_id_and_revision(doc, doc_id)
+
+        self.increase_stat('save_doc')
+
+        self._documents[doc['_id']] = doc
+        self._expire_cache(doc['_id'])
+
+        r = Response(ok=True, id=doc['_id'], rev=doc['_rev'])
+        self._trigger_change(doc['_id'], doc['_rev'])
+        return r
+
+    def _open_doc(self, doc_id):
+        self.increase_stat('open_doc')
+        doc = self._get_doc(doc_id)
+        doc = copy.deepcopy(doc)
+        if doc.get('_deleted', None):
+            raise NotFoundError('deleted')
+        return Response(doc)
+
+    def _delete_doc(self, doc_id, revision):
+        self.increase_stat('delete_doc')
+        doc = self._get_doc(doc_id)
+        if doc['_rev'] != revision:
+            raise ConflictError("Document update conflict.")
+        if doc.get('_deleted', None):
+            raise NotFoundError('deleted')
+        doc['_rev'] = self._generate_rev(doc)
+        doc['_deleted'] = True
+        self._expire_cache(doc['_id'])
+        self.log('Marking document %r as deleted', doc_id)
+        self._trigger_change(doc['_id'], doc['_rev'])
+        return Response(ok=True, id=doc_id, rev=doc['_rev'])
+
+    def _get_view_index(self, factory):
+        index = self._view_indexes.get(factory.name, None)
+        if index is None or index.factory is not factory:
+            index = ViewIndex(factory)
+            self._view_indexes[factory.name] = index
+            for doc_id in self._documents:
+                index.invalidate(doc_id)
+        index.update(self)
+        return index
 
     def _perform_map(self, doc, factory):
         cached = self._get_cache(doc['_id'], factory.name)
@@ -180,28 +243,43 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
         self._set_cache(doc['_id'], factory.name, res)
         return res
 
-    def _perform_reduce(self, map_results, factory):
+    def _perform_reduce(self, map_results, factory,
+                        group=False, group_level=None):
         '''
-        map_results here is a list of tuples (key, value)
+        map_results here is a list of tuples (key, value) sorted by key.
+        When grouping, the rows sharing the same key (or the same first
+        group_level items of array keys) are reduced together.
         '''
-        keys = map(operator.itemgetter(0), map_results)
-        values = map(operator.itemgetter(1), map_results)
-        if not values:
+        if not map_results:
             return []
+        if not group and not group_level:
+            return [(None, self._reduce_rows(map_results, factory), )]
+
+        result = []
+        current, current_key, rows = None, None, []
+        for row in map_results:
+            key = row[0]
+            if group_level and isinstance(key, (list, tuple)):
+                key = list(key[:group_level])
+            collated = collate(key)
+            if rows and collated != current:
+                result.append((current_key,
+                               self._reduce_rows(rows, factory)))
+                rows = []
+            current, current_key = collated, key
+            rows.append(row)
+        result.append((current_key, self._reduce_rows(rows, factory)))
+        return result
+
+    def _reduce_rows(self, rows, factory):
+        keys = map(operator.itemgetter(0), rows)
+        values = map(operator.itemgetter(1), rows)
         if callable(factory.reduce):
-            result = factory.reduce(keys, values)
+            return factory.reduce(keys, values)
         elif factory.reduce == '_sum':
-            result = sum(values)
+            return sum(values)
         elif factory.reduce == '_count':
-            result = len(values)
-
-        return [(None, result, )]
-
-    def _iterdocs(self):
-        for did, doc in self._documents.iteritems():
-            if doc.get('_deleted', False):
-                continue
-            yield doc
+            return len(values)
 
     def _get_cache(self, doc_id, view_name):
         return self._view_cache.get(doc_id, {}).get(view_name, None)
@@ -213,6 +291,8 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
 
     def _expire_cache(self, doc_id):
         self._view_cache.pop(doc_id, None)
+        for index in self._view_indexes.itervalues():
+            index.invalidate(doc_id)
 
     def _set_id_and_revision(self, doc, doc_id):
         doc_id = doc_id or doc.get('_id', None)
@@ -263,3 +343,116 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
 class Response(dict):
 
     pass
+
+
+def collate(value):
+    '''
+    Gives a value ordering the same way CouchDB collates view keys:
+    null, false, true, numbers, strings, arrays and objects.
+    Strings are compared by code points instead of the unicode
+    collation algorithm used by CouchDB.
+    '''
+    if value is None:
+        return (0, )
+    if value is False:
+        return (1, )
+    if value is True:
+        return (2, )
+    if isinstance(value, (int, long, float)):
+        return (3, value)
+    if isinstance(value, basestring):
+        return (4, value)
+    if isinstance(value, (list, tuple)):
+        return (5, tuple([collate(x) for x in value]))
+    if isinstance(value, dict):
+        return (6, tuple([(collate(k), collate(v))
+                          for k, v in sorted(value.items())]))
+    return (7, value)
+
+
+class ViewIndex(object):
+    '''
+    Map results of a view sorted the way CouchDB does, by key then by
+    document id. Documents are mapped again lazily after being invalidated.
+    '''
+
+    def __init__(self, factory):
+        self.factory = factory
+        # sorted [(collated key, doc_id, position)] and matching rows
+        self._entries = []
+        self._rows = []
+        # collated keys of self._entries used for range queries
+        self._keys = []
+        # doc_id -> [entry]
+        self._documents = {}
+        # ids of the documents to map again
+        self._pending = set()
+
+    def invalidate(self, doc_id):
+        self._pending.add(doc_id)
+
+    def update(self, database):
+        while self._pending:
+            doc_id = self._pending.pop()
+            self._remove(doc_id)
+            doc = database._documents.get(doc_id, None)
+            if doc is None or doc.get('_deleted', False):
+                continue
+            try:
+                rows = database._perform_map(doc, self.factory)
+            except:
+                self._pending.add(doc_id)
+                raise
+            self._insert(doc_id, rows)
+
+    def query(self, **options):
+        '''Gives the list of (key, value) rows in the specified range.'''
+        startkey = options.get('startkey', None)
+        endkey = options.get('endkey', None)
+        inclusive_end = options.get('inclusive_end', True)
+        descending = options.get('descending', False)
+        if descending:
+            startkey, endkey = endkey, startkey
+        lower, upper = 0, len(self._keys)
+        if 'key' in options:
+            collated = collate(options['key'])
+            lower = bisect.bisect_left(self._keys, collated)
+            upper = bisect.bisect_right(self._keys, collated)
+        else:
+            if startkey is not None:
+                collated = collate(startkey)
+                if descending and not inclusive_end:
+                    lower = bisect.bisect_right(self._keys, collated)
+                else:
+                    lower = bisect.bisect_left(self._keys, collated)
+            if endkey is not None:
+                collated = collate(endkey)
+                if not descending and not inclusive_end:
+                    upper = bisect.bisect_left(self._keys, collated)
+                else:
+                    upper = bisect.bisect_right(self._keys, collated)
+        rows = self._rows[lower:upper]
+        if descending:
+            rows.reverse()
+        return rows
+
+    ### private ###
+
+    def _insert(self, doc_id, rows):
+        entries = []
+        for position, row in enumerate(rows):
+            entry = (collate(row[0]), doc_id, position)
+            index = bisect.bisect_left(self._entries, entry)
+            self._entries.insert(index, entry)
+            self._keys.insert(index, entry[0])
+            self._rows.insert(index, row)
+            entries.append(entry)
+        if entries:
+            self._documents[doc_id] = entries
+
+    def _remove(self, doc_id):
+        for entry in self._documents.pop(doc_id, ()):
+            index = bisect.bisect_left(self._entries, entry)
+            del self._entries[index]
+            del self._keys[index]
+            del self._rows[index]
@@ -118,6 +118,21 @@ class Messaging(common.ConnectionManager, log.Logger, log.FluLogKeeper,
             self.error("Exchange %r not found!" % shard)
         return defer.succeed(message)
 
+    def publish_many(self, routes, message):
+        '''Publishes the same message instance for a list of
+        (shard, keys), looking up every exchange only once.'''
+        defers = []
+        for shard, keys in routes:
+            exchange = self._get_exchange(shard)
+            if exchange is None:
+                self.error("Exchange %r not found!" % shard)
+            for key in keys:
+                if exchange:
+                    self.increase_stat('messages published')
+                    exchange.publish(message, key)
+                defers.append(defer.succeed(message))
+        return defer.DeferredList(defers)
+
     def create_binding(self, exchange, key, queue):
         ex = self._get_exchange(exchange)
         que = self._get_queue(queue)
@@ -350,6 +350,38 @@ class IDatabaseClient(Interface):
         @returns: Deferred called with the updated document (latest revision).
         '''
 
+    def save_documents(documents):
+        '''
+        Save a list of documents with a single request to the database.
+        Conflicts are reported per document, a failure of one of them
+        does not prevent the others from being saved.
+
+        @param documents: Documents to be saved.
+        @type documents: C{list} of L{feat.agents.document.Document}
+        @returns: Deferred called with a C{list} aligned with the documents
+                  given, containing the updated Document or the exception
+                  instance (L{ConflictError}) describing why it failed.
+        '''
+
+    def get_documents(document_ids):
+        '''
+        Download a list of documents with a single request to the database.
+
+        @param document_ids: The ids of the documents in the database.
+        @returns: Deferred called with a C{list} aligned with the ids given,
+                  containing the instances of the downloaded documents
+                  or L{NotFoundError} instances for the missing ones.
+        '''
+
+    def delete_documents(documents):
+        '''
+        Marks a list of documents as deleted with a single request
+        to the database. See L{save_documents} for the result.
+
+        @param documents: Documents to be deleted.
+        @type documents: C{list} of L{feat.agents.document.Document}
+        '''
+
     def changes_listener(doc_ids, callback):
         '''
         Register a callback called when the document is changed.
@@ -414,6 +446,30 @@ class IDatabaseDriver(Interface):
                  ConflictError
         '''
 
+    def save_docs(docs):
+        '''
+        Create new or update existing documents in a single request.
+        @param docs: list of strings with json documents
+        @return: Deferred fired with a list of dict(id, rev) for
+                 saved documents or dict(id, error, reason) for the
+                 ones that failed, in the same order as the documents.
+        '''
+
+    def open_docs(doc_ids):
+        '''
+        Fetch several documents from database in a single request.
+        @param doc_ids: list of ids of the documents to fetch
+        @return: Deferred fired with the list of json parsed documents,
+                 None is given for missing or deleted documents.
+        '''
+
+    def delete_docs(docs):
+        '''
+        Mark several documents as deleted in a single request.
+        @param docs: list of tuples (doc_id, revision)
+        @return: Deferred fired with a list formatted like for save_docs()
+        '''
+
     def listen_changes(doc_ids, callback):
         '''
         Register callback called when one of the documents get changed.
@@ -535,6 +591,8 @@ class IJournalerConnection(Interface):
     def snapshot(agent_id, instance_id, snapshot):
         """
         Create special IAgencyJournalEntry representing agent snapshot.
+        The snapshot is a tuple (agent, protocols).
+        Returns the committed entry.
         """
 
 
@@ -21,21 +21,27 @@
 # Headers in this file shall remain intact.
 # -*- Mode: Python -*-
 # vi:si:et:sw=4:sts=4:ts=4
+import collections
+import datetime
+import itertools
+import marshal
+import os
 import sqlite3
 import operator
+import tempfile
 import types
 
 from zope.interface import implements
 from twisted.enterprise import adbapi
 from twisted.spread import pb
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from twisted.python import log as twisted_log
 
 from feat.common import (log, text_helper, error_handler, defer,
                          formatable, enum, decorator, time, manhole,
                          fiber, signal, )
 from feat.agencies import common
-from feat.common.serialization import banana
+from feat.common.serialization import banana, binary, sexp
 from feat.extern.log import log as flulog
 
 from feat.interface.journal import *
@@ -53,30 +59,173 @@ class State(enum.Enum):
     (disconnected, connected, ) = range(2)
 
 
-class EntriesCache(object):
+# Version of the schema created by SqliteWriter, files with older schema
+# are migrated with the commands from SCHEMA_MIGRATIONS when opened.
+SCHEMA_VERSION = 2
+
+# target version -> list of commands upgrading from the previous one
+SCHEMA_MIGRATIONS = {
+    2: ["CREATE INDEX IF NOT EXISTS logs_timestamp_idx "
+        "ON logs(timestamp)",
+        "CREATE INDEX IF NOT EXISTS logs_category_idx "
+        "ON logs(category, log_name)",
+        "CREATE INDEX IF NOT EXISTS entries_history_timestamp_idx "
+        "ON entries(history_id, timestamp)"]}
+
+JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL')
+
+
+class OverflowPolicy(enum.Enum):
+    '''
+    Defines what EntriesCache does when it grows over its size limit.
+
+    drop_log - new log entries are dropped, journal entries are always kept
+    spill - entries over the limit are written to a local file and read
+            back in order when the cache gets drained
+    '''
+    (drop_log, spill, ) = range(2)
+
+
+# maximum number of entries handed to the writer at once
+MAX_FETCHED_ENTRIES = 1000
+
+
+# rough estimation of the memory used by an entry apart from its strings
+ENTRY_OVERHEAD = 400
+
+
+def entry_size(entry):
+    '''
+    Estimates the memory used by the entry dictionary in bytes.
+    '''
+    # the s-expressions of captured entries are estimated only once
+    # when they are captured, see Record.commit()
+    size = ENTRY_OVERHEAD + entry.get('size', 0)
+    for value in entry.itervalues():
+        if isinstance(value, types.StringTypes):
+            size += len(value)
+    return size
+
+
+def sexp_size(sexp):
+    '''
+    Estimates the size in bytes of a converted s-expression, strings
+    count for their length and any other atom for a machine word.
+    '''
+    size = 0
+    stack = [sexp]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, (list, tuple)):
+            stack.extend(value)
+        elif isinstance(value, types.StringTypes):
+            size += len(value)
+        else:
+            size += 8
+    return size
+
+
+class SpillFile(object):
+    '''
+    FIFO of entries kept in a local file. The file is removed as soon
+    as all the entries stored in it are read back.
+    '''
+
+    def __init__(self, path=None):
+        self._path = path
+        self._writer = None
+        self._reader = None
+        self._pending = 0
+
+    def push(self, entry):
+        if self._writer is None:
+            if self._path is None:
+                fd, self._path = tempfile.mkstemp(prefix='feat_journal_',
+                                                  suffix='.spill')
+                os.close(fd)
+            self._writer = open(self._path, 'wb')
+        marshal.dump(entry, self._writer)
+        self._pending += 1
+
+    def pop(self):
+        if not self._pending:
+            raise IndexError('pop from empty spill file')
+        if self._reader is None:
+            self._reader = open(self._path, 'rb')
+        self._writer.flush()
+        entry = marshal.load(self._reader)
+        self._pending -= 1
+        if not self._pending:
+            self.close()
+        return entry
+
+    def close(self):
+        for handle in (self._writer, self._reader):
+            if handle is not None:
+                handle.close()
+        self._writer = None
+        self._reader = None
+        if self._path is not None and os.path.exists(self._path):
+            os.remove(self._path)
+        self._pending = 0
+
+    def __len__(self):
+        return self._pending
+
+
+class EntriesCache(common.Statistics):
     '''
     Helper class storing the data and giving the back in transactional way.
+
+    If max_size (in bytes) is given the cache reacts on growing over it
+    according to the overflow policy (see L{OverflowPolicy}). Counters
+    of appended, committed, dropped and spilled entries are available
+    through get_stats().
     '''
 
-    def __init__(self):
-        self._cache = list()
+    def __init__(self, max_size=None, policy=OverflowPolicy.drop_log,
+                 spill_path=None):
+        common.Statistics.__init__(self)
+        self._cache = collections.deque()
         self._fetched = None
+        self._size = 0
+        self._max_size = max_size
+        self._policy = OverflowPolicy.get(policy)
+        self._spill = SpillFile(spill_path)
 
     def append(self, entry):
-        self._cache.append(entry)
+        '''
+        Stores the entry. Returns False if the entry has been dropped.
+        '''
+        self.increase_stat('appended')
+        if self._spill or (self.is_full() and
+                           self._policy == OverflowPolicy.spill):
+            # once we started spilling everything goes to the file,
+            # otherwise we would break the order of entries
+            self._spill.push(entry)
+            self.increase_stat('spilled')
+            return True
+        if (self.is_full() and self._policy == OverflowPolicy.drop_log
+            and entry.get('entry_type') == 'log'):
+            self.increase_stat('dropped')
+            return False
+        self._push(entry)
+        return True
 
-    def fetch(self):
+    def fetch(self, max_entries=MAX_FETCHED_ENTRIES):
         '''
-        Gives all the data it has stored, and remembers what it has given.
-        Later we need to call commit() to actually remove the data from the
-        cache.
+        Gives the oldest entries it has stored, at most max_entries of them,
+        and remembers what it has given. Later we need to call commit()
+        to actually remove the data from the cache.
         '''
         if self._fetched is not None:
             raise RuntimeError('fetch() was called but the previous one has '
                                'not yet been applied. Not supported')
-        if self._cache:
-            self._fetched = len(self._cache)
-        return self._cache[0:self._fetched]
+        entries = list(itertools.islice(self._cache, max_entries))
+        if entries:
+            self._fetched = len(entries)
+        return entries
 
     def commit(self):
         '''
@@ -84,8 +233,11 @@ class EntriesCache(object):
         '''
         if self._fetched is None:
             raise RuntimeError('commit() was called but nothing was fetched')
-        self._cache = self._cache[self._fetched:]
+        for _ in xrange(self._fetched):
+            self._size -= entry_size(self._cache.popleft())
+        self.increase_stat('committed', self._fetched)
         self._fetched = None
+        self._unspill()
 
     def rollback(self):
         if self._fetched is None:
@@ -98,8 +250,37 @@ class EntriesCache(object):
         '''
         return self._fetched is not None
 
+    def is_full(self):
+        return self._max_size is not None and self._size >= self._max_size
+
+    def get_size(self):
+        '''
+        Returns the estimated size of the entries kept in memory in bytes.
+        '''
+        return self._size
+
+    def get_spilled(self):
+        return len(self._spill)
+
+    def close(self):
+        '''
+        Removes the spill file. Entries which has not been read back from
+        it are lost.
+        '''
+        self._spill.close()
+
     def __len__(self):
-        return len(self._cache)
+        return len(self._cache) + len(self._spill)
+
+    ### private ###
+
+    def _push(self, entry):
+        self._cache.append(entry)
+        self._size += entry_size(entry)
+
+    def _unspill(self):
+        while self._spill and (not self._cache or not self.is_full()):
+            self._push(self._spill.pop())
 
 
 @decorator.parametrized_function
@@ -125,13 +306,23 @@ class Journaler(log.Logger, common.StateMachineMixin):
     # FIXME: at some point switch to False and remove this attribute
     should_keep_on_logging_to_flulog = True
 
-    def __init__(self, logger):
+    def __init__(self, logger, max_cache_size=None,
+                 overflow_policy=OverflowPolicy.drop_log, spill_path=None):
+        '''
+        @param max_cache_size: Optional limit (in bytes) of entries kept in
+                               memory while waiting for the writer.
+        @param overflow_policy: What to do when the limit is reached,
+                                see L{OverflowPolicy}.
+        @param spill_path: File used by OverflowPolicy.spill. Defaults to
+                           a temporary file.
+        '''
         log.Logger.__init__(self, self)
 
         common.StateMachineMixin.__init__(self, State.disconnected)
         self._writer = None
         self._flush_task = None
-        self._cache = EntriesCache()
+        self._cache = EntriesCache(max_cache_size, overflow_policy,
+                                   spill_path)
         self._notifier = defer.Notifier()
 
     def configure_with(self, writer):
@@ -156,6 +347,7 @@ class Journaler(log.Logger, common.StateMachineMixin):
 
         d = self._close_writer(flush_writer)
         d.addCallback(defer.drop_param, set_disconnected)
+        d.addCallback(defer.drop_param, self._cache.close)
         return d
 
     ### IJournaler ###
@@ -192,6 +384,17 @@ class Journaler(log.Logger, common.StateMachineMixin):
             return self._writer.is_idle()
         return True
 
+    def get_cache_stats(self):
+        '''
+        Returns the dictionary of counters of the entries cache, allowing
+        to see if the writer keeps up with the incoming entries.
+        '''
+        stats = dict(self._cache.get_stats())
+        stats['pending'] = len(self._cache)
+        stats['size'] = self._cache.get_size()
+        stats['spilled_pending'] = self._cache.get_spilled()
+        return stats
+
     ### ILogObserver provider ###
 
     def on_twisted_log(self, event_dict):
@@ -295,6 +498,7 @@ class BrokerProxyWriter(log.Logger, common.StateMachineMixin):
         self._broker = broker
         self._set_writer(None)
         self._cache = EntriesCache()
+        self._encoder = EntryEncoder()
         self._semaphore = defer.DeferredSemaphore(1)
 
     def initiate(self):
@@ -347,16 +551,22 @@ class BrokerProxyWriter(log.Logger, common.StateMachineMixin):
     def _push_entries(self):
         entries = self._cache.fetch()
         if entries:
-            try:
-                d = self._writer.callRemote('insert_entries', entries)
-                d.addCallbacks(defer.drop_param, defer.drop_param,
-                               callbackArgs=(self._cache.commit, ),
-                               errbackArgs=(self._cache.rollback, ))
-                return d
-            except pb.DeadReferenceError:
-                # for some reason callRemote raises this error
-                # instead of giving failed Deferred
-                self._cache.rollback()
+            # captured entries are encoded in a worker thread
+            # before being sent to the broker
+            d = threads.deferToThread(map, self._encoder.encode, entries)
+            d.addCallback(self._send_entries)
+            d.addCallbacks(defer.drop_param, defer.drop_param,
+                           callbackArgs=(self._cache.commit, ),
+                           errbackArgs=(self._cache.rollback, ))
+            return d
+
+    def _send_entries(self, entries):
+        try:
+            return self._writer.callRemote('insert_entries', entries)
+        except pb.DeadReferenceError:
+            # for some reason callRemote raises this error
+            # instead of giving failed Deferred
+            return defer.fail()
 
     def _set_writer(self, writer):
         self._writer = writer
@@ -375,18 +585,48 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
     _error_handler = error_handler
 
     def __init__(self, logger, filename=":memory:", encoding=None,
-                 on_rotate=None):
+                 on_rotate=None, journal_mode=None, synchronous=None,
+                 rotate_size=None, rotate_age=None):
         '''
         @param encoding: Optional encoding to be used for blob fields.
         @type encoding: Should be a valid parameter for str.encode() method.
         @param filename: File to use for entries. Defaults to :memory:
         @param logger: ILogger to use
+        @param on_rotate: Optional callable called after the journal file
+                          has been reopened (SIGHUP or rotation).
+        @param journal_mode: Optional sqlite journal mode, for example 'WAL'.
+                             Defaults to sqlite default (DELETE).
+        @param synchronous: Optional sqlite synchronous setting, one of
+                            'OFF', 'NORMAL' or 'FULL'.
+        @param rotate_size: If given, the journal file is moved aside and
+                            a new one is started when it grows over this
+                            number of bytes.
+        @param rotate_age: If given, the journal file is moved aside and
+                           a new one is started after this number of
+                           seconds since the first entry written to it.
         '''
         log.Logger.__init__(self, logger)
         log.LogProxy.__init__(self, logger)
         common.StateMachineMixin.__init__(self, State.disconnected)
 
+        if journal_mode is not None:
+            journal_mode = journal_mode.upper()
+            if journal_mode not in JOURNAL_MODES:
+                raise ValueError("Unknown journal mode %r, expected one of: "
+                                 "%s" % (journal_mode,
+                                         ", ".join(JOURNAL_MODES)))
+        if synchronous is not None:
+            synchronous = synchronous.upper()
+            if synchronous not in SYNCHRONOUS_MODES:
+                raise ValueError("Unknown synchronous setting %r, expected "
+                                 "one of: %s" % (synchronous,
+                                                 ", ".join(SYNCHRONOUS_MODES)))
+
+        self._journal_mode = journal_mode
+        self._synchronous = synchronous
         self._encoding = encoding
+        # only used from the single database thread
+        self._encoder = EntryEncoder()
         self._db = None
         self._filename = filename
         self._reset_history_id_cache()
@@ -398,20 +638,37 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
         self._sighup_installed = False
 
         self._on_rotate_cb = on_rotate
+        self._rotate_size = rotate_size
+        self._rotate_age = rotate_age
+        # Deferred of the rotation in progress
+        self._rotation = None
+        # set from the moment close() is called until it is done
+        self._closing = False
+        self._first_insert_at = None
 
     def initiate(self):
         self._db = adbapi.ConnectionPool('sqlite3', self._filename,
                                          cp_min=1, cp_max=1, cp_noisy=True,
                                          check_same_thread=False,
-                                         timeout=10)
+                                         timeout=10,
+                                         cp_openfun=self._connection_opened)
+        self._first_insert_at = None
         self._install_sighup()
         return self._check_schema()
 
     ### IJournalWriter ###
 
     def close(self, flush=True):
+        self._closing = True
+        if self._rotation is not None:
+            # the rotation in progress will not reopen the journal
+            d = defer.Deferred()
+            self._rotation.addCallback(d.callback)
+            d.addCallback(defer.drop_param, self.close, flush)
+            return d
         d = defer.succeed(None)
         if self._cmp_state(State.disconnected):
+            self._closing = False
             return d
         if flush:
             d.addCallback(defer.drop_param, self._flush_next)
@@ -419,6 +676,7 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
         d.addCallback(defer.drop_param, self._uninstall_sighup)
         d.addCallback(defer.drop_param, self._set_state,
                       State.disconnected)
+        d.addBoth(defer.bridge_param, self._close_done)
         return d
 
     @manhole.expose()
@@ -461,6 +719,45 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
         d.addCallback(self._decode)
         return d
 
+    @manhole.expose()
+    @in_state(State.connected)
+    def get_entries_page(self, history, cursor=None, limit=100):
+        '''
+        Paginated version of get_entries(). Returns a tuple of
+        (entries, cursor). The cursor should be passed to the next call
+        to get the following page, it is None if there is nothing more.
+        '''
+        if not isinstance(history, History):
+            raise AttributeError(
+                'First paremeter is expected to be History instance, got %r'
+                % history)
+
+        command = text_helper.format_block("""
+        SELECT histories.agent_id,
+               histories.instance_id,
+               entries.journal_id,
+               entries.function_id,
+               entries.fiber_id,
+               entries.fiber_depth,
+               entries.args,
+               entries.kwargs,
+               entries.side_effects,
+               entries.result,
+               entries.timestamp,
+               entries.rowid
+          FROM entries
+          LEFT JOIN histories ON histories.id = entries.history_id
+          WHERE entries.history_id = ?
+            AND entries.rowid > ?
+          ORDER BY entries.rowid ASC
+          LIMIT ?""")
+        # one more row tells if there is a next page
+        d = self._db.runQuery(command, (history.history_id, cursor or 0,
+                                        int(limit) + 1, ))
+        d.addCallback(self._decode)
+        d.addCallback(self._paginate, limit)
+        return d
+
     @in_state(State.connected)
     def get_log_entries(self, start_date=None, end_date=None, filters=list()):
         '''
@@ -474,38 +771,29 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
                         entries. The entries in this list are combined with
                         OR operator.
         '''
-        query = text_helper.format_block('''
-        SELECT logs.message,
-               logs.level,
-               logs.category,
-               logs.log_name,
-               logs.file_path,
-               logs.line_num,
-               logs.timestamp
-        FROM logs
-        WHERE 1
-        ''')
-        query = self._add_timestamp_condition_sql(query, start_date, end_date)
-
-        def transform_filter(filter):
-            level = filter.get('level', None)
-            category = filter.get('category', None)
-            name = filter.get('name', None)
-            if level is None:
-                raise AttributeError("level is mandatory parameter.")
-            resp = "(logs.level <= %d" % (int(level), )
-            if category is not None:
-                resp += " AND logs.category == '%s'" % (category, )
-            if name is not None:
-                resp += " AND logs.log_name == '%s'" % (name, )
-            resp += ')'
-            return resp
+        query = self._log_entries_query(start_date, end_date, filters)
+        d = self._db.runQuery(query)
+        d.addCallback(self._decode)
+        return d
 
-        filter_strings = map(transform_filter, filters)
-        if filter_strings:
-            query += " AND (%s)\n" % (' OR '.join(filter_strings), )
+    @manhole.expose()
+    @in_state(State.connected)
+    def get_log_entries_page(self, start_date=None, end_date=None,
+                             filters=list(), cursor=None, limit=100):
+        '''
+        Paginated version of get_log_entries(), allowing to browse big
+        journals without loading all the entries at once. Returns a tuple
+        of (entries, cursor). The cursor should be passed to the next call
+        to get the following page, it is None if there is nothing more.
+        '''
+        query = self._log_entries_query(start_date, end_date, filters,
+                                        extra_columns=['logs.rowid'])
+        query += "  AND logs.rowid > %d\n" % (int(cursor or 0), )
+        # one more row tells if there is a next page
+        query += "ORDER BY logs.rowid ASC LIMIT %d" % (int(limit) + 1, )
         d = self._db.runQuery(query)
         d.addCallback(self._decode)
+        d.addCallback(self._paginate, limit)
         return d
 
     @in_state(State.connected)
@@ -582,6 +870,48 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
 
     ### Private ###
 
+    def _log_entries_query(self, start_date, end_date, filters,
+                           extra_columns=[]):
+        columns = ['logs.message', 'logs.level', 'logs.category',
+                   'logs.log_name', 'logs.file_path', 'logs.line_num',
+                   'logs.timestamp'] + extra_columns
+        query = "SELECT %s\nFROM logs\nWHERE 1\n" % (
+            ",\n       ".join(columns), )
+        query = self._add_timestamp_condition_sql(query, start_date, end_date)
+
+        def transform_filter(filter):
+            level = filter.get('level', None)
+            category = filter.get('category', None)
+            name = filter.get('name', None)
+            if level is None:
+                raise AttributeError("level is mandatory parameter.")
+            resp = "(logs.level <= %d" % (int(level), )
+            if category is not None:
+                resp += " AND logs.category == '%s'" % (category, )
+            if name is not None:
+                resp += " AND logs.log_name == '%s'" % (name, )
+            resp += ')'
+            return resp
+
+        filter_strings = map(transform_filter, filters)
+        if filter_strings:
+            query += " AND (%s)\n" % (' OR '.join(filter_strings), )
+        return query
+
+    def _paginate(self, rows, limit):
+        '''
+        Splits the rowid (last column) from the rows of the page and
+        constructs the cursor for the next one. The rows are queried
+        with one extra row past the limit, there is a next page only
+        if it has been found.
+        '''
+        cursor = None
+        limit = int(limit)
+        if len(rows) > limit:
+            rows = rows[:limit]
+            cursor = rows[-1][-1]
+        return [row[:-1] for row in rows], cursor
+
     def _add_timestamp_condition_sql(self, query, start_date, end_date):
         if start_date is not None:
             query += "  AND logs.timestamp >= %d\n" % (int(start_date), )
@@ -589,6 +919,19 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
             query += "  AND logs.timestamp <= %d\n" % (int(end_date), )
         return query
 
+    def _connection_opened(self, connection):
+        '''
+        Applies the configured pragmas to freshly opened connection.
+
+        BEWARE: This method runs in a thread.
+        '''
+        if self._journal_mode is not None:
+            connection.execute("PRAGMA journal_mode = %s"
+                               % (self._journal_mode, ))
+        if self._synchronous is not None:
+            connection.execute("PRAGMA synchronous = %s"
+                               % (self._synchronous, ))
+
     def _reset_history_id_cache(self):
         # (agent_id, instance_id, ) -> history_id
         self._history_id_cache = dict()
@@ -600,6 +943,83 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
         if callable(self._on_rotate_cb):
             self._on_rotate_cb()
 
+    def _close_done(self):
+        self._closing = False
+
+    def _check_rotation(self):
+        if self._rotation is not None or self._closing:
+            return
+        if self._filename == ':memory:':
+            return
+        if self._first_insert_at is None:
+            # nothing has been written to this file yet
+            return
+        reason = None
+        if self._rotate_size is not None:
+            size = self._get_journal_size()
+            if size >= self._rotate_size:
+                reason = "its size of %d bytes" % (size, )
+        if self._rotate_age is not None:
+            age = time.time() - self._first_insert_at
+            if age >= self._rotate_age:
+                reason = "its age of %d seconds" % (age, )
+        if reason is not None:
+            self.log("Rotating the journal because of %s.", reason)
+            self._rotation = defer.Deferred()
+            time.callLater(0, self._rotate)
+
+    def _rotate(self):
+        if self._closing or not self._cmp_state(State.connected):
+            # we have been closed in the meantime
+            self._rotation_done()
+            return
+        # the archiving runs under the semaphore so it never happens
+        # in the middle of inserting the entries
+        d = self._semaphore.run(self._archive_journal)
+        d.addCallback(defer.drop_param, self._reopen_journal)
+        d.addErrback(self._error_handler)
+        d.addBoth(defer.drop_param, self._rotation_done)
+        return d
+
+    def _archive_journal(self):
+        self._set_state(State.disconnected)
+        self._db.close()
+        archive = self._get_archive_filename()
+        os.rename(self._filename, archive)
+        self.info("Journal %r archived as %r.", self._filename, archive)
+
+    def _reopen_journal(self):
+        if self._closing:
+            self.log("Not reopening the journal, it is being closed.")
+            return
+        d = self.initiate()
+        if callable(self._on_rotate_cb):
+            d.addCallback(defer.drop_param, self._on_rotate_cb)
+        return d
+
+    def _rotation_done(self):
+        rotation, self._rotation = self._rotation, None
+        rotation.callback(None)
+
+    def _get_journal_size(self):
+        size = os.path.getsize(self._filename)
+        # in WAL mode the writes stay in the -wal file until a checkpoint
+        try:
+            size += os.path.getsize(self._filename + '-wal')
+        except OSError:
+            pass
+        return size
+
+    def _get_archive_filename(self):
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        base = "%s.%s" % (self._filename, stamp)
+        filename = base
+        index = 0
+        while os.path.exists(filename):
+            index += 1
+            filename = "%s.%d" % (base, index)
+        return filename
+
     def _install_sighup(self):
         if self._sighup_installed:
             return
@@ -639,6 +1059,7 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
         return map(decode_blobs, entries)
 
     def _encode(self, data):
+        data = self._encoder.encode(data)
         result = dict()
 
         if data['entry_type'] == 'journal':
@@ -688,7 +1109,37 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
                          "the value of: %r",
                          self._encoding, encoding, encoding)
         self._encoding = encoding
-        self._initiated_ok()
+        d = self._db.runQuery(
+            'SELECT value FROM metadata WHERE name = "schema_version"')
+        d.addCallback(self._got_schema_version)
+        return d
+
+    def _got_schema_version(self, res):
+        # files created before the schema got versioned have no entry
+        version = int(res[0][0]) if res else 1
+        if version > SCHEMA_VERSION:
+            self.warning("Journal %r has schema version %d which is newer "
+                         "than the one supported (%d). Trying to use it "
+                         "anyway.", self._filename, version, SCHEMA_VERSION)
+        if version >= SCHEMA_VERSION:
+            return self._initiated_ok()
+
+        self.info("Migrating journal %r from schema version %d to %d.",
+                  self._filename, version, SCHEMA_VERSION)
+        commands = list()
+        for target in range(version + 1, SCHEMA_VERSION + 1):
+            commands.extend(SCHEMA_MIGRATIONS[target])
+        if version == 1:
+            commands.append("INSERT INTO metadata VALUES"
+                            "('schema_version', '%d')" % (SCHEMA_VERSION, ))
+        else:
+            commands.append("UPDATE metadata SET value = '%d' "
+                            "WHERE name = 'schema_version'"
+                            % (SCHEMA_VERSION, ))
+
+        d = self._db.runWithConnection(self._run_commands, commands)
+        d.addCallbacks(self._initiated_ok, self._error_handler)
+        return d
 
     def _create_schema(self, fail):
         fail.trap(sqlite3.OperationalError)
@@ -738,23 +1189,30 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
             CREATE INDEX instance_idx ON histories(agent_id, instance_id)
             """)]
 
-        def run_all(connection, commands):
-            for command in commands:
-                self.log('Executing command:\n %s', command)
-                connection.execute(command)
+        for version in range(2, SCHEMA_VERSION + 1):
+            commands.extend(SCHEMA_MIGRATIONS[version])
 
         insert_meta = "INSERT INTO metadata VALUES('%s', '%s')"
-        commands += [insert_meta % (u'encoding', self._encoding, )]
+        commands += [insert_meta % (u'encoding', self._encoding, ),
+                     insert_meta % (u'schema_version', SCHEMA_VERSION, )]
 
         self._reset_history_id_cache()
         # insert_history = "INSERT INTO histories VALUES(%d, '%s', %d)"
         # for (a_id, i_id), h_id in self._history_id_cache.iteritems():
         #     commands += [insert_history % (h_id, a_id, i_id)]
 
-        d = self._db.runWithConnection(run_all, commands)
+        d = self._db.runWithConnection(self._run_commands, commands)
         d.addCallbacks(self._initiated_ok, self._error_handler)
         return d
 
+    def _run_commands(self, connection, commands):
+        '''
+        BEWARE: This method runs in a thread.
+        '''
+        for command in commands:
+            self.log('Executing command:\n %s', command)
+            connection.execute(command)
+
     def _initiated_ok(self, *_):
         self.log('Journaler initiated correctly for the filename %r',
                  self._filename)
@@ -762,28 +1220,16 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
         return self._flush_next()
 
     def _perform_inserts(self, cache):
+        if not self._cmp_state(State.connected):
+            # the journal is being rotated, _flush_next() will wait
+            return defer.succeed(None)
 
-        def do_insert_entry(connection, history_id, data):
-            command = text_helper.format_block("""
-            INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """)
-            connection.execute(
-                command, (history_id,
-                          data['journal_id'], data['function_id'],
-                          data['fiber_id'], data['fiber_depth'],
-                          data['args'], data['kwargs'],
-                          data['side_effects'], data['result'],
-                          data['timestamp']))
-
-        def do_insert_log(connection, data):
-            command = text_helper.format_block("""
-            INSERT INTO logs VALUES (?, ?, ?, ?, ?, ?, ?)
-            """)
-            connection.execute(
-                command, (data['message'], int(data['level']),
-                          data['category'], data['log_name'],
-                          data['file_path'], data['line_num'],
-                          data['timestamp']))
+        insert_entry = text_helper.format_block("""
+        INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """)
+        insert_log = text_helper.format_block("""
+        INSERT INTO logs VALUES (?, ?, ?, ?, ?, ?, ?)
+        """)
 
         def transaction(connection, cache):
             entries = cache.fetch()
@@ -791,14 +1237,39 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
                 return
             try:
                 entries = map(self._encode, entries)
+                # resolve the history ids once per (agent_id, instance_id)
+                # and not once per entry
+                history_ids = dict()
+                entry_rows = list()
+                log_rows = list()
                 for data in entries:
                     if data['entry_type'] == 'journal':
-                        history_id = self._get_history_id(
-                            connection, data['agent_id'], data['instance_id'])
-                        do_insert_entry(connection, history_id, data)
+                        key = (data['agent_id'], data['instance_id'], )
+                        history_id = history_ids.get(key)
+                        if history_id is None:
+                            history_id = self._get_history_id(
+                                connection, *key)
+                            history_ids[key] = history_id
+                        entry_rows.append(
+                            (history_id,
+                             data['journal_id'], data['function_id'],
+                             data['fiber_id'], data['fiber_depth'],
+                             data['args'], data['kwargs'],
+                             data['side_effects'], data['result'],
+                             data['timestamp']))
                     elif data['entry_type'] == 'log':
-                        do_insert_log(connection, data)
+                        log_rows.append(
+                            (data['message'], int(data['level']),
+                             data['category'], data['log_name'],
+                             data['file_path'], data['line_num'],
+                             data['timestamp']))
+                if entry_rows:
+                    connection.executemany(insert_entry, entry_rows)
+                if log_rows:
+                    connection.executemany(insert_log, log_rows)
                 cache.commit()
+                if self._first_insert_at is None:
+                    self._first_insert_at = time.time()
             except Exception:
                 cache.rollback()
                 raise
@@ -841,6 +1312,7 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
             return defer.succeed(None)
         else:
             d = self._semaphore.run(self._perform_inserts, self._cache)
+            d.addCallback(defer.drop_param, self._check_rotation)
             d.addCallback(defer.drop_param, self._flush_next)
             return d
 
@@ -853,9 +1325,60 @@ class Record(object):
 
     def commit(self, **data):
         data['entry_type'] = 'journal'
+        data['captured'] = True
+        data['size'] = sexp_size([data['journal_id'], data['args'],
+                                  data['kwargs'], data['side_effects'],
+                                  data['result']])
         self._journaler.insert_entry(**data)
 
 
+class EntryEncoder(object):
+    '''
+    Second stage of the journal entries serialization. The entries
+    are captured on the reactor thread as s-expressions, which are
+    made only of immutable values, and encoded to the blobs stored
+    in the journal by the writers outside of the reactor thread.
+    An instance should never be used by two threads at the same time.
+    '''
+
+    def __init__(self):
+        self._codec = banana.BananaCodec()
+        self._binary = binary.BinaryCodec()
+        self._serializer = banana.Serializer()
+
+    def encode(self, data):
+        if not data.get('captured'):
+            return data
+        encode = self._codec.encode
+        result = dict(data)
+        del result['captured']
+        del result['size']
+        for key in ('journal_id', 'args', 'kwargs', 'result'):
+            result[key] = encode(data[key])
+        if (data['journal_id'] == 'agency'
+            and data['function_id'] == 'snapshot'):
+            # the arguments of snapshots are stored in the binary format,
+            # so they can be unserialized one by one, see replay
+            result['args'] = self._binary.encode(data['args'])
+        side_effects = map(self._encode_side_effect, data['side_effects'])
+        result['side_effects'] = self._serializer.convert(side_effects)
+        return result
+
+    ### private ###
+
+    def _encode_side_effect(self, record):
+        if not record:
+            # the side effect has never been committed
+            return []
+        encode = self._codec.encode
+        function_id, args, kwargs, effects, result = record
+        effects = [(effect_id, encode(effect_args), encode(effect_kwargs))
+                   for effect_id, effect_args, effect_kwargs in effects]
+        if result is not None:
+            result = encode(result)
+        return [function_id, encode(args), encode(kwargs), effects, result]
+
+
 class JournalerConnection(log.Logger, log.LogProxy):
     implements(IJournalerConnection)
 
@@ -863,8 +1386,9 @@ class JournalerConnection(log.Logger, log.LogProxy):
         log.LogProxy.__init__(self, journaler)
         log.Logger.__init__(self, self)
 
-        self.serializer = banana.Serializer(externalizer=externalizer)
-        self.snapshot_serializer = banana.Serializer()
+        # entries are only captured here, see EntryEncoder
+        self.serializer = sexp.Serializer(externalizer=externalizer)
+        self.snapshot_serializer = sexp.Serializer()
         self.journaler = IJournaler(journaler)
 
     ### IJournalerConnection ###
@@ -882,11 +1406,14 @@ class JournalerConnection(log.Logger, log.LogProxy):
 
     def snapshot(self, agent_id, instance_id, snapshot):
         record = self.journaler.prepare_record()
+        # the agent and its protocols are given as separate arguments,
+        # so the replay can restore them one at a time
+        agent, protocols = snapshot
         entry = AgencyJournalEntry(
             self.snapshot_serializer, record, agent_id, instance_id,
-            'agency', 'snapshot', snapshot)
+            'agency', 'snapshot', agent, *protocols)
         entry.set_result(None)
-        entry.commit()
+        return entry.commit()
 
 
 class AgencyJournalSideEffect(object):
@@ -995,6 +1522,10 @@ class AgencyJournalEntry(object):
         return AgencyJournalSideEffect(self._serializer, record,
                                        function_id, *args, **kwargs)
 
+    def estimate_size(self):
+        '''Estimates the size in bytes of the converted arguments.'''
+        return sexp_size(self._data.get('args'))
+
     def commit(self):
         try:
             self._data['args'] = self._serializer.convert(
@@ -1003,8 +1534,6 @@ class AgencyJournalEntry(object):
                     self._not_serialized['kwargs'])
             self._data['result'] = self._serializer.freeze(
                     self._not_serialized['result'])
-            self._data['side_effects'] = self._serializer.convert(
-                    self._data['side_effects'])
             self._record.commit(**self._data)
             self._record = None
             return self
@@ -120,14 +120,20 @@ class Connection(log.Logger):
                            len(list(recipients)), message)
                 return
 
-        defers = []
+        # The message is published once for every recipient, but
+        # the backend only has to prepare it once for all of them.
+        routes = {}
+        order = []
         for recip in recipients:
             assert recip.channel == self.channel_type, \
                    "Unexpected channel type"
             self.log('Sending message to %r', recip)
-            d = self._messaging.publish(recip.key, recip.route, message)
-            defers.append(d)
-        return defer.DeferredList(defers)
+            if recip.route not in routes:
+                routes[recip.route] = []
+                order.append(recip.route)
+            routes[recip.route].append(recip.key)
+        return self._messaging.publish_many(
+            [(route, routes[route]) for route in order], message)
 
     def release(self):
         self._disconnected = True
@@ -23,6 +23,7 @@ import sys
 import re
 import types
 import os
+import math
 
 from twisted.internet import reactor
 from twisted.spread import pb
@@ -49,6 +50,12 @@ from feat.agencies.net.broker import BrokerRole
 
 GATEWAY_PORT_COUNT = 100
 HOST_RESTART_RETRY_INTERVAL = 5
+# Interval in seconds the snapshots of all the agents are spread over
+SNAPSHOT_INTERVAL = 300
+# Time in seconds snapshotting agents may take in one reactor iteration
+SNAPSHOT_BUDGET = 0.05
+# Minimum delay in seconds between two snapshotting iterations
+SNAPSHOT_MIN_DELAY = 0.5
 
 
 class AgencyAgent(agency.AgencyAgent):
@@ -58,6 +65,132 @@ class AgencyAgent(agency.AgencyAgent):
         return self.agency.gateway_port
 
 
+class SnapshotScheduler(log.Logger):
+    '''
+    Spreads the snapshots of the agents over the snapshot interval.
+    Every round the agents needing a snapshot are ordered by the number
+    of journal entries since their last one, and snapshotted a few in
+    every iteration for as long as the time budget allows.
+    Keeps the size and duration of the snapshots per agent type.
+    The clock is an IReactorTime provider, by default the scaled time
+    of the reactor is used.
+    '''
+
+    def __init__(self, agency, interval=SNAPSHOT_INTERVAL,
+                 budget=SNAPSHOT_BUDGET, min_delay=SNAPSHOT_MIN_DELAY,
+                 clock=None):
+        log.Logger.__init__(self, agency)
+        self.agency = agency
+        self.interval = interval
+        self.budget = budget
+        self.min_delay = min_delay
+        self._clock = clock
+
+        # agents still to snapshot this round, the first ones last
+        self._queue = []
+        self._per_iteration = 1
+        self._delay = interval
+        self._round_task = None
+        self._iteration_task = None
+        # agent type -> [count, total size, max size,
+        #                total duration, max duration]
+        self._metrics = dict()
+
+    def start(self):
+        self._round_task = self._call_later(self.interval, self._start_round)
+
+    def stop(self):
+        for task in (self._round_task, self._iteration_task):
+            if task is not None and task.active():
+                task.cancel()
+        self._round_task = None
+        self._iteration_task = None
+        self._queue = []
+
+    def get_pending(self):
+        return len(self._queue)
+
+    def snapshot(self, medium):
+        '''Snapshots the agent right away and updates the metrics.'''
+        started = self._seconds()
+        entry = medium.journal_snapshot()
+        duration = self._seconds() - started
+        size = entry.estimate_size() if entry is not None else 0
+
+        agent_type = medium.get_descriptor().document_type
+        if agent_type not in self._metrics:
+            self._metrics[agent_type] = [0, 0, 0, 0.0, 0.0]
+        metrics = self._metrics[agent_type]
+        metrics[0] += 1
+        metrics[1] += size
+        metrics[2] = max(metrics[2], size)
+        metrics[3] += duration
+        metrics[4] = max(metrics[4], duration)
+
+    def get_metrics(self):
+        '''
+        Gives a list of (agent type, snapshots, average size, max size,
+        average duration, max duration) with sizes in bytes
+        and durations in seconds.
+        '''
+        return [(agent_type, count, size / count, max_size,
+                 duration / count, max_duration)
+                for agent_type, (count, size, max_size,
+                                 duration, max_duration)
+                in sorted(self._metrics.items())]
+
+    ### private ###
+
+    def _start_round(self):
+        self._round_task = self._call_later(self.interval, self._start_round)
+        agents = [x for x in self.agency.iter_agents() if x.should_snapshot()]
+        if self._queue:
+            self.warning("Snapshotting round started with %d agents "
+                         "still waiting from the previous one.",
+                         len(self._queue))
+        agents.sort(key=lambda x: x.get_entries_since_snapshot())
+        self._queue = agents
+        if not agents:
+            return
+
+        self.log("Snapshotting %d agents in the next %ds.",
+                 len(agents), self.interval)
+        iterations = min(len(agents), int(self.interval / self.min_delay))
+        iterations = max(iterations, 1)
+        self._per_iteration = int(math.ceil(float(len(agents)) / iterations))
+        self._delay = float(self.interval) / iterations
+        if self._iteration_task is None:
+            self._iteration_task = self._call_later(0, self._iterate)
+
+    def _iterate(self):
+        self._iteration_task = None
+        started = self._seconds()
+        done = 0
+        while self._queue and done < self._per_iteration:
+            if done and self._seconds() - started > self.budget:
+                break
+            medium = self._queue.pop()
+            agent_id = medium.get_agent_id()
+            if self.agency.get_agent(agent_id) is not medium:
+                continue
+            if not medium.should_snapshot():
+                continue
+            self.snapshot(medium)
+            done += 1
+        if self._queue:
+            self._iteration_task = self._call_later(self._delay, self._iterate)
+
+    def _seconds(self):
+        if self._clock is None:
+            return time.time_no_sfx()
+        return self._clock.seconds()
+
+    def _call_later(self, delay, fun):
+        if self._clock is None:
+            return time.callLater(delay, fun)
+        return self._clock.callLater(delay, fun)
+
+
 class Agency(agency.Agency):
 
     agency_agent_factory = AgencyAgent
@@ -75,14 +208,24 @@ class Agency(agency.Agency):
                  msg_port=options.DEFAULT_MSG_PORT,
                  msg_user=options.DEFAULT_MSG_USER,
                  msg_password=options.DEFAULT_MSG_PASSWORD,
+                 msg_wire_format=options.DEFAULT_MSG_WIRE_FORMAT,
+                 msg_commit_interval=options.DEFAULT_MSG_COMMIT_INTERVAL,
+                 msg_commit_size=options.DEFAULT_MSG_COMMIT_SIZE,
+                 msg_prefetch=options.DEFAULT_MSG_PREFETCH,
                  db_host=options.DEFAULT_DB_HOST,
                  db_port=options.DEFAULT_DB_PORT,
                  db_name=options.DEFAULT_DB_NAME,
+                 db_pool_size=options.DEFAULT_DB_POOL_SIZE,
+                 db_cache_size=options.DEFAULT_DB_CACHE_SIZE,
                  public_key=options.DEFAULT_MH_PUBKEY,
                  private_key=options.DEFAULT_MH_PRIVKEY,
                  authorized_keys=options.DEFAULT_MH_AUTH,
                  manhole_port=options.DEFAULT_MH_PORT,
                  agency_journal=options.DEFAULT_JOURFILE,
+                 journal_cache_size=options.DEFAULT_JOURNAL_CACHE_SIZE,
+                 journal_overflow=options.DEFAULT_JOURNAL_OVERFLOW,
+                 journal_rotate_size=options.DEFAULT_JOURNAL_ROTATE_SIZE,
+                 journal_rotate_age=options.DEFAULT_JOURNAL_ROTATE_AGE,
                  socket_path=options.DEFAULT_SOCKET_PATH,
                  gateway_port=options.DEFAULT_GW_PORT,
                  enable_spawning_slave=options.DEFAULT_ENABLE_SPAWNING_SLAVE,
@@ -103,14 +246,24 @@ class Agency(agency.Agency):
                           msg_port=msg_port,
                           msg_password=msg_password,
                           msg_user=msg_user,
+                          msg_wire_format=msg_wire_format,
+                          msg_commit_interval=msg_commit_interval,
+                          msg_commit_size=msg_commit_size,
+                          msg_prefetch=msg_prefetch,
                           db_host=db_host,
                           db_port=db_port,
                           db_name=db_name,
+                          db_pool_size=db_pool_size,
+                          db_cache_size=db_cache_size,
                           public_key=public_key,
                           private_key=private_key,
                           authorized_keys=authorized_keys,
                           manhole_port=manhole_port,
                           agency_journal=agency_journal,
+                          journal_cache_size=journal_cache_size,
+                          journal_overflow=journal_overflow,
+                          journal_rotate_size=journal_rotate_size,
+                          journal_rotate_age=journal_rotate_age,
                           socket_path=socket_path,
                           gateway_port=gateway_port,
                           enable_spawning_slave=enable_spawning_slave,
@@ -182,15 +335,30 @@ class Agency(agency.Agency):
         if self.config['agency']['daemonize']:
             os.chdir(self.config['agency']['rundir'])
 
+        commit_interval = self.config['msg']['commit_interval']
+        commit_size = self.config['msg']['commit_size']
+        prefetch = self.config['msg']['prefetch']
         mesg = messaging.Messaging(
             self.config['msg']['host'], int(self.config['msg']['port']),
-            self.config['msg']['user'], self.config['msg']['password'])
+            self.config['msg']['user'], self.config['msg']['password'],
+            wire_format=self.config['msg']['wire_format'],
+            commit_interval=(commit_interval is not None
+                             and float(commit_interval) or None),
+            commit_size=commit_size is not None and int(commit_size) or None,
+            prefetch_count=prefetch is not None and int(prefetch) or None)
         mesg.redirect_log(self)
+        pool_size = self.config['db']['pool_size']
+        cache_size = self.config['db']['cache_size']
         db = database.Database(
             self.config['db']['host'], int(self.config['db']['port']),
-            self.config['db']['name'])
+            self.config['db']['name'], pool_size and int(pool_size),
+            cache_size and int(cache_size))
         db.redirect_log(self)
-        jour = journaler.Journaler(self)
+        cache_size = self.config['agency']['journal_cache_size']
+        overflow = self.config['agency']['journal_overflow']
+        jour = journaler.Journaler(
+            self, max_cache_size=cache_size and int(cache_size),
+            overflow_policy=journaler.OverflowPolicy.get(str(overflow)))
         self._journal_writer = None
 
         reactor.addSystemEventTrigger('before', 'shutdown',
@@ -265,9 +433,13 @@ class Agency(agency.Agency):
         self._ssh.start_listening()
         filename = os.path.join(self.config['agency']['rundir'],
                                 self.config['agency']['journal'])
+        rotate_size = self.config['agency']['journal_rotate_size']
+        rotate_age = self.config['agency']['journal_rotate_age']
         self._journal_writer = journaler.SqliteWriter(
             self, filename=filename, encoding='zip',
-            on_rotate=self._force_snapshot_agents)
+            on_rotate=self._force_snapshot_agents,
+            rotate_size=rotate_size and int(rotate_size),
+            rotate_age=rotate_age and int(rotate_age))
         self._journaler.configure_with(self._journal_writer)
         self._journal_writer.initiate()
         self._start_master_gateway()
@@ -471,12 +643,27 @@ class Agency(agency.Agency):
     @manhole.expose()
     def show_connections(self):
         t = text_helper.Table(
-            fields=("Connection", "Connected", "Host", "Port", "Reconnect in"),
-            lengths=(20, 15, 30, 10, 15))
+            fields=("Connection", "Connected", "Host", "Port",
+                    "Reconnect in", "Statistics"),
+            lengths=(20, 15, 30, 10, 15, 35))
         connections = self._backends.values() + [self._database]
         iterator = (x.show_status() for x in connections)
         return t.render(iterator)
 
+    @manhole.expose()
+    def show_journal_cache(self):
+        '''Print counters of the entries waiting for the journal writer.'''
+        t = text_helper.Table(fields=("Counter", "Value"), lengths=(20, 15))
+        stats = self._journaler.get_cache_stats()
+        return t.render(sorted(stats.items()))
+
+    @manhole.expose()
+    def show_replication(self):
+        '''Print counters of the shared state replication between brokers.'''
+        t = text_helper.Table(fields=("Counter", "Value"), lengths=(20, 15))
+        stats = self._broker.get_replication_stats()
+        return t.render(sorted(stats.items()))
+
     ### Manhole inspection methods ###
 
     @manhole.expose()
@@ -521,10 +708,15 @@ class Agency(agency.Agency):
 
     def _init_config(self, msg_host=None, msg_port=None,
                      msg_user=None, msg_password=None,
+                     msg_wire_format=None, msg_commit_interval=None,
+                     msg_commit_size=None, msg_prefetch=None,
                      db_host=None, db_port=None, db_name=None,
+                     db_pool_size=None, db_cache_size=None,
                      public_key=None, private_key=None,
                      authorized_keys=None, manhole_port=None,
-                     agency_journal=None, socket_path=None,
+                     agency_journal=None, journal_cache_size=None,
+                     journal_overflow=None, journal_rotate_size=None,
+                     journal_rotate_age=None, socket_path=None,
                      gateway_port=None, enable_spawning_slave=None,
                      rundir=None, logdir=None, daemonize=None,
                      force_host_restart=None):
@@ -532,11 +724,17 @@ class Agency(agency.Agency):
         msg_conf = dict(host=msg_host,
                         port=msg_port,
                         user=msg_user,
-                        password=msg_password)
+                        password=msg_password,
+                        wire_format=msg_wire_format,
+                        commit_interval=msg_commit_interval,
+                        commit_size=msg_commit_size,
+                        prefetch=msg_prefetch)
 
         db_conf = dict(host=db_host,
                        port=db_port,
-                       name=db_name)
+                       name=db_name,
+                       pool_size=db_pool_size,
+                       cache_size=db_cache_size)
 
         manhole_conf = dict(public_key=public_key,
                             private_key=private_key,
@@ -547,6 +745,10 @@ class Agency(agency.Agency):
             socket_path = os.path.join(rundir, socket_path)
 
         agency_conf = dict(journal=agency_journal,
+                           journal_cache_size=journal_cache_size,
+                           journal_overflow=journal_overflow,
+                           journal_rotate_size=journal_rotate_size,
+                           journal_rotate_age=journal_rotate_age,
                            socket_path=socket_path,
                            rundir=rundir,
                            logdir=logdir,
@@ -697,36 +899,43 @@ class Agency(agency.Agency):
         return first((x for x in self._agents
                       if x.get_descriptor().document_type == 'host_agent'))
 
-    @defer.inlineCallbacks
     def _find_agent(self, agent_id):
         '''
         Specific to master agency, called by the broker.
         Will return AgencyAgent if agent is hosted by master agency,
         PB.Reference if it runs in stanadlone or None if it was not found.
+        The slave agents are looked up in the index the broker keeps
+        from their registrations, no slave is queried.
         '''
-        local = yield self.find_agent_locally(agent_id)
-        if local:
-            defer.returnValue(local)
-        for slave in self._broker.iter_slaves():
-            found = yield slave.callRemote('find_agent_locally', agent_id)
-            if found:
-                defer.returnValue(found)
-        defer.returnValue(None)
+        local = self.get_agent(agent_id)
+        if local is None:
+            local = self._broker.lookup_agent(agent_id)
+        return defer.succeed(local)
 
     @manhole.expose()
     def snapshot_agents(self, force=False):
-        agency.Agency.snapshot_agents(self, force)
+        for medium in list(self.iter_agents()):
+            if force or medium.should_snapshot():
+                self._snapshoter.snapshot(medium)
         if force:
             return self._broker.broadcast_force_snapshot()
 
-    def _setup_snapshoter(self):
-        self._snapshot_task = time.callLater(300, self._trigger_snapshot)
+    @manhole.expose()
+    def show_snapshots(self):
+        '''Print the size and duration of the agent snapshots per type.'''
+        t = text_helper.Table(
+            fields=("Agent type", "Snapshots", "Avg size", "Max size",
+                    "Avg ms", "Max ms"),
+            lengths=(30, 12, 12, 12, 10, 10))
+        rows = [(agent_type, count, avg_size, max_size,
+                 "%.1f" % (avg_time * 1000), "%.1f" % (max_time * 1000))
+                for (agent_type, count, avg_size, max_size,
+                     avg_time, max_time) in self._snapshoter.get_metrics()]
+        return t.render(rows)
 
-    def _trigger_snapshot(self):
-        self.log("Snapshoting all the agents.")
-        self.snapshot_agents()
-        self._snapshot_task = None
-        self._setup_snapshoter()
+    def _setup_snapshoter(self):
+        self._snapshoter = SnapshotScheduler(self)
+        self._snapshoter.start()
 
     def _force_snapshot_agents(self):
         self.log("Journal has been rotated, forcing snapshot of agents")
@@ -734,9 +943,7 @@ class Agency(agency.Agency):
         self.snapshot_agents(force=True)
 
     def _cancel_snapshoter(self):
-        if self._snapshot_task is not None and self._snapshot_task.active():
-            self._snapshot_task.cancel()
-        self._snapshot_task = None
+        self._snapshoter.stop()
 
     def _start_slave_gateway(self):
         master_port = int(self.config["gateway"]["port"])
@@ -27,7 +27,7 @@ from twisted.internet.error import (CannotListenError, ConnectionRefusedError,
                                     ConnectionDone, )
 from twisted.spread import pb, jelly
 
-from feat.common import log, enum, defer, first, error, manhole
+from feat.common import log, enum, defer, first, error, manhole, time
 from feat.agencies import common
 
 
@@ -47,6 +47,8 @@ class SlaveReference(object):
         self.is_standalone = is_standalone
         # agent_id -> pb.Reference to AgencyAgent instance
         self.agents = dict()
+        # last version of the shared state the slave acknowledged
+        self.state_version = 0
 
     def callRemote(self, _method, *args, **kwargs):
         return self.reference.callRemote(_method, *args, **kwargs)
@@ -59,40 +61,52 @@ class SlaveReference(object):
 
 
 class SharedState(dict):
+    '''
+    Dictionary replicated between the brokers. Modifications are applied
+    locally right away and buffered as a delta coalesced per key, the
+    broker sends it once per reactor tick.
+    '''
 
     def __init__(self, broker, items=[]):
         dict.__init__(self, items)
         self._broker = broker
+        # key -> (True, value) for set or (False, None) for delete
+        self._changes = dict()
+        self._cleared = False
 
     ### dict implementation ###
 
     def __setitem__(self, key, value):
         self.set_locally(key, value)
-        self._broker.update_state_broadcast('set_locally', key, value)
+        self._changed(key, True, value)
 
     def __delitem__(self, key):
         self.del_locally(key)
-        self._broker.update_state_broadcast('del_locally', key)
+        self._changed(key, False)
 
     def clear(self):
         self.clear_locally()
-        self._broker.update_state_broadcast('clear_locally')
+        self._changes.clear()
+        self._cleared = True
+        self._broker.state_changed()
 
     def pop(self, key):
         if key not in self:
             raise KeyError("%s key not found!")
         res = dict.pop(self, key)
-        self._broker.update_state_broadcast('del_locally', key)
+        self._changed(key, False)
         return res
 
     def popitem(self):
         key, value = dict.popitem(self)
-        self._broker.update_state_broadcast('del_locally', key)
+        self._changed(key, False)
         return key, value
 
     def update(self, dict):
         self.update_locally(dict.items())
-        self._broker.update_state_broadcast('update_locally', dict.items())
+        for key, value in dict.items():
+            self._changes[key] = (True, value)
+        self._broker.state_changed()
 
     ### local modifications ###
 
@@ -115,6 +129,72 @@ class SharedState(dict):
         for key, value in items:
             self.set_locally(key, value)
 
+    ### replication ###
+
+    def has_changes(self):
+        return self._cleared or bool(self._changes)
+
+    def count_changes(self):
+        return len(self._changes)
+
+    def take_delta(self):
+        '''
+        Gives the buffered modifications as a tuple
+        (cleared, updated items, deleted keys) and forgets them.
+        '''
+        updated = [(key, value)
+                   for key, (is_set, value) in self._changes.iteritems()
+                   if is_set]
+        deleted = [key for key, (is_set, _) in self._changes.iteritems()
+                   if not is_set]
+        delta = (self._cleared, updated, deleted)
+        self._changes = dict()
+        self._cleared = False
+        return delta
+
+    def apply_delta(self, delta):
+        '''
+        Applies a delta received from another broker. The keys modified
+        locally and not sent yet are left alone, their values will
+        override the received ones when replicated.
+        '''
+        if self._cleared:
+            # our pending clear() will discard it anyway
+            return
+        cleared, updated, deleted = delta
+        if cleared:
+            self.clear_locally()
+            self._apply_changes()
+        for key, value in updated:
+            if key not in self._changes:
+                self.set_locally(key, value)
+        for key in deleted:
+            if key not in self._changes:
+                self.del_locally(key)
+
+    def resync(self, items):
+        '''
+        Resets the content to the items of the master shared state
+        keeping the modifications not sent yet.
+        '''
+        if self._cleared:
+            return
+        self.reset_locally(items)
+        self._apply_changes()
+
+    ### private ###
+
+    def _changed(self, key, is_set, value=None):
+        self._changes[key] = (is_set, value)
+        self._broker.state_changed()
+
+    def _apply_changes(self):
+        for key, (is_set, value) in self._changes.iteritems():
+            if is_set:
+                self.set_locally(key, value)
+            else:
+                self.del_locally(key)
+
 
 class BrokerRole(enum.Enum):
 
@@ -122,7 +202,7 @@ class BrokerRole(enum.Enum):
 
 
 class Broker(log.Logger, log.LogProxy, common.StateMachineMixin,
-             manhole.Manhole, pb.Root):
+             common.Statistics, manhole.Manhole, pb.Root):
     '''
     Mixin for the network agency. It is responsible on connecting/listening
     on the unix socket. The broker which manages to listen is taking the master
@@ -139,6 +219,7 @@ class Broker(log.Logger, log.LogProxy, common.StateMachineMixin,
         log.Logger.__init__(self, agency)
         log.LogProxy.__init__(self, agency)
         common.StateMachineMixin.__init__(self, BrokerRole.disconnected)
+        common.Statistics.__init__(self)
         self.agency = agency
 
         self.connector = None
@@ -148,6 +229,8 @@ class Broker(log.Logger, log.LogProxy, common.StateMachineMixin,
         self._is_standalone = standalone
         # agency_id -> pb.RemoteReference to Agency
         self.slaves = dict()
+        # agent_id -> SlaveReference of the slave agency hosting it
+        self._agent_index = dict()
         self.notifier = defer.Notifier()
 
         self.on_master_cb = on_master_cb
@@ -156,6 +239,13 @@ class Broker(log.Logger, log.LogProxy, common.StateMachineMixin,
         self.on_remove_slave_cb = on_remove_slave_cb
 
         self.shared_state = SharedState(self)
+        # version of the last shared state delta broadcast or applied
+        self._state_version = 0
+        # IDelayedCall sending the buffered shared state delta
+        self._state_flush = None
+        self._resyncing = False
+        self._replication_lag = None
+        self._max_replication_lag = 0
 
     def is_master(self):
         return self._cmp_state(BrokerRole.master)
@@ -199,6 +289,9 @@ class Broker(log.Logger, log.LogProxy, common.StateMachineMixin,
         This is called as part of the agency shutdown.
         '''
         self.log("Disconnecting broker %r.", self)
+        if self._state_flush is not None:
+            self._state_flush.cancel()
+            self._state_flush = None
         if self.is_master():
             d = self.listener.stopListening()
             d.addCallback(defer.drop_param, self.factory.disconnect)
@@ -223,15 +316,36 @@ class Broker(log.Logger, log.LogProxy, common.StateMachineMixin,
         self.debug('Appending slave agency: %r', slave)
         self.append_slave(broker, agency_id, slave, standalone)
         slave.notifyOnDisconnect(self.remove_slave(agency_id))
-        return self.shared_state.items()
+        self.slaves[agency_id].state_version = self._state_version
+        return self.remote_get_shared_state()
+
+    def remote_get_shared_state(self):
+        return self._state_version, self.shared_state.items()
+
+    def remote_update_state_delta(self, delta):
+        self.increase_stat('deltas received')
+        self.shared_state.apply_delta(delta)
+        self._broadcast_delta(delta)
 
     def remote_register_agent_local(self, slave_id, agent_id, reference):
         slave = self.slaves[slave_id]
         slave.register_agent(agent_id, reference)
+        self._agent_index[agent_id] = slave
 
     def remote_unregister_agent_local(self, slave_id, agent_id):
         slave = self.slaves[slave_id]
         slave.unregister_agent(agent_id)
+        if self._agent_index.get(agent_id) is slave:
+            del self._agent_index[agent_id]
+
+    def lookup_agent(self, agent_id):
+        '''
+        Master specific. Gives the pb.RemoteReference of the agent if it
+        is hosted by one of the slave agencies or None.
+        '''
+        slave = self._agent_index.get(agent_id)
+        if slave is not None:
+            return slave.agents.get(agent_id)
 
     def iter_slaves(self):
         return (slave.reference for slave in self.slaves.itervalues())
@@ -276,7 +390,10 @@ class Broker(log.Logger, log.LogProxy, common.StateMachineMixin,
         def do_remove(slave):
             self.log('Removing slave agency.')
             try:
-                del(self.slaves[slave_id])
+                reference = self.slaves.pop(slave_id)
+                for agent_id in reference.agents:
+                    if self._agent_index.get(agent_id) is reference:
+                        del self._agent_index[agent_id]
                 if callable(self.on_remove_slave_cb):
                     return self.on_remove_slave_cb()
             except ValueError:
@@ -286,6 +403,7 @@ class Broker(log.Logger, log.LogProxy, common.StateMachineMixin,
 
     def become_master(self):
         self._set_state(BrokerRole.master)
+        self.state_changed()
         if callable(self.on_master_cb):
             return self.on_master_cb()
 
@@ -306,8 +424,7 @@ class Broker(log.Logger, log.LogProxy, common.StateMachineMixin,
         d.addCallback(defer.drop_param, self._master.callRemote,
                       'handshake', self, self.agency, self.agency.agency_id,
                       self.is_standalone())
-        d.addCallback(defer.inject_param, 1, self.update_state,
-                      'reset_locally')
+        d.addCallback(self._reset_state)
 
         for medium in self.agency.iter_agents():
             d.addCallback(defer.drop_param, self.register_agent, medium)
@@ -431,24 +548,103 @@ class Broker(log.Logger, log.LogProxy, common.StateMachineMixin,
         return method(*args, **kwargs)
 
     @manhole.expose()
-    def update_state_broadcast(self, _method, *args, **kwargs):
-        origin_id = kwargs.pop('agency_id', self.agency.agency_id)
+    def resync_state(self):
+        '''
+        Slave specific. Replaces the shared state by the one of the master.
+        '''
+        self._ensure_state(BrokerRole.slave)
+        self.increase_stat('resyncs')
+        self._resyncing = True
+        d = self._master.callRemote('get_shared_state')
+        d.addCallback(self._reset_state)
+        d.addBoth(defer.bridge_param, setattr, self, '_resyncing', False)
+        return d
 
-        self._ensure_connected()
-        if self._cmp_state(BrokerRole.master):
-            defers = list()
-            if origin_id != self.agency.agency_id:
-                self.update_state(_method, *args, **kwargs)
-            for slave in self.iter_slave_references():
-                if slave.slave_id != self.agency.agency_id:
-                    defers.append(
-                        slave.broker.callRemote(
-                            'update_state', _method, *args, **kwargs))
-            return defer.DeferredList(defers, consumeErrors=True)
-        elif self._cmp_state(BrokerRole.slave):
-            return self._master.callRemote('update_state_broadcast',
-                                           _method, agency_id=origin_id,
-                                           *args, **kwargs)
+    @manhole.expose()
+    def get_replication_stats(self):
+        '''
+        Gives the shared state replication counters. The master reports
+        how many versions the slowest slave is behind, the slaves
+        report the time it took for the last delta to be applied.
+        '''
+        stats = dict(self.get_stats())
+        stats['version'] = self._state_version
+        stats['pending changes'] = self.shared_state.count_changes()
+        if self.is_master():
+            lags = [self._state_version - x.state_version
+                    for x in self.iter_slave_references()]
+            stats['max slave lag'] = max(lags) if lags else 0
+        elif self.is_slave():
+            stats['lag'] = self._replication_lag
+            stats['max lag'] = self._max_replication_lag
+        return stats
+
+    def state_changed(self):
+        '''
+        Called by the shared state when modified,
+        the delta is sent on the next reactor iteration.
+        '''
+        if self._state_flush is None:
+            self._state_flush = time.call_next(self._flush_state)
+
+    def remote_apply_state_delta(self, version, timestamp, delta):
+        self.increase_stat('deltas received')
+        if self._resyncing or version <= self._state_version:
+            return
+        if version != self._state_version + 1:
+            self.warning("Missed shared state deltas, got version %d "
+                         "while at version %d, resyncing.",
+                         version, self._state_version)
+            return self.resync_state()
+        self._state_version = version
+        self.shared_state.apply_delta(delta)
+        self._replication_lag = time.time() - timestamp
+        self._max_replication_lag = max(self._max_replication_lag,
+                                        self._replication_lag)
+
+    ### private ###
+
+    def _flush_state(self):
+        self._state_flush = None
+        if not self.shared_state.has_changes():
+            return
+        if self.is_master():
+            self._broadcast_delta(self.shared_state.take_delta())
+        elif self.is_slave() and not self._resyncing:
+            self.increase_stat('deltas sent')
+            d = self._master.callRemote('update_state_delta',
+                                        self.shared_state.take_delta())
+            d.addErrback(self._replication_failed, self._master)
+
+    def _broadcast_delta(self, delta):
+        self._state_version += 1
+        timestamp = time.time()
+        for slave in self.iter_slave_references():
+            if slave.slave_id != self.agency.agency_id:
+                self.increase_stat('deltas sent')
+                d = slave.broker.callRemote('apply_state_delta',
+                                            self._state_version,
+                                            timestamp, delta)
+                d.addCallback(defer.drop_param, setattr, slave,
+                              'state_version', self._state_version)
+                d.addErrback(self._replication_failed, slave.broker)
+
+    def _reset_state(self, state):
+        version, items = state
+        self._state_version = version
+        self.shared_state.resync(items)
+        if self.shared_state.has_changes():
+            self.state_changed()
+
+    def _replication_failed(self, fail, reference):
+        self.increase_stat('failed deltas')
+        if fail.check(ConnectionDone, pb.PBConnectionLost,
+                      pb.DeadReferenceError):
+            self.log('Swallowing %r - the broker is gone.',
+                     fail.value.__class__.__name__)
+            return
+        error.handle_failure(self, fail, "Failed replicating the shared "
+                             "state to %r", reference)
 
 
 class MasterFactory(pb.PBServerFactory, log.Logger):
@@ -21,14 +21,16 @@
 # Headers in this file shall remain intact.
 import sys
 import os
+import json
 
 from zope.interface import implements
 from twisted.web import error as web_error
-from twisted.internet import error
+from twisted.web.client import Agent
+from twisted.internet import error, reactor
 from twisted.web._newclient import ResponseDone
 from twisted.python import failure
 
-from feat.agencies.database import Connection, ChangeListener
+from feat.agencies.database import Connection, ChangeListener, DocumentCache
 from feat.common import log, defer, time
 from feat.agencies import common
 
@@ -42,24 +44,45 @@ sys.path.insert(0, os.path.join(extern.__path__[0], 'paisley'))
 from paisley.changes import ChangeNotifier
 from paisley.client import CouchDB
 
+try:
+    # Persistent connections are only supported by twisted >= 12.1
+    from twisted.web.client import HTTPConnectionPool
+except ImportError:
+    HTTPConnectionPool = None
+
 
 DEFAULT_DB_HOST = "localhost"
 DEFAULT_DB_PORT = 5984
 DEFAULT_DB_NAME = "feat"
+DEFAULT_DB_POOL_SIZE = 4
 
 
-class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
+class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
+               common.Statistics):
 
     implements(IDbConnectionFactory, IDatabaseDriver)
 
     log_category = "database"
 
-    def __init__(self, host, port, db_name):
+    def __init__(self, host, port, db_name, pool_size=None, cache_size=None):
+        '''At most pool_size HTTP requests are performed concurrently.
+        Requests and change notifications concerning the same document
+        are still processed one after the other.
+        If cache_size is specified the connections keep up to that number
+        of documents cached while receiving the change notifications.'''
         common.ConnectionManager.__init__(self)
         log.LogProxy.__init__(self, log.FluLogKeeper())
         ChangeListener.__init__(self, self)
+        common.Statistics.__init__(self)
+
+        if cache_size:
+            self.document_cache = DocumentCache(cache_size)
 
-        self.semaphore = defer.DeferredSemaphore(1)
+        self.pool_size = pool_size or DEFAULT_DB_POOL_SIZE
+        self.semaphore = defer.DeferredSemaphore(self.pool_size)
+        # doc_id -> DeferredLock
+        self._doc_locks = {}
+        self._connection_pool = None
         self.paisley = None
         self.db_name = None
         self.host = None
@@ -70,6 +93,8 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
         self.reconnector = None
 
         self._configure(host, port, db_name)
+        if self.document_cache is not None:
+            self._setup_notifier()
 
     def reconfigure(self, host, port, name):
         if self.notifier.isRunning():
@@ -80,28 +105,52 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
     def show_status(self):
         eta = self.reconnector and self.reconnector.active() and \
               time.left(self.reconnector.getTime())
-        return "Database", self.is_connected(), self.host, self.port, eta
+        return ("Database", self.is_connected(), self.host, self.port,
+                eta, self._format_stats())
 
     ### IDbConnectionFactory
 
     def get_connection(self):
-        return Connection(self)
+        return Connection(self, self.document_cache)
 
     ### IDatabaseDriver
 
     def open_doc(self, doc_id):
-        return self._paisley_call(self.paisley.openDoc, self.db_name, doc_id)
+        return self._document_call(doc_id, "open_doc", self.paisley.openDoc,
+                                   self.db_name, doc_id)
 
     def save_doc(self, doc, doc_id=None):
-        return self._paisley_call(self.paisley.saveDoc,
-                                  self.db_name, doc, doc_id)
+        return self._document_call(doc_id, "save_doc", self.paisley.saveDoc,
+                                   self.db_name, doc, doc_id)
 
     def delete_doc(self, doc_id, revision):
-        return self._paisley_call(self.paisley.deleteDoc,
-                                  self.db_name, doc_id, revision)
+        return self._document_call(doc_id, "delete_doc",
+                                   self.paisley.deleteDoc,
+                                   self.db_name, doc_id, revision)
+
+    def open_docs(self, doc_ids):
+        body = json.dumps({"keys": list(doc_ids)})
+        d = self._documents_call(doc_ids, "open_docs", self._bulk_request,
+                                 "_all_docs?include_docs=true", body)
+        d.addCallback(self._parse_all_docs)
+        return d
+
+    def save_docs(self, docs):
+        doc_ids = [json.loads(doc).get("_id") for doc in docs]
+        body = '{"docs": [%s]}' % (", ".join(docs), )
+        return self._documents_call(doc_ids, "save_docs", self._bulk_request,
+                                    "_bulk_docs", body)
+
+    def delete_docs(self, docs):
+        body = json.dumps(
+            {"docs": [{"_id": doc_id, "_rev": rev, "_deleted": True}
+                      for doc_id, rev in docs]})
+        doc_ids = [doc_id for doc_id, _rev in docs]
+        return self._documents_call(doc_ids, "delete_docs",
+                                    self._bulk_request, "_bulk_docs", body)
 
     def create_db(self):
-        return self._paisley_call(self.paisley.createDB,
+        return self._paisley_call("create_db", self.paisley.createDB,
                                   self.db_name)
 
     def listen_changes(self, doc_ids, callback):
@@ -115,7 +164,7 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
 
     def query_view(self, factory, **options):
         factory = IViewFactory(factory)
-        d = self._paisley_call(self.paisley.openView,
+        d = self._paisley_call("query_view", self.paisley.openView,
                                self.db_name, DESIGN_DOC_ID, factory.name,
                                **options)
         d.addCallback(self._parse_view_result)
@@ -131,12 +180,16 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
             doc_id = change['id']
             for line in change['changes']:
                 # The changes are analized when there is not http request
-                # pending. Otherwise it can result in race condition problem.
-                self.semaphore.run(self._trigger_change, doc_id, line['rev'])
+                # pending for the same document. Otherwise it can result
+                # in race condition problem.
+                self._document_call(doc_id, None, self._trigger_change,
+                                    doc_id, line['rev'])
         else:
             self.info('Bizare notification received from CouchDB: %r', change)
 
     def connectionLost(self, reason):
+        if self.document_cache is not None:
+            self.document_cache.disable()
         if reason.check(error.ConnectionDone):
             # expected just pass
             return
@@ -166,14 +219,32 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
         self._cancel_reconnector()
         self.host, self.port = host, port
         self.paisley = CouchDB(host, port)
+        self._setup_connection_pool()
         self.db_name = name
         self.notifier = ChangeNotifier(self.paisley, self.db_name)
         self.notifier.addListener(self)
 
         # ping database to figure trigger changing state to connected
-        d = self._paisley_call(self.paisley.listDB)
+        d = self._paisley_call("list_db", self.paisley.listDB)
         d.addErrback(failure.Failure.trap, NotConnectedError)
 
+    def _bulk_request(self, path, body):
+        d = self.paisley.post("/%s/%s" % (self.db_name, path), body)
+        d.addCallback(self.paisley.parseResult)
+        return d
+
+    def _parse_all_docs(self, resp):
+        assert "rows" in resp
+
+        result = []
+        for row in resp["rows"]:
+            value = row.get("value")
+            if "error" in row or value is None or value.get("deleted"):
+                result.append(None)
+            else:
+                result.append(row["doc"])
+        return result
+
     def _parse_view_result(self, resp):
         assert "rows" in resp
 
@@ -186,7 +257,10 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
                  doc_ids)
         if self.notifier.isRunning():
             self.notifier.stop()
-        if len(doc_ids) == 0:
+        if self.document_cache is not None:
+            # The notifications received while restarting are lost.
+            self.document_cache.disable()
+        elif len(doc_ids) == 0:
             # Don't run listner if it is not needed,
             # cancel reconnector if one is running.
             if self.reconnector and self.reconnector.active():
@@ -206,6 +280,8 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
                    'notifications.')
         self._on_connected()
         self._cancel_reconnector()
+        if self.document_cache is not None:
+            self.document_cache.enable()
 
     def _cancel_reconnector(self):
         if self.reconnector:
@@ -214,15 +290,101 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
             self.reconnector = None
             self.retry = 0
 
-    def _paisley_call(self, method, *args, **kwargs):
-        # It is necessarry to acquire the lock to perform the http request
-        # because we need to be sure that we are not in the middle of sth
-        # while analizing the change notification
-        d = self.semaphore.run(method, *args, **kwargs)
+    def _setup_connection_pool(self):
+        if self._connection_pool is not None:
+            self._connection_pool.closeCachedConnections()
+            self._connection_pool = None
+        if HTTPConnectionPool is None or not hasattr(self.paisley, "client"):
+            return
+        pool = HTTPConnectionPool(reactor, persistent=True)
+        pool.maxPersistentPerHost = self.pool_size
+        self.paisley.client = Agent(reactor, pool=pool)
+        self._connection_pool = pool
+
+    def _document_call(self, doc_id, name, method, *args, **kwargs):
+        # It is necessarry to acquire the document lock to perform the http
+        # request because we need to be sure that we are not in the middle
+        # of sth while analizing the change notification of the document.
+        # Documents without identifier are new, nobody is listening to them.
+        if doc_id is None:
+            return self._paisley_call(name, method, *args, **kwargs)
+
+        lock = self._get_document_lock(doc_id)
+        if name is None:
+            d = lock.run(method, *args, **kwargs)
+        else:
+            d = lock.run(self._paisley_call, name, method, *args, **kwargs)
+        d.addBoth(self._release_document, doc_id, lock)
+        return d
+
+    def _documents_call(self, doc_ids, name, method, *args, **kwargs):
+        # Bulk requests hold the locks of all the documents involved.
+        # They are always acquired in the same order to avoid deadlocks
+        # between concurrent bulk requests.
+        doc_ids = sorted(set(x for x in doc_ids if x is not None))
+        locks = [(doc_id, self._get_document_lock(doc_id))
+                 for doc_id in doc_ids]
+        d = defer.succeed(None)
+        for _doc_id, lock in locks:
+            d.addCallback(defer.drop_param, lock.acquire)
+        d.addCallback(defer.drop_param, self._paisley_call,
+                      name, method, *args, **kwargs)
+        d.addBoth(self._release_documents, locks)
+        return d
+
+    def _release_documents(self, result, locks):
+        for doc_id, lock in locks:
+            lock.release()
+            self._release_document(None, doc_id, lock)
+        return result
+
+    def _get_document_lock(self, doc_id):
+        lock = self._doc_locks.get(doc_id)
+        if lock is None:
+            lock = defer.DeferredLock()
+            self._doc_locks[doc_id] = lock
+        return lock
+
+    def _release_document(self, result, doc_id, lock):
+        if not (lock.locked or lock.waiting):
+            if self._doc_locks.get(doc_id) is lock:
+                del self._doc_locks[doc_id]
+        return result
+
+    def _paisley_call(self, name, method, *args, **kwargs):
+        d = self.semaphore.run(self._timed_call, name, method,
+                               *args, **kwargs)
         d.addCallback(defer.bridge_param, self._on_connected)
         d.addErrback(self._error_handler)
         return d
 
+    def _timed_call(self, name, method, *args, **kwargs):
+        started = time.time()
+        d = defer.maybeDeferred(method, *args, **kwargs)
+        d.addBoth(self._update_latency, name, started)
+        return d
+
+    def _update_latency(self, result, name, started):
+        self.increase_stat(name)
+        self.increase_stat(name + " time", time.time() - started)
+        return result
+
+    def _format_stats(self):
+        stats = dict(self.get_stats())
+        in_flight = self.pool_size - self.semaphore.tokens
+        doc_waiting = sum([len(x.waiting) for x in self._doc_locks.values()])
+        lines = ["in flight: %d/%d" % (in_flight, self.pool_size),
+                 "queued: %d" % (len(self.semaphore.waiting), ),
+                 "waiting for documents: %d" % (doc_waiting, )]
+        for name in sorted(stats):
+            if name + " time" in stats:
+                lines.append("%s: %d (%.1f ms)" % (
+                    name, stats[name],
+                    stats[name + " time"] * 1000 / stats[name]))
+        if self.document_cache is not None:
+            lines.append(self.document_cache.format_stats())
+        return "\n".join(lines)
+
     def _error_handler(self, failure):
         exception = failure.value
         msg = failure.getErrorMessage()
@@ -28,17 +28,30 @@ from feat.extern.txamqp.protocol import AMQClient
 from feat.extern.txamqp.content import Content
 from feat.extern.txamqp import queue as txamqp_queue
 from twisted.internet import reactor, protocol
+from twisted.python import failure
 from zope.interface import implements
 
 from feat.common import log, defer, enum, error_handler, time
-from feat.common.serialization import banana
+from feat.common.serialization import banana, binary
 from feat.agencies.messaging import Connection, Queue
 from feat.agencies.common import StateMachineMixin, ConnectionManager
+from feat.agencies.common import Statistics
 from feat.agents.base.message import BaseMessage
 
 from feat.agencies.interface import IConnectionFactory
 from feat.interface.channels import IBackend
 
+# {WIRE_FORMAT: (CONTENT_TYPE, SERIALIZATION_MODULE)}
+WIRE_FORMATS = {"banana": ("application/x-feat-banana", banana),
+                "binary": ("application/x-feat-binary", binary)}
+
+# Agencies not aware of the content type only understand banana
+DEFAULT_WIRE_FORMAT = "banana"
+
+# Maximum time in seconds publications and acknowledgments wait for
+# the transaction to be committed when only a batch size is specified
+DEFAULT_COMMIT_INTERVAL = 0.05
+
 
 class MessagingClient(AMQClient, log.Logger):
 
@@ -159,7 +172,7 @@ class AMQFactory(protocol.ReconnectingClientFactory, log.Logger, log.LogProxy):
         self._wait_for_client = defer.Deferred()
 
 
-class Messaging(ConnectionManager, log.Logger, log.LogProxy):
+class Messaging(ConnectionManager, log.Logger, log.LogProxy, Statistics):
 
     implements(IConnectionFactory, IBackend)
 
@@ -167,11 +180,34 @@ class Messaging(ConnectionManager, log.Logger, log.LogProxy):
 
     channel_type = "default"
 
-    def __init__(self, host, port, user='guest', password='guest'):
+    def __init__(self, host, port, user='guest', password='guest',
+                 wire_format=None, commit_interval=None, commit_size=None,
+                 prefetch_count=None):
+        '''If commit_interval or commit_size are specified, publications
+        and acknowledgments are not committed one by one but in batches
+        of at most commit_size operations waiting at most commit_interval
+        seconds. The deferreds they return are fired after the commit.
+        If prefetch_count is specified, the queues receive up to that
+        number of messages before the previous ones are acknowledged.'''
         ConnectionManager.__init__(self)
         log.LogProxy.__init__(self, log.FluLogKeeper())
         log.Logger.__init__(self, self)
+        Statistics.__init__(self)
+
+        wire_format = wire_format or DEFAULT_WIRE_FORMAT
+        if wire_format not in WIRE_FORMATS:
+            raise ValueError("Unknown wire format %r, valid formats are: %s"
+                             % (wire_format, ", ".join(WIRE_FORMATS)))
+
+        self.wire_format = wire_format
+
+        if commit_size is not None and commit_interval is None:
+            commit_interval = DEFAULT_COMMIT_INTERVAL
+        self.commit_interval = commit_interval
+        self.commit_size = commit_size
+        self.prefetch_count = prefetch_count
 
+        self._started = time.time()
         self._user = user
         self._password = password
         self._host = None
@@ -192,7 +228,8 @@ class Messaging(ConnectionManager, log.Logger, log.LogProxy):
 
     def show_status(self):
         eta = self._factory.get_eta_to_reconnect()
-        return "Messaging", self.is_connected(), self._host, self._port, eta
+        return ("Messaging", self.is_connected(), self._host, self._port,
+                eta, self._format_stats())
 
     ### IConnectionFactory ###
 
@@ -229,6 +266,11 @@ class Messaging(ConnectionManager, log.Logger, log.LogProxy):
 
     ### private ###
 
+    def _format_stats(self):
+        elapsed = max(time.time() - self._started, 1)
+        return "\n".join(["%s: %d (%.1f/s)" % (k, v, v / elapsed)
+                          for k, v in sorted(self.get_stats())])
+
     def _configure(self, host, port):
         self._host = host
         self._port = port
@@ -294,12 +336,26 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
         self.channel = None
         self.client = None
         self.factory = factory
+        self.messaging = messaging
 
         self._queues = []
         self._processing_chain = []
 
-        self.serializer = banana.Serializer()
+        # Deferreds waiting for the next transaction commit when batching
+        self._pending_commit = []
+        self._commit_call = None
+        # (delivery tag, Deferred) of the messages waiting to be acked
+        self._pending_acks = []
+        self._acking = False
+
+        # Messages are published using the format of the backend,
+        # but any known format is accepted based on the content type
+        content_type, module = WIRE_FORMATS[messaging.wire_format]
+        self.content_type = content_type
+        self.serializer = module.Serializer()
         self.unserializer = banana.Unserializer()
+        self._unserializers = dict([(t, m.Unserializer())
+                                    for t, m in WIRE_FORMATS.values()])
 
         client_defer.addCallback(self._setup_with_client)
 
@@ -393,6 +449,9 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
     def get_queue_consumer(self, name):
         d = self.channel.queue_declare(
             queue=name, durable=True, auto_delete=False)
+        if self.messaging.prefetch_count:
+            d.addCallback(lambda _: self.channel.basic_qos(
+                prefetch_count=self.messaging.prefetch_count))
         d.addCallback(lambda _:
                       self.channel.basic_consume(queue=name, no_ack=False))
         d.addCallback(lambda resp: self.client.queue(resp.consumer_tag))
@@ -408,27 +467,41 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
         d.addCallback(queue.configure)
         return d
 
-    @wait_for_channel
     def publish(self, key, shard, message):
-        assert isinstance(message, BaseMessage), \
-               "Unexpected message class"
-        serialized = self.serializer.convert(message)
-        content = Content(serialized)
-        content.properties['delivery mode'] = 1  # non-persistent
+        content = self._prepare_content(message)
+        return self._publish(key, shard, content, message)
+
+    def publish_many(self, routes, message):
+        '''Publishes the message for a list of (shard, keys) serializing
+        it only once. Gives a DeferredList of the publications.'''
+        content = self._prepare_content(message)
+        defers = [self._publish(key, shard, content, message)
+                  for shard, keys in routes for key in keys]
+        return defer.DeferredList(defers)
 
+    @wait_for_channel
+    def _publish(self, key, shard, content, message):
         self.log('Publishing msg=%s, shard=%s, key=%s', message, shard, key)
         d = self.channel.basic_publish(exchange=shard, content=content,
                                        routing_key=key, immediate=False)
-        d.addCallback(self.tx_commit)
+        d.addCallback(self._commit)
+        d.addCallback(defer.drop_param, self.messaging.increase_stat,
+                      'messages published')
         d.addCallback(defer.override_result, message)
         return d
 
     @wait_for_channel
     def disconnect(self):
-        # Both methods needs to be called. Closes channel locally the other
-        # one sends channel close. Yes, it is very bizzare.
-        d = self.channel.channel_close()
-        d.addCallback(self.channel.close)
+
+        def close(_):
+            # Both methods needs to be called. Closes channel locally the
+            # other one sends channel close. Yes, it is very bizzare.
+            d = self.channel.channel_close()
+            d.addCallback(self.channel.close)
+            return d
+
+        d = self._flush_commit()
+        d.addCallback(close)
         return d
 
     @wait_for_channel
@@ -452,25 +525,100 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
         return self.channel.queue_unbind(exchange=exchange, routing_key=key,
                                          queue=queue)
 
-    @wait_for_channel
     def ack(self, message):
-        self.log("Sending ack for the message.")
-        d = self.channel.basic_ack(message.delivery_tag)
-        d.addCallback(self.tx_commit)
+        '''While an acknowledgment is being sent the messages received
+        in the meantime are acknowledged together afterwards.'''
+        d = defer.Deferred()
+        self._pending_acks.append((message.delivery_tag, d))
+        if not self._acking:
+            self._send_acks()
+        return d
+
+    @wait_for_channel
+    def _ack(self, delivery_tag, multiple):
+        self.log("Sending ack for the message(s) up to %r.", delivery_tag)
+        d = self.channel.basic_ack(delivery_tag, multiple)
+        d.addCallback(self._commit)
         return d
 
     @wait_for_channel
     def tx_commit(self, *_):
+        self.messaging.increase_stat('commits')
         return self.channel.tx_commit()
 
-    def parse_message(self, msg):
+    def _commit(self, _=None):
+        if self.messaging.commit_interval is None:
+            return self.tx_commit()
+
+        d = defer.Deferred()
+        self._pending_commit.append(d)
+        size = self.messaging.commit_size
+        if size is not None and len(self._pending_commit) >= size:
+            self._flush_commit()
+        elif self._commit_call is None:
+            self._commit_call = time.callLater(self.messaging.commit_interval,
+                                               self._flush_commit)
+        return d
+
+    def _flush_commit(self):
+        if self._commit_call is not None:
+            if self._commit_call.active():
+                self._commit_call.cancel()
+            self._commit_call = None
+
+        if not self._pending_commit:
+            return defer.succeed(None)
+
+        pending, self._pending_commit = self._pending_commit, []
+        d = self.tx_commit()
+        d.addBoth(self._commit_done, pending)
+        return d
+
+    def _commit_done(self, result, pending):
+        for d in pending:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def _send_acks(self):
+        pending, self._pending_acks = self._pending_acks, []
+        delivery_tag = max([tag for tag, _ in pending])
+        self._acking = True
+        d = self._ack(delivery_tag, len(pending) > 1)
+        d.addBoth(self._acks_sent, pending)
+
+    def _acks_sent(self, result, pending):
+        self._acking = False
+        for _, d in pending:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                self.messaging.increase_stat('messages acked')
+                d.callback(result)
+        if self._pending_acks:
+            self._send_acks()
 
-        def unwrap(_, msg):
-            body = msg.content.body
-            return self.unserializer.convert(body)
+    def _prepare_content(self, message):
+        assert isinstance(message, BaseMessage), \
+               "Unexpected message class"
+        serialized = self.serializer.convert(message)
+        content = Content(serialized)
+        content.properties['delivery mode'] = 1  # non-persistent
+        content.properties['content type'] = self.content_type
+        return content
 
+    def parse_message(self, msg):
+        # The message is unserialized without waiting for the ack
         d = self.ack(msg)
-        d.addCallback(unwrap, msg)
+        content_type = msg.content.properties.get('content type')
+        unserializer = self._unserializers.get(content_type,
+                                               self.unserializer)
+        try:
+            result = unserializer.convert(msg.content.body)
+        except Exception:
+            result = failure.Failure()
+        d.addCallback(defer.override_result, result)
         return d
 
 
@@ -483,6 +631,12 @@ class WrappedQueue(Queue, log.Logger):
         self.channel = channel
         self.queue = None
 
+        self.window = channel.messaging.prefetch_count or 1
+        self._fetching = False
+        # [parsed, result] of the messages being parsed, they are enqueued
+        # in the order they have been received
+        self._parsing = []
+
     def configure(self, bare_queue):
         if bare_queue is None:
             raise ValueError('Got None, expected TimeoutDeferredQueue.')
@@ -494,12 +648,34 @@ class WrappedQueue(Queue, log.Logger):
         return self
 
     def _main_loop(self, *_):
+        if (self._fetching or self.queue is None
+            or len(self._parsing) >= self.window):
+            return
+        self._fetching = True
         d = self.queue.get()
-        d.addCallback(self.channel.parse_message)
-        d.addCallback(self.enqueue)
-        d.addCallbacks(self._main_loop, self._error_handler)
+        d.addCallbacks(self._received, self._error_handler)
+
+    def _received(self, msg):
+        self._fetching = False
+        self.channel.messaging.increase_stat('received by ' + self.name)
+        entry = [False, None]
+        self._parsing.append(entry)
+        d = self.channel.parse_message(msg)
+        d.addBoth(self._parsed, entry)
+        self._main_loop()
+
+    def _parsed(self, result, entry):
+        entry[0], entry[1] = True, result
+        while self._parsing and self._parsing[0][0]:
+            _, result = self._parsing.pop(0)
+            if isinstance(result, failure.Failure):
+                self._error_handler(result)
+            else:
+                self.enqueue(result)
+        self._main_loop()
 
     def _error_handler(self, f):
+        self._fetching = False
         exception = f.value
         if isinstance(exception, txamqp_queue.Closed):
             if self.channel.factory.continueTrying:
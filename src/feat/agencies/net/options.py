@@ -25,14 +25,24 @@ from feat.common import reflect
 
 from feat.agencies.net.broker import DEFAULT_SOCKET_PATH
 from feat.agencies.net.database import DEFAULT_DB_HOST, DEFAULT_DB_PORT
-from feat.agencies.net.database import DEFAULT_DB_NAME
+from feat.agencies.net.database import DEFAULT_DB_NAME, DEFAULT_DB_POOL_SIZE
 
 DEFAULT_MSG_HOST = "localhost"
 DEFAULT_MSG_PORT = 5672
 DEFAULT_MSG_USER = "guest"
 DEFAULT_MSG_PASSWORD = "guest"
+DEFAULT_MSG_WIRE_FORMAT = "banana"
+DEFAULT_MSG_COMMIT_INTERVAL = None
+DEFAULT_MSG_COMMIT_SIZE = None
+DEFAULT_MSG_PREFETCH = None
+
+DEFAULT_DB_CACHE_SIZE = None
 
 DEFAULT_JOURFILE = 'journal.sqlite3'
+DEFAULT_JOURNAL_CACHE_SIZE = None
+DEFAULT_JOURNAL_OVERFLOW = "drop_log"
+DEFAULT_JOURNAL_ROTATE_SIZE = None
+DEFAULT_JOURNAL_ROTATE_AGE = None
 DEFAULT_GW_PORT = 5500
 
 # Only for command-line options
@@ -81,6 +91,32 @@ def add_agency_options(parser):
                      action="store", dest="agency_journal",
                      help=("journal filename (default: %s)"
                            % DEFAULT_JOURFILE))
+    group.add_option('--journal-cache-size',
+                     dest="agency_journal_cache_size",
+                     help=("maximum size in bytes of the journal entries "
+                           "kept in memory while waiting to be written "
+                           "(default: no limit)"),
+                     metavar="SIZE", type="int")
+    group.add_option('--journal-overflow',
+                     dest="agency_journal_overflow",
+                     help=("what to do with the journal entries over the "
+                           "cache size, 'drop_log' drops the log entries, "
+                           "'spill' writes them to a temporary file "
+                           "(default: %s)" % DEFAULT_JOURNAL_OVERFLOW),
+                     metavar="POLICY", type="choice",
+                     choices=("drop_log", "spill"))
+    group.add_option('--journal-rotate-size',
+                     dest="agency_journal_rotate_size",
+                     help=("start a new journal file when the current one "
+                           "grows over this size in bytes "
+                           "(default: no size limit)"),
+                     metavar="SIZE", type="int")
+    group.add_option('--journal-rotate-age',
+                     dest="agency_journal_rotate_age",
+                     help=("start a new journal file this number of "
+                           "seconds after the first entry written to the "
+                           "current one (default: no age limit)"),
+                     metavar="SECONDS", type="int")
     group.add_option('-S', '--socket-path', dest="agency_socket_path",
                      help=("path to the unix socket used by the agency"
                            "(default: %s)" % DEFAULT_SOCKET_PATH),
@@ -137,6 +173,28 @@ def add_msg_options(parser):
                      help=("password to messaging server (default: %s)" %
                            DEFAULT_MSG_PASSWORD),
                      metavar="PASSWORD")
+    group.add_option('--msgformat', dest="msg_wire_format",
+                     help=("format of the published messages, either "
+                           "banana or binary, messages in any of them are "
+                           "accepted (default: %s)" %
+                           DEFAULT_MSG_WIRE_FORMAT),
+                     metavar="FORMAT", choices=["banana", "binary"])
+    group.add_option('--msgcommitinterval', dest="msg_commit_interval",
+                     help=("commit published and acknowledged messages "
+                           "in batches waiting at most the specified "
+                           "number of seconds (default: commit every "
+                           "message)"),
+                     metavar="SECONDS", type="float")
+    group.add_option('--msgcommitsize', dest="msg_commit_size",
+                     help=("commit published and acknowledged messages "
+                           "in batches of at most the specified size "
+                           "(default: commit every message)"),
+                     metavar="SIZE", type="int")
+    group.add_option('--msgprefetch', dest="msg_prefetch",
+                     help=("number of messages an agent queue receives "
+                           "before acknowledging the previous ones "
+                           "(default: one message at a time)"),
+                     metavar="COUNT", type="int")
     parser.add_option_group(group)
 
 
@@ -155,6 +213,16 @@ def add_db_options(parser):
                      help=("host of database server to connect to "
                            "(default: %s)" % DEFAULT_DB_NAME),
                      metavar="NAME")
+    group.add_option('--dbpoolsize', dest="db_pool_size",
+                     help=("maximum number of concurrent requests to the "
+                           "database server (default: %s)" %
+                           DEFAULT_DB_POOL_SIZE),
+                     metavar="SIZE", type="int")
+    group.add_option('--dbcachesize', dest="db_cache_size",
+                     help=("number of documents to keep cached, they are "
+                           "invalidated by the database change notifications "
+                           "(default: no cache)"),
+                     metavar="SIZE", type="int")
     parser.add_option_group(group)
 
 
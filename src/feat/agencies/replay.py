@@ -25,7 +25,7 @@ from zope.interface import implements, classProvides
 
 from feat.common import serialization, log, text_helper, deep_compare
 from feat.agents.base import replay
-from feat.common.serialization import banana
+from feat.common.serialization import banana, binary
 
 from feat.interface.agent import IAgencyAgent
 from feat.interface.generic import ITimeProvider
@@ -213,7 +213,12 @@ class JournalReplayEntry(object):
             # registred, etc. It is important that it happens only once
             # for each entry. Here we store the result to later only
             # return it.
-            args = self._replay.unserializer.convert(self._args) or ()
+            if binary.is_binary(self._args):
+                # snapshots, the arguments are restored one at a time
+                args = tuple(binary.unserialize_stream(
+                    [self._args], externalizer=self._replay))
+            else:
+                args = self._replay.unserializer.convert(self._args) or ()
             kwargs = self._replay.unserializer.convert(self._kwargs) or {}
             self._unserialized_arguments = (args, kwargs)
         return self._unserialized_arguments
@@ -477,8 +482,11 @@ class Replay(log.FluLogKeeper, log.Logger):
         if self.agent is None:
             raise NoHamsterballError()
 
-    def _restore_snapshot(self, snapshot):
-        self.agent, self.protocols = snapshot
+    def _restore_snapshot(self, agent, *protocols):
+        if isinstance(agent, tuple):
+            # snapshot journaled as a single (agent, protocols) argument
+            agent, protocols = agent
+        self.agent, self.protocols = agent, list(protocols)
 
     def _check_snapshot(self, old_agent, old_protocols):
         # check that the state so far matches the snapshop
@@ -69,12 +69,13 @@ def create_connection(host, port, name):
 def push_initial_data(connection):
     global _documents
 
-    for doc in _documents:
-        try:
-            yield connection.save_document(doc)
-        except ConflictError:
+    results = yield connection.save_documents(_documents)
+    for doc, result in zip(_documents, results):
+        if isinstance(result, ConflictError):
             log.error('script', 'Document with id %s already exists!',
                       doc.doc_id)
+        elif isinstance(result, Exception):
+            raise result
 
     design = view.generate_design_doc()
     yield connection.save_document(design)
@@ -79,8 +79,8 @@ class OneRelation(Relation):
         match = Relation.query(self, partners)
         return self._ensure_one(partners, match)
 
-    def query_with_role(self, partners):
-        match = Relation.query_with_role(self, partners)
+    def query_with_role(self, partners, role):
+        match = Relation.query_with_role(self, partners, role)
         return self._ensure_one(partners, match)
 
     def _ensure_one(self, partners, match):
@@ -216,6 +216,53 @@ class BasePartner(serialization.Serializable, mro.MroMixin):
                  self.recipient, self.allocation_id, self.role, )
 
 
+class PartnersIndex(object):
+    '''
+    Positions of the partners of a descriptor revision indexed by recipient
+    key, by role and lazily by partner class. Positions are used instead of
+    the partners themselves so the lookups keep returning the instances of
+    the descriptor copy they are performed on.
+    '''
+
+    def __init__(self, desc):
+        self.doc_id = desc.doc_id
+        self.rev = desc.rev
+        self.size = len(desc.partners)
+        # recipient key -> [position]
+        self.keys = dict()
+        # role -> [position]
+        self.roles = dict()
+        # (partner class, role) -> [position]
+        self._classes = dict()
+
+        for position, partner in enumerate(desc.partners):
+            self.keys.setdefault(partner.recipient.key, []).append(position)
+            self.roles.setdefault(partner.role, []).append(position)
+
+    def is_valid(self, desc):
+        '''Tells if the index can be used for the descriptor. Descriptors
+        without revision are never considered valid.'''
+        return (self.rev is not None and self.rev == desc.rev
+                and self.doc_id == desc.doc_id
+                and self.size == len(desc.partners))
+
+    def find(self, partners, key):
+        return [partners[x] for x in self.keys.get(key, ())]
+
+    def query(self, partners, factory, role=None, with_role=False):
+        cache_key = (factory, role, with_role)
+        positions = self._classes.get(cache_key)
+        if positions is None:
+            if with_role:
+                candidates = self.roles.get(role, ())
+            else:
+                candidates = xrange(self.size)
+            positions = [x for x in candidates
+                         if isinstance(partners[x], factory)]
+            self._classes[cache_key] = positions
+        return [partners[x] for x in positions]
+
+
 class Partners(log.Logger, log.LogProxy, replay.Replayable):
 
     default_handler = BasePartner
@@ -229,12 +276,15 @@ class Partners(log.Logger, log.LogProxy, replay.Replayable):
         log.Logger.__init__(self, agent)
         log.LogProxy.__init__(self, agent)
         replay.Replayable.__init__(self, agent)
+        # Derived from the descriptor, it is not part of the state
+        self._index = None
 
     @replay.immutable
     def restored(self, state):
         log.Logger.__init__(self, state.agent)
         log.LogProxy.__init__(self, state.agent)
         replay.Replayable.restored(self)
+        self._index = None
 
     def init_state(self, state, agent):
         state.agent = agent
@@ -307,18 +357,23 @@ class Partners(log.Logger, log.LogProxy, replay.Replayable):
 
     @replay.immutable
     def query(self, state, name_or_class):
-        partners = state.agent.get_descriptor().partners
+        desc = state.agent.get_descriptor()
+        index = self._get_index(desc)
         if isinstance(name_or_class, types.TypeType) and \
             issubclass(name_or_class, BasePartner):
-            return filter(lambda x: isinstance(x, name_or_class), partners)
+            return index.query(desc.partners, name_or_class)
         else:
             relation = self._get_relation(name_or_class)
+            partners = index.query(desc.partners, relation.factory)
             return relation.query(partners)
 
     @replay.immutable
     def query_with_role(self, state, name, role):
-        partners = state.agent.get_descriptor().partners
+        desc = state.agent.get_descriptor()
+        index = self._get_index(desc)
         relation = self._get_relation(name)
+        partners = index.query(desc.partners, relation.factory,
+                               role, with_role=True)
         return relation.query_with_role(partners, role)
 
     @replay.immutable
@@ -330,7 +385,7 @@ class Partners(log.Logger, log.LogProxy, replay.Replayable):
         else:
             agent_id = recp
         desc = state.agent.get_descriptor()
-        match = [x for x in desc.partners if x.recipient.key == agent_id]
+        match = self._get_index(desc).find(desc.partners, agent_id)
         if len(match) == 0:
             return None
         elif len(match) > 1:
@@ -468,6 +523,13 @@ class Partners(log.Logger, log.LogProxy, replay.Replayable):
             f.add_callback(defer.drop_param, self.update_partner, partner)
         return f
 
+    def _get_index(self, desc):
+        index = self._index
+        if index is None or not index.is_valid(desc):
+            index = PartnersIndex(desc)
+            self._index = index
+        return index
+
     def _get_relation(self, name):
         try:
             return self._relations[name]
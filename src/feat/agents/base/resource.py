@@ -127,7 +127,7 @@ class Range(serialization.Serializable):
     ### IResourceDefinition ###
 
     def allocate(self, allocations, number):
-        values = self._find_free_values(allocations, number)
+        values = self._find_free_values(self._get_used(allocations), number)
         return AllocatedRange(values)
 
     def modify(self, allocations, resource, *args):
@@ -138,8 +138,12 @@ class Range(serialization.Serializable):
         - add - allocate specified number of random values more
         - add_specific - allocate specific value
         - release - release allocated specific value
+        The parameters of add_specific and release can also be lists of
+        values to allocate or release them in bulk.
         '''
         res = RangeModification()
+        used = self._get_used(allocations)
+        current = resource.values if resource is not None else set()
         last_cmd = None
         for param in args:
             if isinstance(param, (str, unicode, )):
@@ -147,23 +151,28 @@ class Range(serialization.Serializable):
             elif last_cmd is None:
                 raise DeclarationError("First parameter should be a command")
             elif last_cmd == 'add':
-                values = self._find_free_values(allocations, param)
-                for p in values:
-                    res.add_value(p)
+                values = self._find_free_values(used, param)
+                res.add_values(values)
+                used.update(values)
             elif last_cmd == 'add_specific':
-                if not self._value_free(allocations, param):
-                    raise NotEnoughResource(
-                        'Value %r of resource %s is allocated' %
-                        (param, self.name, ))
-                if param in resource.values:
-                    raise DeclarationError('Value %s is already included '
-                                           'in %r' % (param, resource))
-                res.add_value(param)
+                values = self._get_values(param)
+                for value in values:
+                    if value in used:
+                        raise NotEnoughResource(
+                            'Value %r of resource %s is allocated' %
+                            (value, self.name, ))
+                    if value in current:
+                        raise DeclarationError('Value %s is already included '
+                                               'in %r' % (value, resource))
+                res.add_values(values)
+                used.update(values)
             elif last_cmd == 'release':
-                if not param in resource.values:
-                    raise DeclarationError('Value %s is not included '
-                                           'in %r' % (param, resource))
-                res.add_value(-param)
+                values = self._get_values(param)
+                for value in values:
+                    if not value in current:
+                        raise DeclarationError('Value %s is not included '
+                                               'in %r' % (value, resource))
+                res.add_values([-x for x in values])
             else:
                 raise DeclarationError("Unknown modify command: %s" %
                                        (last_cmd, ))
@@ -171,23 +180,49 @@ class Range(serialization.Serializable):
 
     def reduce(self, allocations):
         # gives list of allocated values
-        return [x for x in range(self.first, self.last + 1)
-                if not self._value_free(allocations, x)]
+        return sorted(x for x in self._get_used(allocations)
+                      if self.first <= x <= self.last)
 
     def get_total(self):
         return (self.first, self.last)
 
     ### private ####
 
-    def _find_free_values(self, allocations, number):
+    def _get_used(self, allocations):
+        used = set()
+        for allocation in allocations:
+            used.update(allocation.values)
+        return used
+
+    def _get_values(self, param):
+        if isinstance(param, (list, tuple, set, frozenset)):
+            return list(param)
+        return [param]
+
+    def _free_intervals(self, used):
+        '''
+        Gives the list of (first, last) intervals of free values
+        in the gaps between the used values.
+        '''
+        intervals = list()
+        start = self.first
+        for value in sorted(x for x in used if self.first <= x <= self.last):
+            if value > start:
+                intervals.append((start, value - 1))
+            start = value + 1
+        if start <= self.last:
+            intervals.append((start, self.last))
+        return intervals
+
+    def _find_free_values(self, used, number):
         to_allocate = number
         res = list()
-        for x in range(self.first, self.last + 1):
+        for first, last in self._free_intervals(used):
             if number < 1:
                 break
-            if self._value_free(allocations, x):
-                res.append(x)
-                number -= 1
+            taken = min(number, last - first + 1)
+            res.extend(xrange(first, first + taken))
+            number -= taken
 
         if number > 0:
             total_allocated = self.last - self.first - to_allocate + number
@@ -196,10 +231,6 @@ class Range(serialization.Serializable):
                                     (self.name, total_allocated, to_allocate))
         return res
 
-    def _value_free(self, allocations, value):
-        included = any(map(lambda x: value in x.values, allocations))
-        return not included
-
     def __eq__(self, other):
         if not isinstance(other, type(self)):
             return NotImplemented
@@ -317,6 +348,9 @@ class AllocatedRange(serialization.Serializable):
     def add_value(self, value):
         self.values.add(value)
 
+    def add_values(self, values):
+        self.values.update(values)
+
     def __repr__(self):
         return str(self.values)
 
@@ -120,10 +120,11 @@ class ExpBase(object):
 @serialization.register
 class ExpDict(ExpBase):
     """
-    WARNING: - Getting the length and therefore construct like
-               "if exp_dict: ..." or "bool(exp_dict)"
-               will iterate over all elements.
-             - Comparison operations are very expensive.
+    Expiration times are kept in a heap, so the expired entries are
+    found without iterating over all the elements; they are removed
+    lazily when packing or when accessed.
+
+    WARNING: - Comparison operations are very expensive.
     """
 
     DEFAULT_MAX_SIZE = 1000
@@ -133,7 +134,8 @@ class ExpDict(ExpBase):
     classProvides(serialization.IRestorator)
     implements(serialization.ISerializable)
 
-    __slots__ = ("_time", "_items", "_max_size", "_last_pack")
+    __slots__ = ("_time", "_items", "_max_size", "_last_pack",
+                 "_heap", "_expired")
 
     def __init__(self, time_provider, max_size=None):
         '''Create an expiration dictionary.
@@ -143,12 +145,16 @@ class ExpDict(ExpBase):
         @type max_size: int'''
         self._time = ITimeProvider(time_provider)
         self._items = {} # {KEY: ExpItem(TIME, VALUE)}
+        self._heap = [] # [(TIME, ID, ExpItem, KEY)]
+        self._expired = set() # Keys of expired items not removed yet
         self._max_size = max_size or self.DEFAULT_MAX_SIZE
         self._last_pack = 0
 
     def clear(self):
         '''Removes all items from the dictionary.'''
         self._items.clear()
+        self._expired.clear()
+        del self._heap[:]
 
     def pack(self):
         '''Packs the dictionary by removing all expired items.'''
@@ -173,7 +179,7 @@ class ExpDict(ExpBase):
                 expiration = now + expiration
             if expiration <= now:
                 return
-        self._items[key] = ExpItem(expiration, value)
+        self._add_item(key, ExpItem(expiration, value))
 
     def remove(self, key):
         '''Removes the dictionary entry with with specified key .
@@ -185,6 +191,7 @@ class ExpDict(ExpBase):
         now = self._time.get_time()
         if self._items:
             item = self._items.pop(key)
+            self._expired.discard(key)
             if item.exp is None or item.exp > now:
                 return item.value
         raise KeyError(key)
@@ -200,6 +207,7 @@ class ExpDict(ExpBase):
         if self._items:
             try:
                 item = self._items.pop(key)
+                self._expired.discard(key)
                 if item.exp is None or item.exp > now:
                     return item.value
                 raise KeyError(key)
@@ -265,7 +273,7 @@ class ExpDict(ExpBase):
 
     def __setitem__(self, key, value):
         self._lazy_pack()
-        self._items[key] = ExpItem(None, value)
+        self._add_item(key, ExpItem(None, value))
 
     def __getitem__(self, key):
         item = self._get_item(key)
@@ -287,9 +295,8 @@ class ExpDict(ExpBase):
         return self.iterkeys()
 
     def __len__(self):
-        now = self._time.get_time()
-        return len([i for i in self._items.itervalues()
-                    if i.exp is None or i.exp > now])
+        self._expire(self._time.get_time())
+        return len(self._items) - len(self._expired)
 
     def __eq__(self, other):
         if not issubclass(type(other), type(self)):
@@ -323,6 +330,8 @@ class ExpDict(ExpBase):
         self._time, self._max_size, data = snapshot
         self._items = dict([(k, ExpItem.restore(s))
                             for k, s in data.iteritems()])
+        self._expired = set()
+        self._rebuild_heap()
         self._last_pack = 0
 
     ### Private Methods ###
@@ -335,10 +344,38 @@ class ExpDict(ExpBase):
                 self._pack(now)
 
     def _pack(self, now):
-        self._items = dict([(k, i) for k, i in self._items.iteritems()
-                            if i.exp is None or i.exp > now])
+        self._expire(now)
+        items = self._items
+        for key in self._expired:
+            del items[key]
+        self._expired.clear()
         self._last_pack = now
 
+    def _expire(self, now):
+        # Moves the keys of the items expired since last call
+        # from the heap to the set of expired keys
+        heap = self._heap
+        items = self._items
+        while heap and heap[0][0] <= now:
+            _exp, _id, item, key = heapq.heappop(heap)
+            if items.get(key) is item:
+                self._expired.add(key)
+
+    def _add_item(self, key, item):
+        self._items[key] = item
+        self._expired.discard(key)
+        if item.exp is not None:
+            heapq.heappush(self._heap, (item.exp, id(item), item, key))
+            # Replaced and removed items are still in the heap
+            if len(self._heap) > 2 * len(self._items) + 16:
+                self._rebuild_heap()
+
+    def _rebuild_heap(self):
+        heap = [(i.exp, id(i), i, k) for k, i in self._items.iteritems()
+                if i.exp is not None and k not in self._expired]
+        heapq.heapify(heap)
+        self._heap = heap
+
     def _get_item(self, key):
         self._lazy_pack()
         now = self._time.get_time()
@@ -347,6 +384,7 @@ class ExpDict(ExpBase):
             if item.exp is None or item.exp > now:
                 return item
             del self._items[key]
+            self._expired.discard(key)
         return None
 
 
@@ -29,6 +29,11 @@ from feat.common.serialization import sexp
 from feat.interface.serialization import *
 
 
+# Banana copies its pending buffer after every token it parses, so the
+# data is fed to it in chunks of this size to keep decoding linear.
+DECODING_CHUNK_SIZE = 16384
+
+
 class BananaCodec(object):
 
     def __init__(self):
@@ -43,21 +48,29 @@ class BananaCodec(object):
         return io.getvalue()
 
     def decode(self, data):
+        """Decodes a string or an iterable of string chunks, so the data
+        can be decoded while it is read or decompressed."""
+        if isinstance(data, basestring):
+            data = iter_chunks(data)
         heap = []
         self._banana.expressionReceived = heap.append
         try:
-            self._banana.dataReceived(data)
+            for chunk in data:
+                self._banana.dataReceived(chunk)
         finally:
             self._banana.buffer = ''
+            self._banana.listStack = []
             del self._banana.expressionReceived
         return heap[0]
 
 
 class Serializer(sexp.Serializer, BananaCodec):
 
-    def __init__(self, externalizer=None, source_ver=None, target_ver=None):
+    def __init__(self, externalizer=None, source_ver=None, target_ver=None,
+                 acyclic=False):
         sexp.Serializer.__init__(self, externalizer=externalizer,
-                                 source_ver=source_ver, target_ver=target_ver)
+                                 source_ver=source_ver, target_ver=target_ver,
+                                 acyclic=acyclic)
         BananaCodec.__init__(self)
 
     ### Overridden Methods ###
@@ -97,6 +110,11 @@ def unserialize(data):
     return _unserializer.convert(data)
 
 
+def iter_chunks(data, size=DECODING_CHUNK_SIZE):
+    for offset in xrange(0, len(data), size):
+        yield data[offset:offset + size]
+
+
 ### Private Stuff ###
 
 _serializer = Serializer()
@@ -131,6 +131,14 @@ class VersionAdapter(object):
 
     @classmethod
     def adapt_version(cls, snapshot, source_ver, target_ver):
+        for method in cls.get_version_adapters(source_ver, target_ver):
+            snapshot = method(snapshot)
+        return snapshot
+
+    @classmethod
+    def get_version_adapters(cls, source_ver, target_ver):
+        """Returns the list of methods to call in order to adapt
+        a snapshot from source_ver to target_ver."""
         assert isinstance(source_ver, int)
         assert isinstance(target_ver, int)
 
@@ -142,14 +150,15 @@ class VersionAdapter(object):
             step = -1
         else:
             # No adaption needed
-            return snapshot
+            return []
 
+        methods = []
         for ver in range(source_ver + step, target_ver + step, step):
             method = getattr(cls, template % (ver, ), None)
             if method is not None:
-                snapshot = method(snapshot)
+                methods.append(method)
 
-        return snapshot
+        return methods
 
 
 class MetaSnapshotable(MetaVersionAdapter):
@@ -213,6 +222,48 @@ class Serializable(Snapshotable):
         pass
 
 
+class RestorePlan(object):
+    """Everything needed to restore instances of a type from snapshots
+    of a given version, resolved once so unserializers do not have
+    to query the restorator and its version adapter for every instance.
+    Plans are created and cached by the L{Registry}."""
+
+    __slots__ = ("restorator", "prepare", "restore", "adapters")
+
+    def __init__(self, restorator, source_ver=None, target_ver=None):
+        self.restorator = restorator
+        self.prepare = restorator.prepare
+        # Only needed by restorators of immutable types
+        self.restore = getattr(restorator, "restore", None)
+        self.adapters = self._resolve_adapters(restorator,
+                                               source_ver, target_ver)
+
+    def adapt(self, snapshot):
+        for adapter in self.adapters:
+            snapshot = adapter(snapshot)
+        return snapshot
+
+    ### private ###
+
+    def _resolve_adapters(self, restorator, source_ver, target_ver):
+        if source_ver is None or not IVersionAdapter.providedBy(restorator):
+            return ()
+
+        #TODO: If external adapter is needed change this to a cast
+        adapter = IVersionAdapter(restorator)
+        adapt_version = adapter.adapt_version
+        default = VersionAdapter.adapt_version.im_func
+        if getattr(adapt_version, "im_func", None) is default:
+            # Standard version adapter, we can resolve the methods now
+            return tuple(adapter.get_version_adapters(source_ver,
+                                                      target_ver))
+
+        def adapt(snapshot):
+            return adapt_version(snapshot, source_ver, target_ver)
+
+        return (adapt, )
+
+
 class Registry(object):
     """Keep track of L{IRestorator}. Used by unserializers."""
 
@@ -220,16 +271,30 @@ class Registry(object):
 
     def __init__(self):
         self._restorators = {} # {TYPE_NAME: IRestorator}
+        self._plans = {} # {(TYPE_NAME, SOURCE_VER, TARGET_VER): RestorePlan}
 
     ### IRegistry ###
 
     def register(self, restorator):
         r = IRestorator(restorator)
         self._restorators[r.type_name] = r
+        # Cached plans may refer to replaced restorators
+        self._plans.clear()
 
     def lookup(self, type_name):
         return self._restorators.get(type_name)
 
+    def lookup_plan(self, type_name, source_ver=None, target_ver=None):
+        key = (type_name, source_ver, target_ver)
+        plan = self._plans.get(key)
+        if plan is None:
+            restorator = self._restorators.get(type_name)
+            if restorator is None:
+                return None
+            plan = RestorePlan(restorator, source_ver, target_ver)
+            self._plans[key] = plan
+        return plan
+
 
 class Externalizer(object):
     """Simplistic implementation of L{IExternalizer}.
@@ -338,6 +403,16 @@ class Serializer(object):
     should be moved to the constructor and self should not be passed anymore
     as the first parameter because the function would be then bound.
 
+    The lookup tables are compiled at construction time for both
+    converter and freezer capabilities, so the capabilities of basic
+    types are not checked for every value and the packing functions
+    are resolved only once.
+
+    If the serializer is created with acyclic=True it will not keep track
+    of references at all. It is faster but only safe if the caller
+    guarantees the value is a tree: containers referenced multiple times
+    are serialized multiple times and circular references never end.
+
     #FIXME: Add datetime types datetime, date, time and timedelta
 
     """
@@ -371,7 +446,7 @@ class Serializer(object):
 
     def __init__(self, converter_caps=None, freezer_caps=None,
                  post_converter=None, externalizer=None, registry=None,
-                 source_ver=None, target_ver=None):
+                 source_ver=None, target_ver=None, acyclic=False):
         global _global_registry
         assert ((source_ver is None) and (target_ver is None)) \
                or ((source_ver is not None) and (target_ver is not None))
@@ -382,6 +457,20 @@ class Serializer(object):
         self._registry = IRegistry(registry) if registry else _global_registry
         self._source_ver = source_ver
         self._target_ver = target_ver
+        # If the caller guarantees the serialized values never contain
+        # the same container twice we do not need to track references.
+        self._acyclic = acyclic
+        # {FREEZING: {TYPE: FLATTENER}}
+        self._value_flatteners = {
+            False: self._compile_lookup(self._value_lookup,
+                                        self.converter_capabilities),
+            True: self._compile_lookup(self._value_lookup,
+                                       self.freezer_capabilities)}
+        self._key_flatteners = {
+            False: self._compile_lookup(self._key_lookup,
+                                        self.converter_capabilities),
+            True: self._compile_lookup(self._key_lookup,
+                                       self.freezer_capabilities)}
         self.reset()
 
     ### IFreezer ###
@@ -408,22 +497,23 @@ class Serializer(object):
             return data
         packer, value = data
         if isinstance(value, list):
-            value = [self.pack_value(d) for d in value]
+            pack_value = self.pack_value
+            value = [pack_value(d) for d in value]
         if packer is not None:
             return packer(value)
         return value
 
     def flatten_value(self, value, caps, freezing):
-        vtype = type(value)
-        default = Serializer.flatten_unknown_value
-        flattener = self._value_lookup.get(vtype, default)
-        return flattener(self, value, caps, freezing)
+        flattener = self._value_flatteners[freezing].get(type(value))
+        if flattener is None:
+            return self.flatten_unknown_value(value, caps, freezing)
+        return flattener(value, caps, freezing)
 
     def flatten_key(self, key, caps, freezing):
-        vtype = type(key)
-        default = Serializer.flatten_unknown_key
-        flattener = self._key_lookup.get(vtype, default)
-        return flattener(self, key, caps, freezing)
+        flattener = self._key_flatteners[freezing].get(type(key))
+        if flattener is None:
+            return self.flatten_unknown_key(key, caps, freezing)
+        return flattener(key, caps, freezing)
 
     def post_convertion(self, data):
         if self._post_converter is not None:
@@ -653,7 +743,8 @@ class Serializer(object):
         self.check_capabilities(Capabilities.instance_values, value,
                                 caps, freezing)
 
-        referenceable = getattr(value, "referenceable", True)
+        referenceable = (not self._acyclic
+                         and getattr(value, "referenceable", True))
 
         if referenceable:
             deref = self._prepare(value)
@@ -717,8 +808,110 @@ class Serializer(object):
                    bool: flatten_bool_key,
                    type(None): flatten_none_key}
 
+    # {FLATTENER: (CAPABILITY, PACKER_NAME, IS_CONTAINER)} used to compile
+    # flatteners bypassing the capability checks and, for acyclic
+    # serializers, the references handling.
+    _fast_flatteners = {
+        flatten_str_value: (Capabilities.str_values, "pack_str", False),
+        flatten_unicode_value: (Capabilities.unicode_values,
+                                "pack_unicode", False),
+        flatten_int_value: (Capabilities.int_values, "pack_int", False),
+        flatten_long_value: (Capabilities.long_values, "pack_long", False),
+        flatten_float_value: (Capabilities.float_values,
+                              "pack_float", False),
+        flatten_bool_value: (Capabilities.bool_values, "pack_bool", False),
+        flatten_none_value: (Capabilities.none_values, "pack_none", False),
+        flatten_tuple_value: (Capabilities.tuple_values, "pack_tuple", True),
+        flatten_list_value: (Capabilities.list_values, "pack_list", True),
+        flatten_set_value: (Capabilities.set_values, "pack_set", True),
+        flatten_str_key: (Capabilities.str_keys, "pack_str", False),
+        flatten_unicode_key: (Capabilities.unicode_keys,
+                              "pack_unicode", False),
+        flatten_int_key: (Capabilities.int_keys, "pack_int", False),
+        flatten_long_key: (Capabilities.long_keys, "pack_long", False),
+        flatten_float_key: (Capabilities.float_keys, "pack_float", False),
+        flatten_bool_key: (Capabilities.bool_keys, "pack_bool", False),
+        flatten_none_key: (Capabilities.none_keys, "pack_none", False),
+        flatten_tuple_key: (Capabilities.tuple_keys, "pack_tuple", True)}
+
     ### private ###
 
+    def _compile_lookup(self, lookup, caps):
+        """Builds the {TYPE: FLATTENER} table used by flatten_value()
+        and flatten_key() for the given capabilities. Capabilities are
+        checked once here instead of for every value, so the compiled
+        flatteners ignore the caps parameter they are called with."""
+        table = {}
+        for vtype, method in lookup.iteritems():
+            fast = self._fast_flatteners.get(method)
+            if (fast is None or fast[0] not in caps
+                or not hasattr(self, fast[1])):
+                # Not a simple value or not supported, the original method
+                # will take care of it and raise the proper error if needed
+                table[vtype] = method.__get__(self, type(self))
+                continue
+            _cap, packer_name, is_container = fast
+            packer = getattr(self, packer_name)
+            if not is_container:
+                table[vtype] = self._simple_flattener(packer)
+            elif self._acyclic:
+                table[vtype] = self._container_flattener(packer)
+            else:
+                table[vtype] = self._referenceable_flattener(packer)
+        if Capabilities.dict_values in caps and dict in lookup:
+            if self._acyclic:
+                table[dict] = self._flatten_acyclic_dict
+            else:
+                table[dict] = self._flatten_referenceable_dict
+        return table
+
+    def _simple_flattener(self, packer):
+
+        def flatten(value, caps, freezing):
+            return packer, value
+
+        def passthrough(value, caps, freezing):
+            return value
+
+        # pack_value() returns values that are not lists
+        # or tuples as-is, there is no need for a packing pair
+        return passthrough if packer is None else flatten
+
+    def _container_flattener(self, packer):
+        flatten_value = self.flatten_value
+
+        def flatten(value, caps, freezing):
+            return packer, [flatten_value(v, caps, freezing) for v in value]
+
+        return flatten
+
+    def _referenceable_flattener(self, packer):
+        flatten_value = self.flatten_value
+
+        def flatten(value, caps, freezing):
+            deref = self._prepare(value)
+            if deref is not None:
+                return deref
+            data = [flatten_value(v, caps, freezing) for v in value]
+            return self._preserve(value, packer, data)
+
+        return flatten
+
+    def _flatten_acyclic_dict(self, value, caps, freezing):
+        items = value.items()
+        if freezing:
+            items = sorted(items, key=operator.itemgetter(0))
+        flatten_item = self.flatten_item
+        return self.pack_dict, [flatten_item(i, caps, freezing)
+                                for i in items]
+
+    def _flatten_referenceable_dict(self, value, caps, freezing):
+        deref = self._prepare(value)
+        if deref is not None:
+            return deref
+        packer, data = self._flatten_acyclic_dict(value, caps, freezing)
+        return self._preserve(value, packer, data)
+
     def _convert(self, data, caps, freezing):
         try:
             # Flatten the value to the list-only format with packer function
@@ -848,12 +1041,23 @@ class Unserializer(object):
     def reset(self):
         self._references = {} # {REFERENCE_ID: (DATA_ID, OBJECT)}
         self._pending = [] # Pendings unpacking
-        self._instances = [] # [(RESTORATOR, INSTANCE, SNAPSHOT)]
+        self._instances = [] # [(RestorePlan, INSTANCE, SNAPSHOT, REFID)]
         self._delayed = 0 # If we are in a delayable unpacking
 
     def unpack_data(self, data):
         return self._unpack_data(data, None, None)
 
+    def unpack_item(self, data):
+        """Unpacks and restores one top-level item of a stream.
+        Contrary to convert() the references are kept between calls,
+        so an item can refer to values of the previous ones.
+        reset() must be called at the end of the stream."""
+        unpacked = self.unpack_data(data)
+        self.finish_unpacking()
+        # The instances are fully restored now, forget about them
+        self._instances = []
+        return unpacked
+
     def delayed_unpacking(self, container, fun, *args, **kwargs):
         """Should be used when unpacking mutable values.
         This allows circular references resolution by pausing serialization."""
@@ -878,9 +1082,8 @@ class Unserializer(object):
             fun(*args, **kwargs)
 
         # Initialize the instance in creation order
-        for restorator, instance, snapshot, _refid in self._instances:
-            snapshot = self._adapt_snapshot(restorator, snapshot)
-            instance.recover(snapshot)
+        for plan, instance, snapshot, _refid in self._instances:
+            instance.recover(plan.adapt(snapshot))
 
         # Calls the instances post restoration callback in reversed order
         # in an intent to reduce the possibilities of instances relying
@@ -910,31 +1113,30 @@ class Unserializer(object):
         return instance
 
     def prepare_instance(self, type_name):
-        restorator = self._lookup_restorator(type_name)
+        plan = self._lookup_plan(type_name)
         # Prepare the instance for recovery
-        instance = restorator.prepare()
+        instance = plan.prepare()
         if instance is not None:
-            return restorator, instance
+            return plan, instance
 
     def restore_instance(self, type_name, data, refid=None,
-                         restorator=None, instance=None):
-        if restorator is None:
-            restorator = self._lookup_restorator(type_name)
+                         plan=None, instance=None):
+        if plan is None:
+            plan = self._lookup_plan(type_name)
 
         if instance is None:
             # Prepare the instance for recovery
-            instance = restorator.prepare()
+            instance = plan.prepare()
 
         if instance is None:
             # Immutable type, we can't delay restoration
             snapshot = self.unpack_data(data)
-            snapshot = self._adapt_snapshot(restorator, snapshot)
-            return restorator.restore(snapshot)
+            return plan.restore(plan.adapt(snapshot))
 
         # Delay the instance restoration for later to handle circular refs
         return self.delayed_unpacking(instance,
                                       self._continue_restoring_instance,
-                                      restorator, instance, data, refid)
+                                      plan, instance, data, refid)
 
     def restore_reference(self, refid, data):
         if refid in self._references:
@@ -1082,13 +1284,14 @@ class Unserializer(object):
         blob.extend(self._instances)
         self._instances = blob
 
-    def _lookup_restorator(self, type_name):
-        # Lookup the registry for a IRestorator
-        restorator = self._registry.lookup(type_name)
-        if restorator is None:
+    def _lookup_plan(self, type_name):
+        # Lookup the registry for a cached RestorePlan
+        plan = self._registry.lookup_plan(type_name, self._source_ver,
+                                          self._target_ver)
+        if plan is None:
             raise TypeError("Type %s not supported by unserializer %s"
                             % (type_name, reflect.canonical_name(self)))
-        return restorator
+        return plan
 
     def _unpack_data(self, data, refid, refdata):
         # Just return pass-through types,
@@ -1122,34 +1325,24 @@ class Unserializer(object):
                     # Immutable instance
                     return unpacker(self, data, None, None, None)
 
-                restorator, instance = prepared
+                plan, instance = prepared
 
                 if refid is not None:
                     self._references[refid] = (id(refdata), instance)
                 return self.delayed_unpacking(instance, unpacker, self, data,
-                                              refid, restorator, instance)
+                                              refid, plan, instance)
 
         raise TypeError("Type %s not supported by unserializer %s"
                         % (type(data).__name__,
                            reflect.canonical_name(self)))
 
-    def _continue_restoring_instance(self, restorator, instance, data, refid):
+    def _continue_restoring_instance(self, plan, instance, data, refid):
         snapshot = self.unpack_data(data)
         # Delay instance initialization to the end to be sure
         # all snapshots circular references have been resolved
-        self._instances.append((restorator, instance, snapshot, refid))
+        self._instances.append((plan, instance, snapshot, refid))
         return instance
 
-    def _adapt_snapshot(self, restorator, snapshot):
-        if self._source_ver is not None:
-            #TODO: If external adapter is needed change this to a cast
-            if IVersionAdapter.providedBy(restorator):
-                adapter = IVersionAdapter(restorator)
-                snapshot = adapter.adapt_version(snapshot,
-                                                 self._source_ver,
-                                                 self._target_ver)
-        return snapshot
-
 
 ### private ###
 
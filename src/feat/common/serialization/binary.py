@@ -0,0 +1,413 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+"""Compact binary encoding of the s-expressions produced by
+L{sexp.Serializer}. Every message is self-contained:
+
+  MESSAGE := MAGIC VERSION VALUE
+  VALUE   := LIST VARINT(COUNT) VALUE* | SMALL_LIST + COUNT VALUE*
+           | STR VARINT(LENGTH) BYTES
+           | INTERN VARINT(LENGTH) BYTES
+           | INTERNED VARINT(INDEX) | SMALL_INTERNED + INDEX
+           | (POS_INT | NEG_INT) VARINT(ABSOLUTE_VALUE) | SMALL_INT + VALUE
+           | (POS_LONG | NEG_LONG) VARINT(ABSOLUTE_VALUE)
+           | FLOAT IEEE754_DOUBLE
+
+Short strings, like the atoms, type names and dictionary keys, are
+added to a table the first time they are encoded with INTERN and
+then referenced by their index in the table. Small integers, short
+lists and the first interned strings are encoded in a single byte."""
+
+from __future__ import absolute_import
+
+import struct
+
+from feat.common.serialization import sexp
+from feat.interface.serialization import *
+
+MAGIC = "\xfe"
+VERSION = 1
+
+# Strings longer than this are never interned
+INTERN_MAX_LENGTH = 64
+
+LIST = 0x01
+STR = 0x02
+INTERN = 0x03
+INTERNED = 0x04
+POS_INT = 0x05
+NEG_INT = 0x06
+POS_LONG = 0x07
+NEG_LONG = 0x08
+FLOAT = 0x09
+
+# Single byte codes with the value embedded
+SMALL_INT = 0x80 # 0x80 - 0xbf for 0 - 63
+SMALL_INT_MAX = 0x3f
+SMALL_LIST = 0xc0 # 0xc0 - 0xcf for 0 - 15 items
+SMALL_LIST_MAX = 0x0f
+SMALL_INTERNED = 0xd0 # 0xd0 - 0xff for indexes 0 - 47
+SMALL_INTERNED_MAX = 0x2f
+
+_HEADER = MAGIC + chr(VERSION)
+_FLOAT = struct.Struct("!d")
+_BYTES = [chr(i) for i in range(256)]
+
+
+class BinaryCodec(object):
+
+    def encode(self, data):
+        out = [_HEADER]
+        self._encode(data, out.append, {})
+        return "".join(out)
+
+    def decode(self, data):
+        if not isinstance(data, str):
+            raise TypeError("Invalid binary data type: %r" % (data, ))
+        if data[:2] != _HEADER:
+            raise ValueError("Invalid binary data header: %r" % (data[:2], ))
+        try:
+            value, pos = self._decode(data, 2, [])
+        except (IndexError, struct.error):
+            raise ValueError("Truncated binary data")
+        if pos != len(data):
+            raise ValueError("Unexpected data after binary value")
+        return value
+
+    ### private ###
+
+    def _encode(self, value, append, interned):
+        vtype = type(value)
+
+        if vtype is list:
+            count = len(value)
+            if count <= SMALL_LIST_MAX:
+                append(_BYTES[SMALL_LIST + count])
+            else:
+                append(_BYTES[LIST])
+                _encode_varint(count, append)
+            encode = self._encode
+            for item in value:
+                encode(item, append, interned)
+            return
+
+        if vtype is str:
+            index = interned.get(value)
+            if index is not None:
+                if index <= SMALL_INTERNED_MAX:
+                    append(_BYTES[SMALL_INTERNED + index])
+                else:
+                    append(_BYTES[INTERNED])
+                    _encode_varint(index, append)
+                return
+            length = len(value)
+            if length <= INTERN_MAX_LENGTH:
+                interned[value] = len(interned)
+                append(_BYTES[INTERN])
+            else:
+                append(_BYTES[STR])
+            _encode_varint(length, append)
+            append(value)
+            return
+
+        if vtype is int:
+            if 0 <= value <= SMALL_INT_MAX:
+                append(_BYTES[SMALL_INT + value])
+            elif value >= 0:
+                append(_BYTES[POS_INT])
+                _encode_varint(value, append)
+            else:
+                append(_BYTES[NEG_INT])
+                _encode_varint(-value, append)
+            return
+
+        if vtype is long:
+            if value >= 0:
+                append(_BYTES[POS_LONG])
+                _encode_varint(value, append)
+            else:
+                append(_BYTES[NEG_LONG])
+                _encode_varint(-value, append)
+            return
+
+        if vtype is float:
+            append(_BYTES[FLOAT])
+            append(_FLOAT.pack(value))
+            return
+
+        raise TypeError("Type %s not supported by binary codec"
+                        % (vtype.__name__, ))
+
+    def _decode(self, data, pos, interned):
+        code = ord(data[pos])
+        pos += 1
+
+        if code >= SMALL_INTERNED:
+            index = code - SMALL_INTERNED
+            if index >= len(interned):
+                raise ValueError("Unknown interned string: %d" % (index, ))
+            return interned[index], pos
+
+        if code >= SMALL_LIST or code == LIST:
+            if code == LIST:
+                count, pos = _decode_varint(data, pos)
+            else:
+                count = code - SMALL_LIST
+            result = []
+            append = result.append
+            decode = self._decode
+            for _ in xrange(count):
+                value, pos = decode(data, pos, interned)
+                append(value)
+            return result, pos
+
+        if code >= SMALL_INT:
+            return code - SMALL_INT, pos
+
+        if code == INTERN or code == STR:
+            length, pos = _decode_varint(data, pos)
+            end = pos + length
+            if end > len(data):
+                raise IndexError()
+            value = data[pos:end]
+            if code == INTERN:
+                interned.append(value)
+            return value, end
+
+        if code == INTERNED:
+            index, pos = _decode_varint(data, pos)
+            if index >= len(interned):
+                raise ValueError("Unknown interned string: %d" % (index, ))
+            return interned[index], pos
+
+        if code == POS_INT:
+            value, pos = _decode_varint(data, pos)
+            return int(value), pos
+
+        if code == NEG_INT:
+            value, pos = _decode_varint(data, pos)
+            return int(-value), pos
+
+        if code == POS_LONG:
+            value, pos = _decode_varint(data, pos)
+            return long(value), pos
+
+        if code == NEG_LONG:
+            value, pos = _decode_varint(data, pos)
+            return long(-value), pos
+
+        if code == FLOAT:
+            value, = _FLOAT.unpack_from(data, pos)
+            return value, pos + _FLOAT.size
+
+        raise ValueError("Invalid binary code: 0x%02x" % (code, ))
+
+
+class Serializer(sexp.Serializer, BinaryCodec):
+
+    def __init__(self, externalizer=None, source_ver=None, target_ver=None,
+                 acyclic=False):
+        sexp.Serializer.__init__(self, externalizer=externalizer,
+                                 source_ver=source_ver, target_ver=target_ver,
+                                 acyclic=acyclic)
+
+    ### Overridden Methods ###
+
+    def post_convertion(self, data):
+        return self.encode(data)
+
+
+class Unserializer(sexp.Unserializer, BinaryCodec):
+
+    def __init__(self, registry=None, externalizer=None,
+                 source_ver=None, target_ver=None):
+        sexp.Unserializer.__init__(self, registry=registry,
+                                   externalizer=externalizer,
+                                   source_ver=source_ver,
+                                   target_ver=target_ver)
+
+    ### Overridden Methods ###
+
+    def pre_convertion(self, data):
+        return self.decode(data)
+
+
+class StreamDecoder(BinaryCodec):
+    """Decodes a list encoded by L{BinaryCodec} from chunks of data,
+    giving back its items as soon as they are complete. An item not
+    complete yet is decoded again from its beginning for every new
+    chunk, so chunks should not be too small compared to the items."""
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._interned = []
+        self._remaining = None # Items left to decode, None before the header
+
+    def feed(self, chunk):
+        """Gives an iterator over the items completed by the chunk, every
+        item is only decoded when reached. It has to be exhausted before
+        feeding the next chunk."""
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+
+        if self._remaining is None and not self._decode_header():
+            return
+
+        while self._remaining > 0:
+            mark = len(self._interned)
+            try:
+                item, pos = self._decode(self._buffer, self._pos,
+                                         self._interned)
+            except (IndexError, struct.error):
+                # Not enough data, forget the strings interned meanwhile
+                del self._interned[mark:]
+                break
+            self._pos = pos
+            self._remaining -= 1
+            yield item
+
+        if self._remaining == 0 and self._pos < len(self._buffer):
+            raise ValueError("Unexpected data after binary value")
+
+    def close(self):
+        if self._remaining != 0:
+            raise ValueError("Truncated binary data")
+
+    ### private ###
+
+    def _decode_header(self):
+        data = self._buffer
+        if data[:2] != _HEADER[:len(data)]:
+            raise ValueError("Invalid binary data header: %r" % (data[:2], ))
+        if len(data) < 3:
+            return False
+        code = ord(data[2])
+        if code == LIST:
+            try:
+                count, pos = _decode_varint(data, 3)
+            except IndexError:
+                return False
+        elif SMALL_LIST <= code <= SMALL_LIST + SMALL_LIST_MAX:
+            count, pos = code - SMALL_LIST, 3
+        else:
+            raise ValueError("Only lists can be decoded from a stream")
+        self._remaining = count
+        self._pos = pos
+        return True
+
+
+class StreamUnserializer(object):
+    """Unserializes a list or a tuple serialized with L{Serializer}
+    from chunks of data, giving back the items as soon as they are
+    completely restored. References between items are preserved
+    as long as the stream is not closed."""
+
+    def __init__(self, registry=None, externalizer=None,
+                 source_ver=None, target_ver=None):
+        self._unserializer = Unserializer(registry=registry,
+                                          externalizer=externalizer,
+                                          source_ver=source_ver,
+                                          target_ver=target_ver)
+        self._decoder = StreamDecoder()
+        self._started = False
+
+    def feed(self, chunk):
+        """Gives an iterator over the items completed by the given chunk,
+        every item is decoded and restored only when reached, so only
+        one of them is kept in its decoded form at a time. It has to be
+        exhausted before feeding the next chunk."""
+        for item in self._decoder.feed(chunk):
+            if not self._started:
+                if item not in (sexp.LIST_ATOM, sexp.TUPLE_ATOM):
+                    raise ValueError("Only lists and tuples can be "
+                                     "unserialized from a stream")
+                self._started = True
+                continue
+            yield self._unserializer.unpack_item(item)
+
+    def close(self):
+        try:
+            self._decoder.close()
+        finally:
+            # Cleanup all references
+            self._unserializer.reset()
+
+
+def serialize(value):
+    global _serializer
+    return _serializer.convert(value)
+
+
+def freeze(value):
+    global _serializer
+    return _serializer.freeze(value)
+
+
+def unserialize(data):
+    global _unserializer
+    return _unserializer.convert(data)
+
+
+def unserialize_stream(chunks, registry=None, externalizer=None):
+    """Generator giving the items of a list or tuple serialized with
+    L{Serializer} while consuming the given iterator of chunks."""
+    stream = StreamUnserializer(registry=registry, externalizer=externalizer)
+    for chunk in chunks:
+        for item in stream.feed(chunk):
+            yield item
+    stream.close()
+
+
+def is_binary(data):
+    '''Tells if the given data looks like something encoded
+    with this module, to tell it apart from other formats.'''
+    return isinstance(data, str) and data[:1] == MAGIC
+
+
+### Private Stuff ###
+
+
+def _encode_varint(value, append):
+    while value > 0x7f:
+        append(_BYTES[(value & 0x7f) | 0x80])
+        value >>= 7
+    append(_BYTES[value])
+
+
+def _decode_varint(data, pos):
+    byte = ord(data[pos])
+    pos += 1
+    if byte < 0x80:
+        return byte, pos
+    value = byte & 0x7f
+    shift = 7
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+_serializer = Serializer()
+_unserializer = Unserializer()
@@ -77,12 +77,13 @@ class Serializer(base.Serializer):
     pack_dict = dict
 
     def __init__(self, indent=None, separators=None, externalizer=None,
-                 source_ver=None, target_ver=None):
+                 source_ver=None, target_ver=None, acyclic=False):
         base.Serializer.__init__(self, converter_caps=JSON_CONVERTER_CAPS,
                                  freezer_caps=JSON_FREEZER_CAPS,
                                  externalizer=externalizer,
                                  source_ver=source_ver,
-                                 target_ver=target_ver)
+                                 target_ver=target_ver,
+                                 acyclic=acyclic)
         self._indent = indent
         self._separators = separators
 
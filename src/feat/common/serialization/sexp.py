@@ -49,11 +49,12 @@ class Serializer(base.Serializer):
     with twisted.spread.jelly.'''
 
     def __init__(self, post_converter=None, externalizer=None,
-                 source_ver=None, target_ver=None):
+                 source_ver=None, target_ver=None, acyclic=False):
         base.Serializer.__init__(self, post_converter=post_converter,
                                  externalizer=externalizer,
                                  source_ver=source_ver,
-                                 target_ver=target_ver)
+                                 target_ver=target_ver,
+                                 acyclic=acyclic)
 
     def pack_unicode(self, value):
         return [UNICODE_ATOM, value.encode(UNICODE_FORMAT_ATOM)]
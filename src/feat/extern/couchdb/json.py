@@ -16,9 +16,11 @@ This module currently supports the following JSON modules:
    Python standard library since version 2.6
    (see http://docs.python.org/library/json.html)
 
-The default behavior is to use ``simplejson`` if installed, and otherwise
-fallback to the standard library module. To explicitly tell CouchDB-Python
-which module to use, invoke the `use()` function with the module name::
+The default behavior is to use the standard library module if its C
+accelerations are available, then ``simplejson`` if installed, and otherwise
+fallback to the pure python standard library module. To explicitly tell
+CouchDB-Python which module to use, invoke the `use()` function with the
+module name::
 
     from couchdb import json
     json.use('cjson')
@@ -105,12 +107,15 @@ def use(module=None, decode=None, encode=None):
 def _initialize():
     global _initialized
 
+    # The encoders are created once, dumps() would instantiate a new one
+    # on every call because of the non default arguments.
+
     def _init_simplejson():
         global _decode, _encode
         import simplejson
-        _decode = lambda string, loads=simplejson.loads: loads(string)
-        _encode = lambda obj, dumps=simplejson.dumps: \
-            dumps(obj, allow_nan=False, ensure_ascii=False)
+        _decode = simplejson.JSONDecoder().decode
+        _encode = simplejson.JSONEncoder(allow_nan=False,
+                                         ensure_ascii=False).encode
 
     def _init_cjson():
         global _decode, _encode
@@ -121,9 +126,9 @@ def _initialize():
     def _init_stdlib():
         global _decode, _encode
         json = __import__('json', {}, {})
-        _decode = lambda string, loads=json.loads: loads(string)
-        _encode = lambda obj, dumps=json.dumps: \
-            dumps(obj, allow_nan=False, ensure_ascii=False)
+        _decode = json.JSONDecoder().decode
+        _encode = json.JSONEncoder(allow_nan=False,
+                                   ensure_ascii=False).encode
 
     if _using == 'simplejson':
         _init_simplejson()
@@ -132,8 +137,20 @@ def _initialize():
     elif _using == 'json':
         _init_stdlib()
     elif _using != 'custom':
-        try:
-            _init_simplejson()
-        except ImportError:
+        if _stdlib_accelerated():
             _init_stdlib()
+        else:
+            try:
+                _init_simplejson()
+            except ImportError:
+                _init_stdlib()
     _initialized = True
+
+
+def _stdlib_accelerated():
+    try:
+        json = __import__('json', {}, {}, ['decoder', 'encoder'])
+    except ImportError:
+        return False
+    return (json.decoder.c_scanstring is not None
+            and json.encoder.c_make_encoder is not None)
@@ -31,13 +31,15 @@ def run(input=sys.stdin, output=sys.stdout):
     :param output: the writable file-like object to write output to
     """
     functions = []
+    # source -> compiled function, kept across resets because CouchDB
+    # sends the same functions over and over again
+    compiled = {}
 
     def _writejson(obj):
         obj = json.encode(obj)
         if isinstance(obj, unicode):
             obj = obj.encode('utf-8')
-        output.write(obj)
-        output.write('\n')
+        output.write(obj + '\n')
         output.flush()
 
     def _log(message):
@@ -45,30 +47,41 @@ def run(input=sys.stdin, output=sys.stdout):
             message = json.encode(message)
         _writejson({'log': message})
 
-    def reset(config=None):
-        del functions[:]
-        return True
-
-    def add_fun(string):
-        string = BOM_UTF8 + string.encode('utf-8')
+    def _compile(source, error_id, example):
+        function = compiled.get(source)
+        if function is not None:
+            return function
+        string = BOM_UTF8 + source.encode('utf-8')
         globals_ = {}
         try:
             exec string in {'log': _log}, globals_
         except Exception, e:
             return {'error': {
-                'id': 'map_compilation_error',
+                'id': error_id,
                 'reason': e.args[0]
             }}
         err = {'error': {
-            'id': 'map_compilation_error',
+            'id': error_id,
             'reason': 'string must eval to a function '
-                      '(ex: "def(doc): return 1")'
+                      '(ex: "%s")' % example
         }}
         if len(globals_) != 1:
             return err
         function = globals_.values()[0]
         if type(function) is not FunctionType:
             return err
+        compiled[source] = function
+        return function
+
+    def reset(config=None):
+        del functions[:]
+        return True
+
+    def add_fun(string):
+        function = _compile(string, 'map_compilation_error',
+                            'def(doc): return 1')
+        if type(function) is not FunctionType:
+            return function
         functions.append(function)
         return True
 
@@ -84,29 +97,20 @@ def run(input=sys.stdin, output=sys.stdout):
                 _log(traceback.format_exc())
         return results
 
+    def map_docs(docs):
+        return [map_doc(doc) for doc in docs]
+
     def reduce(*cmd, **kwargs):
-        code = BOM_UTF8 + cmd[0][0].encode('utf-8')
+        reducers = []
+        for source in cmd[0]:
+            function = _compile(source, 'reduce_compilation_error',
+                                'def(keys, values): return 1')
+            if type(function) is not FunctionType:
+                log.error('compilation error in reduce function: %s',
+                          function['error']['reason'])
+                return function
+            reducers.append(function)
         args = cmd[1]
-        globals_ = {}
-        try:
-            exec code in {'log': _log}, globals_
-        except Exception, e:
-            log.error('runtime error in reduce function: %s', e,
-                      exc_info=True)
-            return {'error': {
-                'id': 'reduce_compilation_error',
-                'reason': e.args[0]
-            }}
-        err = {'error': {
-            'id': 'reduce_compilation_error',
-            'reason': 'string must eval to a function '
-                      '(ex: "def(keys, values): return 1")'
-        }}
-        if len(globals_) != 1:
-            return err
-        function = globals_.values()[0]
-        if type(function) is not FunctionType:
-            return err
 
         rereduce = kwargs.get('rereduce', False)
         results = []
@@ -119,18 +123,19 @@ def run(input=sys.stdin, output=sys.stdout):
             else:
                 keys = []
                 vals = []
-        if function.func_code.co_argcount == 3:
-            results = function(keys, vals, rereduce)
-        else:
-            results = function(keys, vals)
-        return [True, [results]]
+        for function in reducers:
+            if function.func_code.co_argcount == 3:
+                results.append(function(keys, vals, rereduce))
+            else:
+                results.append(function(keys, vals))
+        return [True, results]
 
     def rereduce(*cmd):
         # Note: weird kwargs is for Python 2.5 compat
         return reduce(*cmd, **{'rereduce': True})
 
     handlers = {'reset': reset, 'add_fun': add_fun, 'map_doc': map_doc,
-                'reduce': reduce, 'rereduce': rereduce}
+                'map_docs': map_docs, 'reduce': reduce, 'rereduce': rereduce}
 
     try:
         while True:
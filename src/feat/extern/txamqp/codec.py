@@ -27,6 +27,11 @@ fields.
 from cStringIO import StringIO
 from struct import *
 
+OCTET = Struct("!B")
+SHORT = Struct("!H")
+LONG = Struct("!L")
+LONGLONG = Struct("!Q")
+
 class EOF(Exception):
   pass
 
@@ -80,10 +85,10 @@ class Codec:
       return values
 
   def encode(self, type, value):
-    getattr(self, "encode_" + type)(value)
+    self.ENCODERS[type](self, value)
 
   def decode(self, type):
-    return getattr(self, "decode_" + type)()
+    return self.DECODERS[type](self)
 
   # bit
   def encode_bit(self, o):
@@ -101,31 +106,31 @@ class Codec:
 
   # octet
   def encode_octet(self, o):
-    self.pack("!B", o)
+    self.write(OCTET.pack(o))
 
   def decode_octet(self):
-    return self.unpack("!B")
+    return OCTET.unpack(self.read(OCTET.size))[0]
 
   # short
   def encode_short(self, o):
-    self.pack("!H", o)
+    self.write(SHORT.pack(o))
 
   def decode_short(self):
-    return self.unpack("!H")
+    return SHORT.unpack(self.read(SHORT.size))[0]
 
   # long
   def encode_long(self, o):
-    self.pack("!L", o)
+    self.write(LONG.pack(o))
 
   def decode_long(self):
-    return self.unpack("!L")
+    return LONG.unpack(self.read(LONG.size))[0]
 
   # longlong
   def encode_longlong(self, o):
-    self.pack("!Q", o)
+    self.write(LONGLONG.pack(o))
 
   def decode_longlong(self):
-    return self.unpack("!Q")
+    return LONGLONG.unpack(self.read(LONGLONG.size))[0]
 
   def enc_str(self, fmt, s):
     size = len(s)
@@ -185,6 +190,195 @@ class Codec:
       result[key] = value
     return result
 
+Codec.ENCODERS = dict((name[len("encode_"):], value)
+                      for name, value in Codec.__dict__.items()
+                      if name.startswith("encode_"))
+Codec.DECODERS = dict((name[len("decode_"):], value)
+                      for name, value in Codec.__dict__.items()
+                      if name.startswith("decode_"))
+
+# Fixed size types packed with struct by the compiled codecs
+FIXED = {"octet": "B", "short": "H", "long": "L", "longlong": "Q",
+         "timestamp": "Q"}
+
+def compile_codec(types, head=()):
+  """
+  Generates the functions encoding and decoding a sequence of fields
+  of the given types. Consecutive fixed size fields and bits are packed
+  and unpacked with a single precompiled struct. The encoder takes a
+  sequence of values and returns the encoded string, it is prefixed
+  with the (type, value) pairs given as head. The decoder takes
+  a string and an offset, where the head has already been skipped,
+  and returns the tuple of values. Returns None if the types are not
+  all supported.
+  """
+  for type in types:
+    if type not in FIXED and type not in ("bit", "shortstr", "longstr",
+                                          "table"):
+      return None
+  encoder = _compile_encoder(types, head)
+  decoder = _compile_decoder(types)
+  return encoder, decoder
+
+def _compile_encoder(types, head):
+  g = {"_str": _str, "_longstr": _encode_longstr, "_table": _encode_table}
+  names = ["a%d" % i for i in range(len(types))]
+  parts = []
+  group = [[], []] # [formats, expressions]
+  bits = []
+
+  def flush_bits():
+    # AMQP packs consecutive bits in octets, lowest bit first
+    for i in range(0, len(bits), 8):
+      group[0].append("B")
+      group[1].append(" | ".join("(%s and %d or 0)" % (name, 1 << index)
+                                 for index, name in
+                                 enumerate(bits[i:i + 8])))
+    del bits[:]
+
+  def flush_group():
+    flush_bits()
+    if group[0]:
+      struct_name = "_s%d" % len(g)
+      g[struct_name] = Struct("!" + "".join(group[0]))
+      parts.append("%s.pack(%s)" % (struct_name, ", ".join(group[1])))
+    group[0], group[1] = [], []
+
+  for type, value in head:
+    group[0].append(FIXED[type])
+    group[1].append(repr(value))
+  for type, name in zip(types, names):
+    if type == "bit":
+      bits.append(name)
+      continue
+    flush_bits()
+    if type in FIXED:
+      group[0].append(FIXED[type])
+      group[1].append(name)
+    elif type == "shortstr":
+      group[0].append("B")
+      group[1].append("len(%s)" % name)
+      flush_group()
+      parts.append(name)
+    else:
+      flush_group()
+      parts.append("_%s(%s)" % (type, name))
+  flush_group()
+
+  code = "def encode(args):\n"
+  if names:
+    code += "  %s, = args\n" % ", ".join(names)
+  for type, name in zip(types, names):
+    if type == "shortstr":
+      code += "  %s = _str(%s)\n" % (name, name)
+  if parts:
+    code += "  return \"\".join((%s, ))\n" % ", ".join(parts)
+  else:
+    code += "  return \"\"\n"
+  l = {}
+  exec code in g, l
+  return l["encode"]
+
+def _compile_decoder(types):
+  g = {"_table": _decode_table}
+  names = ["a%d" % i for i in range(len(types))]
+  code = ["def decode(data, offset):"]
+  group = [[], []] # [formats, targets]
+  bits = []
+
+  def flush_group():
+    if group[0]:
+      struct_name = "_s%d" % len(g)
+      g[struct_name] = Struct("!" + "".join(group[0]))
+      code.append("  %s, = %s.unpack_from(data, offset)"
+                  % (", ".join(group[1]), struct_name))
+      code.append("  offset += %d" % g[struct_name].size)
+    group[0], group[1] = [], []
+    for target, bit_names in bits:
+      for index, name in enumerate(bit_names):
+        code.append("  %s = %s & %d != 0" % (name, target, 1 << index))
+    del bits[:]
+
+  previous = None
+  for type, name in zip(types, names):
+    if type == "bit":
+      if previous != "bit" or len(bits[-1][1]) == 8:
+        target = "_b%d_%d" % (len(code), len(bits))
+        group[0].append("B")
+        group[1].append(target)
+        bits.append((target, []))
+      bits[-1][1].append(name)
+    elif type in FIXED:
+      group[0].append(FIXED[type])
+      group[1].append(name)
+    elif type == "table":
+      flush_group()
+      code.append("  %s, offset = _table(data, offset)" % name)
+    else:
+      size = "_l%d" % len(code)
+      group[0].append(type == "shortstr" and "B" or "L")
+      group[1].append(size)
+      flush_group()
+      code.append("  %s = data[offset:offset + %s]" % (name, size))
+      code.append("  offset += %s" % size)
+    previous = type
+  flush_group()
+  code.append("  return (%s)" % "".join(name + ", " for name in names))
+  l = {}
+  exec "\n".join(code) + "\n" in g, l
+  return l["decode"]
+
+def _str(s):
+  # unicode strings are written the same way as by StringIO
+  if isinstance(s, unicode):
+    return s.encode("ascii")
+  return s
+
+def _encode_longstr(s):
+  if isinstance(s, dict):
+    return _encode_table(s)
+  s = _str(s)
+  return LONG.pack(len(s)) + s
+
+def _encode_table(tbl):
+  parts = []
+  for key, value in tbl.items():
+    key = _str(key)
+    parts.append(OCTET.pack(len(key)))
+    parts.append(key)
+    if isinstance(value, basestring):
+      value = _str(value)
+      parts.append("S")
+      parts.append(LONG.pack(len(value)))
+      parts.append(value)
+    else:
+      parts.append("I")
+      parts.append(LONG.pack(value))
+  s = "".join(parts)
+  return LONG.pack(len(s)) + s
+
+def _decode_table(data, offset):
+  size, = LONG.unpack_from(data, offset)
+  offset += 4
+  end = offset + size
+  result = {}
+  while offset < end:
+    length = ord(data[offset])
+    key = data[offset + 1:offset + 1 + length]
+    type = data[offset + 1 + length]
+    offset += length + 2
+    if type == "S":
+      length, = LONG.unpack_from(data, offset)
+      value = data[offset + 4:offset + 4 + length]
+      offset += length + 4
+    elif type == "I":
+      value, = LONG.unpack_from(data, offset)
+      offset += 4
+    else:
+      raise ValueError(repr(type))
+    result[key] = value
+  return result, offset
+
 def test(type, value):
   if isinstance(value, (list, tuple)):
     values = value
@@ -21,6 +21,9 @@ import codec
 from cStringIO import StringIO
 from spec import load, pythonize
 from codec import EOF
+from struct import Struct
+
+METHOD_ID = Struct("!HH")
 
 class Frame:
 
@@ -62,6 +65,14 @@ class Payload:
 
   def decode(spec, dec): abstract
 
+  @classmethod
+  def unpack(cls, spec, data, start, end):
+    """
+    Decodes the payload found between start and end of the data,
+    just after its 4 bytes size.
+    """
+    return cls.decode(spec, codec.Codec(StringIO(data[start - 4:end])))
+
 class Method(Payload):
 
   type = Frame.METHOD
@@ -77,6 +88,10 @@ class Method(Payload):
     self.args = args
 
   def encode(self, enc):
+    compiled = self.method.get_codec()
+    if compiled is not None:
+      enc.encode_longstr(compiled[0](self.args))
+      return
     buf = StringIO()
     c = codec.Codec(buf)
     c.encode_short(self.method.klass.id)
@@ -94,6 +109,15 @@ class Method(Payload):
     args = tuple([c.decode(f.type) for f in meth.fields])
     return Method(meth, *args)
 
+  @classmethod
+  def unpack(cls, spec, data, start, end):
+    klass_id, method_id = METHOD_ID.unpack_from(data, start)
+    meth = spec.classes.byid[klass_id].methods.byid[method_id]
+    compiled = meth.get_codec()
+    if compiled is None:
+      return super(Method, cls).unpack(spec, data, start, end)
+    return Method(meth, *compiled[1](data, start + METHOD_ID.size))
+
   def __str__(self):
     return "%s %s" % (self.method, ", ".join([str(a) for a in self.args]))
 
@@ -194,6 +218,10 @@ class Body(Payload):
   def decode(spec, dec):
     return Body(dec.decode_longstr())
 
+  @classmethod
+  def unpack(cls, spec, data, start, end):
+    return Body(data[start:end])
+
   def __str__(self):
     return "Body(%r)" % self.content
 
@@ -123,16 +123,29 @@ class AMQChannel(object):
         if size > 0:
             queue.put(Frame(self.id, Body(content.body)))
 
+FRAME_HEADER = struct.Struct("!BHI")
+
+
 class FrameReceiver(protocol.Protocol, basic._PauseableMixin):
 
     frame_mode = False
     MAX_LENGTH = 4096
     HEADER_LENGTH = 1 + 2 + 4 + 1
+
+    # The received data not parsed yet is __buffer[__offset:] followed
+    # by the __chunks, __size bytes in total. The chunks are only
+    # joined when they contain the rest of the next frame, so a frame
+    # received in many chunks is copied once, and the frames are
+    # parsed at their offset in the buffer without slicing it.
     __buffer = ''
+    __offset = 0
+    __size = 0
 
     def __init__(self, spec):
         self.spec = spec
         self.FRAME_END = self.spec.constants.bypyname["frame_end"].id
+        self.__chunks = []
+        self.__frameTypes = {}
 
     # packs a frame and writes it to the underlying transport
     def sendFrame(self, frame):
@@ -151,15 +164,20 @@ class FrameReceiver(protocol.Protocol, basic._PauseableMixin):
         return data
 
     # unpacks a frame, see qpid.connection.Connection#read
-    def _unpackFrame(self, data):
-        s = StringIO(data)
-        c = Codec(s)
-        frameType = spec.pythonize(self.spec.constants.byid[c.decode_octet()].name)
-        channel = c.decode_short()
-        payload = Frame.DECODERS[frameType].decode(self.spec, c)
-        end = c.decode_octet()
-        if end != self.FRAME_END:
-            raise GarbageException('frame error: expected %r, got %r' % (self.FRAME_END, end))
+    def _unpackFrame(self, data, offset=0):
+        typeId, channel, size = FRAME_HEADER.unpack_from(data, offset)
+        frameType = self.__frameTypes.get(typeId)
+        if frameType is None:
+            frameType = spec.pythonize(self.spec.constants.byid[typeId].name)
+            self.__frameTypes[typeId] = frameType
+        start = offset + FRAME_HEADER.size
+        end = start + size
+        payload = Frame.DECODERS[frameType].unpack(self.spec, data, start, end)
+        if end >= len(data):
+            raise EOF()
+        frameEnd = ord(data[end])
+        if frameEnd != self.FRAME_END:
+            raise GarbageException('frame error: expected %r, got %r' % (self.FRAME_END, frameEnd))
         frame = Frame(channel, payload)
         return frame
 
@@ -172,32 +190,55 @@ class FrameReceiver(protocol.Protocol, basic._PauseableMixin):
             return self.dataReceived(extra)
 
     def dataReceived(self, data):
-        self.__buffer = self.__buffer + data
+        self.__chunks.append(data)
+        self.__size += len(data)
         while self.frame_mode and not self.paused:
-            sz = len(self.__buffer) - self.HEADER_LENGTH
-            if sz >= 0:
-                length, = struct.unpack("!I", self.__buffer[3:7]) # size = 4 bytes
-                if sz >= length:
-                    packet = self.__buffer[:self.HEADER_LENGTH + length]
-                    self.__buffer = self.__buffer[self.HEADER_LENGTH + length:]
-                    frame = self._unpackFrame(packet)
+            if self.__size >= self.HEADER_LENGTH:
+                self.__fill(self.HEADER_LENGTH)
+                _, _, length = FRAME_HEADER.unpack_from(self.__buffer,
+                                                        self.__offset)
+                size = self.HEADER_LENGTH + length
+                if self.__size >= size:
+                    self.__fill(size)
+                    buffer, offset = self.__buffer, self.__offset
+                    self.__offset += size
+                    self.__size -= size
+                    if self.__offset == len(buffer):
+                        self.__buffer, self.__offset = '', 0
+                    frame = self._unpackFrame(buffer, offset)
 
                     why = self.frameReceived(frame)
                     if why or self.transport and self.transport.disconnecting:
                         return why
                     else:
                         continue
-            if len(self.__buffer) > self.MAX_LENGTH:
-                frame, self.__buffer = self.__buffer, ''
-                return self.frameLengthExceeded(frame)
+            if self.__size > self.MAX_LENGTH:
+                return self.frameLengthExceeded(self.__take())
             break
         else:
             if not self.paused:
-                data = self.__buffer
-                self.__buffer = ''
+                data = self.__take()
                 if data:
                     return self.rawDataReceived(data)
 
+    def __fill(self, size):
+        # makes sure that the buffer contains at least size bytes
+        # after the offset
+        if len(self.__buffer) - self.__offset < size:
+            self.__chunks.insert(0, self.__buffer[self.__offset:])
+            self.__buffer = ''.join(self.__chunks)
+            self.__offset = 0
+            del self.__chunks[:]
+
+    def __take(self):
+        # gives all the data not parsed yet
+        self.__fill(self.__size)
+        data = self.__buffer[self.__offset:]
+        self.__buffer = ''
+        self.__offset = 0
+        self.__size = 0
+        return data
+
     def sendInitString(self):
         initString = "!4s4B"
         s = StringIO()
@@ -31,7 +31,7 @@ situations.
 
 import re, textwrap, new
 
-from feat.extern.txamqp import xmlutil
+from feat.extern.txamqp import xmlutil, codec
 
 class SpecContainer:
 
@@ -173,6 +173,20 @@ class Method(Metadata):
     self.description = description
     self.docs = docs
     self.response = False
+    self._codec = None
+
+  def get_codec(self):
+    """
+    Returns the (encoder, decoder) functions generated for the method
+    arguments, the encoded string starts with the class and method ids.
+    Returns None if some of the fields are not supported by
+    codec.compile_codec().
+    """
+    if self._codec is None:
+      head = (("short", self.klass.id), ("short", self.id))
+      self._codec = codec.compile_codec([f.type for f in self.fields],
+                                        head) or False
+    return self._codec or None
 
   def docstring(self):
     s = "\n\n".join([fill(d, 2) for d in [self.description] + self.docs])
@@ -73,6 +73,13 @@ class IRegistry(Interface):
         '''Gives a L{IRestorer} for specified type name
         or None if not found.'''
 
+    def lookup_plan(type_name, source_ver=None, target_ver=None):
+        '''Gives an object with the prepare() and restore() methods
+        of the L{IRestorer} for specified type name and an adapt(snapshot)
+        method adapting snapshots from source_ver to target_ver.
+        It is cached until a new L{IRestorer} is registered.
+        Returns None if not found.'''
+
 
 class IExternalizer(Interface):
     '''Used with converters to substitute instances by references
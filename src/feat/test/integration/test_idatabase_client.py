@@ -251,6 +251,48 @@ class TestCase(object):
         rev3 = doc.rev
         self.assertNotEqual(rev3, rev2)
 
+    @defer.inlineCallbacks
+    def testBulkDocuments(self):
+        conflicting = DummyDocument(doc_id=u'conflicting', field=u'old')
+        yield self.connection.save_document(conflicting)
+        conflicting.rev = None
+
+        docs = [DummyDocument(field=u'first'), conflicting,
+                DummyDocument(doc_id='second', field=u'second')]
+        result = yield self.connection.save_documents(docs)
+        self.assertEqual(3, len(result))
+        self.assertIdentical(docs[0], result[0])
+        self.assertTrue(isinstance(result[1], ConflictError))
+        self.assertIdentical(docs[2], result[2])
+        self.assertTrue(docs[0].doc_id is not None)
+        self.assertTrue(docs[0].rev is not None)
+
+        ids = [docs[0].doc_id, u'unknown', u'second']
+        fetched = yield self.connection.get_documents(ids)
+        self.assertEqual(3, len(fetched))
+        self.assertEqual(u'first', fetched[0].field)
+        self.assertEqual(docs[0].rev, fetched[0].rev)
+        self.assertTrue(isinstance(fetched[1], NotFoundError))
+        self.assertEqual(u'second', fetched[2].field)
+
+        # documents failing to save are left untouched
+        stale = DummyDocument(doc_id='conflicting', field=u'stale')
+        result = yield self.connection.save_documents([stale])
+        self.assertTrue(isinstance(result[0], ConflictError))
+        self.assertTrue(isinstance(stale.doc_id, str))
+
+        rev = docs[2].rev
+        result = yield self.connection.delete_documents([docs[0], docs[2]])
+        self.assertEqual([docs[0], docs[2]], result)
+        self.assertNotEqual(rev, docs[2].rev)
+
+        result = yield self.connection.delete_documents([docs[0]])
+        self.assertTrue(isinstance(result[0], NotFoundError))
+
+        fetched = yield self.connection.get_documents(ids)
+        self.assertTrue(isinstance(fetched[0], NotFoundError))
+        self.assertTrue(isinstance(fetched[2], NotFoundError))
+
     @defer.inlineCallbacks
     def testOtherSession(self):
         self.changes = list()
@@ -360,6 +402,76 @@ class EmuDatabaseIntegrationTest(common.IntegrationTest, TestCase):
         self.connection = self.database.get_connection()
 
 
+@common.attr(timescale=0.05)
+class CachedEmuDatabaseIntegrationTest(EmuDatabaseIntegrationTest):
+
+    def setUp(self):
+        common.IntegrationTest.setUp(self)
+        self.database = emu_database.Database(cache_size=2)
+        self.connection = self.database.get_connection()
+
+    def get_stat(self, name):
+        return dict(self.database.document_cache.get_stats()).get(name, 0)
+
+    @defer.inlineCallbacks
+    def testCachedDocuments(self):
+        docs = [DummyDocument(field=u'doc%d' % i) for i in range(3)]
+        yield self.connection.save_documents(docs)
+
+        fetched = yield self.connection.get_document(docs[0].doc_id)
+        self.assertEqual(1, self.get_stat('misses'))
+        fetched.field = u'changed locally'
+        fetched = yield self.connection.get_document(docs[0].doc_id)
+        self.assertEqual(1, self.get_stat('hits'))
+        self.assertEqual(u'doc0', fetched.field)
+        self.assertEqual(docs[0].rev, fetched.rev)
+
+        # changes made by other agencies invalidate the cache
+        other_connection = self.database.get_connection()
+        fetched.field = u'changed'
+        yield self.database.save_doc(
+            other_connection.serializer.convert(fetched))
+        self.assertEqual(1, self.get_stat('invalidations'))
+        fetched = yield self.connection.get_document(docs[0].doc_id)
+        self.assertEqual(u'changed', fetched.field)
+        self.assertEqual(2, self.get_stat('misses'))
+
+        # least recently used documents are evicted
+        yield self.connection.get_document(docs[1].doc_id)
+        yield self.connection.get_document(docs[2].doc_id)
+        yield self.connection.reload_document(docs[2])
+        self.assertEqual(2, self.get_stat('hits'))
+        yield self.connection.get_document(docs[0].doc_id)
+        self.assertEqual(5, self.get_stat('misses'))
+
+        yield other_connection.delete_document(fetched)
+        d = self.connection.get_document(docs[0].doc_id)
+        self.assertFailure(d, NotFoundError)
+        yield d
+
+    @defer.inlineCallbacks
+    def testNotificationWhileFetching(self):
+        doc = DummyDocument(field=u'old')
+        yield self.connection.save_document(doc)
+        rev = doc.rev
+        open_doc = self.database.open_doc
+
+        def racing_open_doc(doc_id):
+            d = open_doc(doc_id)
+            # the document is updated before the response is processed
+            self.database._trigger_change(doc_id, u'%d-new' % (
+                int(rev.split('-')[0]) + 1, ))
+            return d
+
+        self.database.open_doc = racing_open_doc
+        fetched = yield self.connection.get_document(doc.doc_id)
+        self.assertEqual(rev, fetched.rev)
+        self.database.open_doc = open_doc
+        yield self.connection.get_document(doc.doc_id)
+        self.assertEqual(0, self.get_stat('hits'))
+        self.assertEqual(2, self.get_stat('misses'))
+
+
 @attr('slow')
 class PaisleyIntegrationTest(common.IntegrationTest, TestCase,
                              PaisleySpecific):
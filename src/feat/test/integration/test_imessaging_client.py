@@ -283,6 +283,8 @@ class RabbitIntegrationTest(common.IntegrationTest, TestCase,
 
     configurable_attributes = ['number_of_agents']
 
+    messaging_options = {}
+
     @defer.inlineCallbacks
     def setUp(self):
         if messaging is None:
@@ -297,10 +299,21 @@ class RabbitIntegrationTest(common.IntegrationTest, TestCase,
         yield self.process.restart()
 
         self.messaging = messaging.Messaging(
-            '127.0.0.1', self.process.get_config()['port'])
+            '127.0.0.1', self.process.get_config()['port'],
+            **self.messaging_options)
         yield self.init_agents()
         self.log('Setup finished, starting the testcase.')
 
     def tearDown(self):
         self.messaging.disconnect()
         return self.process.terminate()
+
+
+class RabbitBatchedCommitsIntegrationTest(RabbitIntegrationTest):
+
+    messaging_options = dict(commit_interval=0.01, commit_size=5)
+
+
+class RabbitPrefetchIntegrationTest(RabbitIntegrationTest):
+
+    messaging_options = dict(prefetch_count=10)
@@ -161,6 +161,42 @@ class TestAgencyAgent(common.TestCase, common.AgencyTestHelper):
         yield self.agent.update_descriptor(update_fun)
         self.assertEqual('changed', self.agent._descriptor.shard)
 
+    @defer.inlineCallbacks
+    def testCoalescedUpdates(self):
+        saved = []
+        save_document = self.agent.save_document
+
+        def save_counter(doc):
+            saved.append(doc)
+            d = save_document(doc)
+            d.addCallback(common.delay, 0.01)
+            return d
+
+        self.agent.save_document = save_counter
+
+        def append_key(desc, key):
+            desc.partners.append(key)
+            return key
+
+        def failing_update(desc):
+            desc.partners.append('invalid')
+            raise ValueError('Failing update')
+
+        ds = [self.agent.update_descriptor(append_key, 'first')]
+        # these ones are queued while the first update is being saved
+        ds.append(self.agent.update_descriptor(append_key, 'second'))
+        ds.append(self.agent.update_descriptor(failing_update))
+        ds.append(self.agent.update_descriptor(append_key, 'third'))
+
+        self.assertEqual('first', (yield ds[0]))
+        self.assertEqual('second', (yield ds[1]))
+        yield self.assertFailure(ds[2], ValueError)
+        self.assertEqual('third', (yield ds[3]))
+
+        self.assertEqual(2, len(saved))
+        self.assertEqual(['first', 'second', 'third'],
+                         self.agent.get_descriptor().partners)
+
     def testRegisterTwice(self):
         self.assertTrue(self.agent.register_interest(DummyReplier))
         self.failIf(self.agent.register_interest(DummyReplier))
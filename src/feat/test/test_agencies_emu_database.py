@@ -25,6 +25,7 @@ from twisted.internet import defer
 
 from feat.agencies.emu import database
 from feat.agencies.interface import ConflictError, NotFoundError
+from feat.agents.base import view
 
 from . import common
 
@@ -121,6 +122,94 @@ class TestDatabase(common.TestCase):
         return dict(text=text)
 
 
+class ItemView(view.BaseView):
+
+    name = 'items'
+    use_reduce = True
+
+    def map(doc):
+        if 'group' in doc:
+            yield [doc['group'], doc['number']], doc['number']
+
+    reduce = "_sum"
+
+
+class TestViewIndex(common.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.database = database.Database()
+        for group, number in [("b", 3), ("a", 2), ("b", 1), ("a", 4),
+                              ("c", 5)]:
+            yield self.save(group, number)
+
+    def save(self, group, number):
+        doc_id = "%s%d" % (group, number)
+        doc = dict(_id=doc_id, group=group, number=number)
+        return self.database.save_doc(json.dumps(doc))
+
+    def query(self, **options):
+        return self.database.query_view(ItemView, reduce=False, **options)
+
+    def keys(self, rows):
+        return ["%s%d" % tuple(key) for key, _ in rows]
+
+    @defer.inlineCallbacks
+    def testRangeQueries(self):
+        rows = yield self.query()
+        self.assertEqual(["a2", "a4", "b1", "b3", "c5"], self.keys(rows))
+
+        rows = yield self.query(key=["b", 3])
+        self.assertEqual([(["b", 3], 3)], rows)
+
+        rows = yield self.query(startkey=["a", 3], endkey=["b", 3])
+        self.assertEqual(["a4", "b1", "b3"], self.keys(rows))
+
+        rows = yield self.query(startkey=["a", 3], endkey=["b", 3],
+                                inclusive_end=False)
+        self.assertEqual(["a4", "b1"], self.keys(rows))
+
+        rows = yield self.query(startkey=["b"], endkey=["b", {}])
+        self.assertEqual(["b1", "b3"], self.keys(rows))
+
+        rows = yield self.query(descending=True, startkey=["b", 3],
+                                endkey=["a", 3])
+        self.assertEqual(["b3", "b1", "a4"], self.keys(rows))
+
+        rows = yield self.query(skip=1, limit=2)
+        self.assertEqual(["a4", "b1"], self.keys(rows))
+
+    @defer.inlineCallbacks
+    def testIndexUpdates(self):
+        rows = yield self.query(startkey=["b"])
+        self.assertEqual(["b1", "b3", "c5"], self.keys(rows))
+
+        resp = yield self.database.open_doc("b1")
+        yield self.database.delete_doc("b1", resp["_rev"])
+        doc = yield self.database.open_doc("a4")
+        doc["group"] = "d"
+        yield self.database.save_doc(json.dumps(doc))
+        yield self.save("a", 7)
+
+        rows = yield self.query()
+        self.assertEqual(["a2", "a7", "b3", "c5", "d4"], self.keys(rows))
+
+    @defer.inlineCallbacks
+    def testGroupedReduce(self):
+        rows = yield self.database.query_view(ItemView)
+        self.assertEqual([(None, 15)], rows)
+
+        rows = yield self.database.query_view(ItemView, startkey=["b"])
+        self.assertEqual([(None, 9)], rows)
+
+        rows = yield self.database.query_view(ItemView, group_level=1)
+        self.assertEqual([(["a"], 6), (["b"], 4), (["c"], 5)], rows)
+
+        rows = yield self.database.query_view(ItemView, group=True,
+                                              startkey=["b"], limit=2)
+        self.assertEqual([(["b", 1], 1), (["b", 3], 3)], rows)
+
+
 class TestDatabaseIntegration(common.TestCase):
     '''This testcase uses only external interface for sanity check.
     Idea is to later reuse the testcase for paisley.'''
@@ -240,3 +240,26 @@ class TestMessaging(common.TestCase):
         reactor.callLater(0.1, asserts, d)
 
         return d
+
+    @defer.inlineCallbacks
+    def testPublishingToManyRecipients(self):
+        agent2 = common.StubAgent()
+        second_connection = yield self.messaging.new_channel(agent2)
+        keys = [self.agent.get_agent_id(), agent2.get_agent_id()]
+        self.connection.bind(keys[0], 'lobby')
+        second_connection.bind(keys[1], 'lobby')
+        second_connection.bind(keys[1], 'other')
+
+        msg = message.BaseMessage(payload='some message')
+        recipients = [recipient.Recipient(keys[0], 'lobby'),
+                      recipient.Recipient(keys[1], 'other'),
+                      recipient.Recipient(keys[1], 'lobby'),
+                      recipient.Recipient(keys[1], 'unknown')]
+        result = yield self.connection.post(recipients, msg)
+        self.assertEqual([(True, msg)] * 4, result)
+        stats = dict(self.messaging.get_stats())
+        self.assertEqual(3, stats['messages published'])
+
+        yield common.delay(None, 0.1)
+        self.assertEqual(1, len(self.agent.messages))
+        self.assertEqual(2, len(agent2.messages))
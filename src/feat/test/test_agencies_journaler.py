@@ -20,13 +20,24 @@
 
 # Headers in this file shall remain intact.
 import signal
+import shutil
+import sqlite3
 import tempfile
 import os
 
 from feat.test import common
 from feat.common import defer, time
 from feat.agencies import journaler
-from feat.common.serialization import banana
+from feat.common.serialization import banana, binary, sexp
+
+
+class DummyJournaler(object):
+
+    def __init__(self):
+        self.entries = []
+
+    def insert_entry(self, **data):
+        self.entries.append(data)
 
 
 class SqliteWriter(journaler.SqliteWriter, common.Mock):
@@ -115,6 +126,83 @@ class DBTests(common.TestCase):
         self.assertEqual('some.canonical.name', first['fun_id'])
         self.assertEqual('other', second['fun_id'])
 
+    @defer.inlineCallbacks
+    def testCapturedEntries(self):
+        jour = journaler.Journaler(self)
+        writer = journaler.SqliteWriter(self)
+        yield writer.initiate()
+        yield jour.configure_with(writer)
+        connection = journaler.JournalerConnection(jour, None)
+
+        payload = {'list': [1, 2L, 3.5], 'text': u'\u2603', 'none': None}
+        for index in range(3):
+            entry = connection.new_entry('some id', 1, ('some_id', index),
+                                         'some.canonical.name',
+                                         index, payload, key=payload)
+            entry.set_fiber_context('some fiber id', 1)
+            side_effect = entry.new_side_effect('some.effect', payload)
+            side_effect.add_effect('some_effect', payload, key=index)
+            side_effect.set_result(payload)
+            side_effect.commit()
+            entry.new_side_effect('uncommitted.effect')
+            entry.set_result(payload)
+            entry.commit()
+            # the entry has been captured, changing the values
+            # after the commit should not change the journal
+            payload['list'].append(index)
+
+        yield self.wait_for(jour.is_idle, 1, freq=0.01)
+        histories = yield jour.get_histories()
+        entries = yield jour.get_entries(histories[0])
+        self.assertEqual(3, len(entries))
+
+        payload = {'list': [1, 2L, 3.5], 'text': u'\u2603', 'none': None}
+        for index, row in enumerate(entries):
+            # blobs should be the same as serialized on the reactor
+            unpacked = self._unpack(row)
+            self.assertEqual(self.serializer.convert(('some_id', index)),
+                             unpacked['j_id'])
+            self.assertEqual(self.serializer.convert((index, payload)),
+                             unpacked['args'])
+            self.assertEqual(self.serializer.convert({'key': payload}),
+                             unpacked['kwargs'])
+            self.assertEqual(self.serializer.freeze(payload),
+                             unpacked['res'])
+            side_effects = [
+                ['some.effect', self.serializer.freeze((payload, )),
+                 self.serializer.freeze(dict()),
+                 [('some_effect', self.serializer.convert((payload, )),
+                   self.serializer.convert({'key': index}))],
+                 self.serializer.convert(payload)],
+                []]
+            self.assertEqual(self.serializer.convert(side_effects),
+                             unpacked['sfx'])
+            payload['list'].append(index)
+
+    @defer.inlineCallbacks
+    def testSnapshotEntries(self):
+        jour = journaler.Journaler(self)
+        writer = journaler.SqliteWriter(self, encoding='zip')
+        yield writer.initiate()
+        yield jour.configure_with(writer)
+        connection = journaler.JournalerConnection(jour, None)
+
+        agent = {'state': 'x' * 100}
+        protocols = [[agent], u'protocol']
+        connection.snapshot('some id', 1, (agent, protocols))
+
+        yield self.wait_for(jour.is_idle, 1, freq=0.01)
+        histories = yield jour.get_histories()
+        entries = yield jour.get_entries(histories[0])
+        self.assertEqual(1, len(entries))
+        unpacked = self._unpack(entries[0])
+        self.assertEqual('snapshot', unpacked['fun_id'])
+        # the agent and the protocols can be restored one by one
+        self.assertTrue(binary.is_binary(unpacked['args']))
+        items = list(binary.unserialize_stream([unpacked['args']]))
+        self.assertEqual([agent] + protocols, items)
+        self.assertTrue(items[1][0] is items[0])
+
     def _unpack(self, row):
         keys = ('a_id', 'i_id', 'j_id', 'fun_id', 'f_id',
                 'f_dep', 'args', 'kwargs', 'sfx', 'res', 'time', )
@@ -193,6 +281,257 @@ class DBTests(common.TestCase):
         self.assertEqual(3, self._rotate_called)
         yield jour.close()
 
+    @defer.inlineCallbacks
+    @common.attr(timeout=10)
+    def testRotationBySize(self):
+        self._rotate_called = 0
+
+        def on_rotate():
+            self._rotate_called += 1
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'journal.sqlite')
+        jour = journaler.Journaler(self)
+        writer = journaler.SqliteWriter(
+            self, filename=filename, rotate_size=100000, on_rotate=on_rotate)
+        yield writer.initiate()
+        jour.configure_with(writer)
+
+        args = self.serializer.convert('x' * 1000)
+        for x in range(100):
+            yield jour.insert_entry(**self._generate_data(args=args))
+        yield self.wait_for(lambda: self._rotate_called > 0, 5, freq=0.1)
+
+        archived = [x for x in os.listdir(tmpdir) if x != 'journal.sqlite']
+        self.assertTrue(len(archived) >= 1)
+        self.assertTrue(os.path.exists(filename))
+
+        # the new file holds only the entries written after the rotation
+        yield jour.insert_entry(**self._generate_data())
+        histories = yield jour.get_histories()
+        entries = yield jour.get_entries(histories[0])
+        self.assertTrue(0 < len(entries) < 101)
+        yield jour.close()
+
+    @defer.inlineCallbacks
+    @common.attr(timeout=10)
+    def testRotationBySizeInWalMode(self):
+        self._rotate_called = 0
+
+        def on_rotate():
+            self._rotate_called += 1
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'journal.sqlite')
+        jour = journaler.Journaler(self)
+        writer = journaler.SqliteWriter(
+            self, filename=filename, journal_mode='wal',
+            rotate_size=100000, on_rotate=on_rotate)
+        yield writer.initiate()
+        jour.configure_with(writer)
+
+        # the entries stay in the -wal file, far from the checkpoint
+        args = self.serializer.convert('x' * 1000)
+        for x in range(100):
+            yield jour.insert_entry(**self._generate_data(args=args))
+        yield self.wait_for(lambda: self._rotate_called > 0, 5, freq=0.1)
+
+        archived = [x for x in os.listdir(tmpdir)
+                    if not x.startswith('journal.sqlite-')
+                    and x != 'journal.sqlite']
+        self.assertTrue(len(archived) >= 1)
+        yield jour.close()
+
+    @defer.inlineCallbacks
+    def testCloseDuringRotation(self):
+        self._rotate_called = 0
+
+        def on_rotate():
+            self._rotate_called += 1
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'journal.sqlite')
+        jour = journaler.Journaler(self)
+        writer = journaler.SqliteWriter(
+            self, filename=filename, rotate_size=10 ** 9, on_rotate=on_rotate)
+        yield writer.initiate()
+        yield jour.configure_with(writer)
+        yield jour.insert_entry(**self._generate_data())
+
+        # the rotation is triggered and the writer closed in the same turn
+        writer._rotate_size = 1
+        writer._check_rotation()
+        yield writer.close()
+        yield common.delay(None, 0.1)
+        self.assertEqual(journaler.State.disconnected,
+                         writer._get_machine_state())
+        self.assertFalse(writer._sighup_installed)
+        self.assertEqual(['journal.sqlite'], os.listdir(tmpdir))
+        self.assertEqual(0, self._rotate_called)
+
+        # the writer is closed while the rotation reopens the journal
+        yield writer.initiate()
+        yield jour.insert_entry(**self._generate_data())
+        writer._check_rotation()
+        yield common.delay(None, 0)
+        self.assertTrue(writer._rotation is not None)
+        yield writer.close()
+        yield common.delay(None, 0.1)
+        self.assertEqual(journaler.State.disconnected,
+                         writer._get_machine_state())
+        self.assertFalse(writer._sighup_installed)
+        self.assertEqual(2, len(os.listdir(tmpdir)))
+        self.assertTrue(writer._rotation is None)
+
+    @defer.inlineCallbacks
+    def testWalJournalMode(self):
+        filename = self._get_tmp_file()
+        writer = journaler.SqliteWriter(self, filename=filename,
+                                        journal_mode='wal',
+                                        synchronous='normal')
+        yield writer.initiate()
+        res = yield writer._db.runQuery('PRAGMA journal_mode')
+        self.assertEqual('wal', res[0][0])
+        res = yield writer._db.runQuery('PRAGMA synchronous')
+        # NORMAL == 1
+        self.assertEqual(1, res[0][0])
+        yield writer.close()
+
+        self.assertRaises(ValueError, journaler.SqliteWriter,
+                          self, journal_mode='unknown')
+        self.assertRaises(ValueError, journaler.SqliteWriter,
+                          self, synchronous='unknown')
+
+    @defer.inlineCallbacks
+    def testBulkInsertOfMixedEntries(self):
+        writer = journaler.SqliteWriter(self, encoding='zip')
+        yield writer.initiate()
+
+        entries = []
+        for index in range(10):
+            entries.append(self._generate_data(
+                agent_id='agent %d' % (index % 3, ),
+                function_id='function %d' % (index, )))
+            entries.append(self._generate_log(message='message %d' % index))
+        yield writer.insert_entries(entries)
+
+        histories = yield writer.get_histories()
+        self.assertEqual(3, len(histories))
+        for history in histories:
+            rows = yield writer.get_entries(history)
+            functions = [self._unpack(row)['fun_id'] for row in rows]
+            expected = ['function %d' % (index, ) for index in range(10)
+                        if 'agent %d' % (index % 3, ) == history.agent_id]
+            self.assertEqual(expected, functions)
+
+        logs = yield writer.get_log_entries(filters=[dict(level=5)])
+        self.assertEqual(['message %d' % (index, ) for index in range(10)],
+                         [row[0] for row in logs])
+        yield writer.close()
+
+    @defer.inlineCallbacks
+    def testSchemaMigration(self):
+        filename = self._get_tmp_file()
+        # schema of the journals created before it got versioned
+        connection = sqlite3.connect(filename)
+        for command in (
+            "CREATE TABLE entries (history_id INTEGER NOT NULL, "
+            "journal_id BLOB, function_id VARCHAR(200), "
+            "fiber_id VARCHAR(36), fiber_depth INTEGER, args BLOB, "
+            "kwargs BLOB, side_effects BLOB, result BLOB, "
+            "timestamp INTEGER)",
+            "CREATE TABLE logs (message BLOB, level INTEGER, "
+            "category VARCHAR(36), log_name VARCHAR(36), "
+            "file_path VARCHAR(200), line_num INTEGER, timestamp INTEGER)",
+            "CREATE TABLE histories (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "agent_id VARCHAR(36), instance_id INTEGER)",
+            "CREATE TABLE metadata (name VARCHAR(100), value VARCHAR(100))",
+            "INSERT INTO metadata VALUES('encoding', 'None')"):
+            connection.execute(command)
+        connection.commit()
+        connection.close()
+
+        writer = SqliteWriter(self, filename=filename)
+        yield writer.initiate()
+        self.assertCalled(writer, '_create_schema', times=0)
+        yield self._assert_schema(writer)
+        yield writer.close()
+
+        # migration is not repeated
+        writer = SqliteWriter(self, filename=filename)
+        yield writer.initiate()
+        yield self._assert_schema(writer)
+        yield writer.close()
+
+    @defer.inlineCallbacks
+    def testNewSchema(self):
+        writer = journaler.SqliteWriter(self, filename=self._get_tmp_file())
+        yield writer.initiate()
+        yield self._assert_schema(writer)
+        yield writer.close()
+
+    @defer.inlineCallbacks
+    def testPaginatedQueries(self):
+        writer = journaler.SqliteWriter(self)
+        yield writer.initiate()
+        entries = [self._generate_log(message='message %d' % (x, ),
+                                      category='category %d' % (x % 2, ),
+                                      timestamp=x)
+                   for x in range(25)]
+        entries += [self._generate_data(function_id='function %d' % (x, ))
+                    for x in range(7)]
+        yield writer.insert_entries(entries)
+
+        pages = []
+        cursor = None
+        filters = [dict(level=5, category='category 1')]
+        while True:
+            rows, cursor = yield writer.get_log_entries_page(
+                start_date=3, filters=filters, cursor=cursor, limit=5)
+            pages.append([row[0] for row in rows])
+            self.assertTrue(all([len(row) == 7 for row in rows]))
+            if cursor is None:
+                break
+        expected = ['message %d' % (x, ) for x in range(3, 25, 2)]
+        self.assertEqual([expected[0:5], expected[5:10], expected[10:]],
+                         pages)
+
+        history = (yield writer.get_histories())[0]
+        rows, cursor = yield writer.get_entries_page(history, limit=4)
+        self.assertEqual(['function %d' % (x, ) for x in range(4)],
+                         [self._unpack(row)['fun_id'] for row in rows])
+        self.assertTrue(cursor is not None)
+        rows, cursor = yield writer.get_entries_page(history, cursor=cursor,
+                                                     limit=4)
+        self.assertEqual(['function %d' % (x, ) for x in range(4, 7)],
+                         [self._unpack(row)['fun_id'] for row in rows])
+        self.assertTrue(cursor is None)
+
+        # a last page with exactly limit rows has no next page
+        rows, cursor = yield writer.get_entries_page(history, limit=7)
+        self.assertEqual(7, len(rows))
+        self.assertTrue(cursor is None)
+        page = writer.lookup_cmd('get_log_entries_page')
+        rows, cursor = yield page(filters=filters, limit=12)
+        self.assertEqual(12, len(rows))
+        self.assertTrue(cursor is None)
+        yield writer.close()
+
+    @defer.inlineCallbacks
+    def _assert_schema(self, writer):
+        res = yield writer._db.runQuery(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")
+        indexes = [row[0] for row in res]
+        for index in ('logs_timestamp_idx', 'logs_category_idx',
+                      'entries_history_timestamp_idx'):
+            self.assertTrue(index in indexes)
+        res = yield writer._db.runQuery(
+            "SELECT value FROM metadata WHERE name = 'schema_version'")
+        self.assertEqual([(unicode(journaler.SCHEMA_VERSION), )], res)
+
     def _get_tmp_file(self):
         fd, name = tempfile.mkstemp(suffix='_journal.sqlite')
         self.addCleanup(os.remove, name)
@@ -216,6 +555,20 @@ class DBTests(common.TestCase):
         defaults.update(opts)
         return defaults
 
+    def _generate_log(self, **opts):
+        defaults = {
+            'entry_type': 'log',
+            'level': 3,
+            'log_name': 'some name',
+            'category': 'some category',
+            'file_path': 'some_file.py',
+            'line_num': 42,
+            'message': 'some message',
+            'timestamp': int(time.time())}
+
+        defaults.update(opts)
+        return defaults
+
     @defer.inlineCallbacks
     def _assert_entries(self, jour, num):
         histories = yield jour.get_histories()
@@ -225,3 +578,218 @@ class DBTests(common.TestCase):
             entries = yield jour.get_entries(histories[0])
             self.assertIsInstance(entries, list)
             self.assertEqual(num, len(entries))
+
+
+class EntriesCacheTest(common.TestCase):
+
+    def testDropLogs(self):
+        cache = journaler.EntriesCache(max_size=2000)
+        for index in range(10):
+            cache.append(self._log(index))
+            cache.append(self._journal(index))
+        stats = dict(cache.get_stats())
+        self.assertTrue(cache.is_full())
+        self.assertEqual(20, stats['appended'])
+        self.assertTrue(stats['dropped'] > 0)
+        entries = cache.fetch()
+        journals = [x['index'] for x in entries
+                    if x['entry_type'] == 'journal']
+        self.assertEqual(range(10), journals)
+        self.assertEqual(20 - stats['dropped'], len(entries))
+        cache.commit()
+        self.assertEqual(0, len(cache))
+        self.assertEqual(0, cache.get_size())
+        self.assertFalse(cache.is_full())
+
+    def testSpill(self):
+        fd, path = tempfile.mkstemp(suffix='.spill')
+        os.close(fd)
+        cache = journaler.EntriesCache(
+            max_size=2000, policy=journaler.OverflowPolicy.spill,
+            spill_path=path)
+        for index in range(20):
+            cache.append(self._journal(index))
+        self.assertEqual(20, len(cache))
+        self.assertTrue(cache.get_spilled() > 0)
+        self.assertTrue(os.path.exists(path))
+
+        result = []
+        while len(cache) > 0:
+            result.extend([x['index'] for x in cache.fetch()])
+            cache.commit()
+        self.assertEqual(range(20), result)
+        self.assertEqual(0, cache.get_spilled())
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(20, dict(cache.get_stats())['committed'])
+
+    def testRollback(self):
+        cache = journaler.EntriesCache()
+        cache.append(self._journal(0))
+        self.assertEqual(1, len(cache.fetch()))
+        self.assertTrue(cache.is_locked())
+        self.assertRaises(RuntimeError, cache.fetch)
+        cache.append(self._journal(1))
+        cache.rollback()
+        self.assertEqual(2, len(cache.fetch()))
+        cache.commit()
+        self.assertEqual(0, len(cache))
+
+    def testBoundedFetch(self):
+        cache = journaler.EntriesCache()
+        for index in range(25):
+            cache.append(self._journal(index))
+        result = []
+        while len(cache) > 0:
+            entries = cache.fetch(max_entries=10)
+            self.assertTrue(len(entries) <= 10)
+            result.extend([x['index'] for x in entries])
+            cache.commit()
+        self.assertEqual(range(25), result)
+        self.assertEqual([], cache.fetch())
+        self.assertFalse(cache.is_locked())
+
+    def testCapturedEntriesSize(self):
+        jour = DummyJournaler()
+        serializer = sexp.Serializer()
+        for payload in ('x', 'x' * 10000):
+            record = journaler.Record(jour)
+            entry = journaler.AgencyJournalEntry(
+                serializer, record, 'some id', 1, 'some_id',
+                'some.canonical.name', payload)
+            entry.new_side_effect('some.effect', payload).commit()
+            entry.set_result(payload)
+            entry.commit()
+        small, big = jour.entries
+
+        # the payload counts for the arguments, the side effect
+        # and the result of the entry
+        difference = journaler.entry_size(big) - journaler.entry_size(small)
+        self.assertTrue(difference >= 3 * 9999)
+
+        cache = journaler.EntriesCache(max_size=20000)
+        cache.append(small)
+        self.assertFalse(cache.is_full())
+        cache.append(big)
+        self.assertTrue(cache.is_full())
+
+        encoded = journaler.EntryEncoder().encode(big)
+        self.assertFalse('size' in encoded)
+        self.assertFalse('captured' in encoded)
+
+    def _log(self, index):
+        return {'entry_type': 'log',
+                'level': 3,
+                'log_name': 'some name',
+                'category': 'some category',
+                'file_path': 'some_file.py',
+                'line_num': 42,
+                'message': 'x' * 100,
+                'timestamp': int(time.time()),
+                'index': index}
+
+    def _journal(self, index):
+        return {'entry_type': 'journal',
+                'agent_id': 'some id',
+                'instance_id': 1,
+                'journal_id': 'some journal id',
+                'function_id': 'some.canonical.name',
+                'args': 'x' * 100,
+                'kwargs': '',
+                'fiber_id': 'some fiber id',
+                'fiber_depth': 1,
+                'result': '',
+                'side_effects': '',
+                'timestamp': int(time.time()),
+                'index': index}
+
+
+@common.attr('slow')
+class BenchmarkTests(common.TestCase):
+
+    timeout = 120
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.serializer = banana.Serializer()
+
+    @defer.inlineCallbacks
+    def testInsertThroughput(self):
+        fd, filename = tempfile.mkstemp(suffix='_journal.sqlite')
+        os.close(fd)
+        self.addCleanup(os.remove, filename)
+
+        result = yield self._measure(filename)
+        self.info("Inserted %d entries with default settings: "
+                  "%.0f entries/s", *result)
+
+        os.remove(filename)
+        result = yield self._measure(filename, journal_mode='WAL',
+                                     synchronous='NORMAL')
+        self.info("Inserted %d entries with WAL journal: "
+                  "%.0f entries/s", *result)
+
+    @defer.inlineCallbacks
+    def testRecordedCallLatency(self):
+        jour = journaler.Journaler(self)
+        writer = journaler.SqliteWriter(self)
+        yield writer.initiate()
+        yield jour.configure_with(writer)
+        connection = journaler.JournalerConnection(jour, None)
+
+        count = 10000
+        payload = {'list': range(10), 'text': u'some text' * 5,
+                   'nested': dict(('key%d' % i, (i, 'value'))
+                                  for i in range(10))}
+        start = time.time()
+        for index in range(count):
+            entry = connection.new_entry('agent %d' % (index % 20, ), 1,
+                                         ('some_id', index),
+                                         'some.canonical.name',
+                                         payload, key=index)
+            side_effect = entry.new_side_effect('some.effect', index)
+            side_effect.add_effect('some_effect', payload)
+            side_effect.set_result(payload)
+            side_effect.commit()
+            entry.set_result(payload)
+            entry.commit()
+        recorded = time.time() - start
+        yield self.wait_for(jour.is_idle, 100, freq=0.01)
+        elapsed = time.time() - start
+        self.info("Recorded %d calls: %.1f us per call on the reactor, "
+                  "%.0f entries/s written", count,
+                  recorded * 1000000 / count, count / elapsed)
+
+    @defer.inlineCallbacks
+    def _measure(self, filename, count=50000, batch=500, **options):
+        writer = journaler.SqliteWriter(self, filename=filename, **options)
+        yield writer.initiate()
+        entries = map(self._generate_entry, range(count))
+        start = time.time()
+        for index in range(0, count, batch):
+            yield writer.insert_entries(entries[index:index + batch])
+        elapsed = time.time() - start
+        yield writer.close()
+        defer.returnValue((count, count / elapsed))
+
+    def _generate_entry(self, index):
+        if index % 2:
+            return {'entry_type': 'log',
+                    'level': 3,
+                    'log_name': 'some name',
+                    'category': 'some category',
+                    'file_path': 'some_file.py',
+                    'line_num': index,
+                    'message': 'message %d' % (index, ),
+                    'timestamp': index}
+        return {'entry_type': 'journal',
+                'agent_id': 'agent %d' % (index % 20, ),
+                'instance_id': 1,
+                'journal_id': self.serializer.convert(('some_id', index)),
+                'function_id': 'some.canonical.name',
+                'args': self.serializer.convert((index, )),
+                'kwargs': self.serializer.convert(dict()),
+                'fiber_id': 'some fiber id',
+                'fiber_depth': 1,
+                'result': self.serializer.convert(None),
+                'side_effects': self.serializer.convert(list()),
+                'timestamp': index}
@@ -25,7 +25,7 @@ import os
 import optparse
 import operator
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.spread import pb
 
 from feat.test import common
@@ -47,6 +47,147 @@ class OptParseMock(object):
     agent_name = 'name'
 
 
+class DummySnapshotEntry(object):
+
+    def __init__(self, size):
+        self.size = size
+
+    def estimate_size(self):
+        return self.size
+
+
+class DummySnapshotDescriptor(object):
+
+    def __init__(self, document_type):
+        self.document_type = document_type
+
+
+class DummySnapshotMedium(object):
+
+    def __init__(self, clock, agent_id, agent_type, entries, snapshots,
+                 duration=0):
+        self.clock = clock
+        self.agent_id = agent_id
+        self.agent_type = agent_type
+        self.entries = entries
+        self.snapshots = snapshots
+        self.duration = duration
+
+    def get_agent_id(self):
+        return self.agent_id
+
+    def get_descriptor(self):
+        return DummySnapshotDescriptor(self.agent_type)
+
+    def get_entries_since_snapshot(self):
+        return self.entries
+
+    def should_snapshot(self):
+        return self.entries > base_agency.MIN_ENTRIES_PER_SNAPSHOT
+
+    def journal_snapshot(self):
+        self.clock.advance(self.duration)
+        self.snapshots.append(self.agent_id)
+        self.entries = 0
+        return DummySnapshotEntry(100)
+
+
+class DummySnapshotAgency(log.Logger, log.LogProxy):
+
+    def __init__(self, testcase, agents):
+        log.Logger.__init__(self, testcase)
+        log.LogProxy.__init__(self, testcase)
+        self.agents = dict((x.agent_id, x) for x in agents)
+
+    def iter_agents(self):
+        return self.agents.itervalues()
+
+    def get_agent(self, agent_id):
+        return self.agents.get(agent_id)
+
+
+class SnapshotSchedulerTest(common.TestCase):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.clock = task.Clock()
+        self.snapshots = []
+
+    def tearDown(self):
+        self.scheduler.stop()
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def medium(self, agent_id, entries, agent_type='dummy', duration=0):
+        return DummySnapshotMedium(self.clock, agent_id, agent_type,
+                                   entries, self.snapshots, duration)
+
+    def scheduler_for(self, agents, **kwargs):
+        dummy = DummySnapshotAgency(self, agents)
+        return agency.SnapshotScheduler(dummy, clock=self.clock, **kwargs)
+
+    def testSpreadsSnapshots(self):
+        agents = [self.medium('a', 700), self.medium('b', 5000),
+                  self.medium('c', 100), self.medium('d', 900),
+                  self.medium('e', 2000)]
+        self.scheduler = self.scheduler_for(
+            agents, interval=0.4, min_delay=0.1)
+        self.scheduler.start()
+        self.clock.advance(0.39)
+        self.assertEqual([], self.snapshots)
+
+        # one agent every 0.1s, the ones with more entries first
+        self.clock.advance(0.01)
+        self.assertEqual(['b'], self.snapshots)
+        self.assertEqual(3, self.scheduler.get_pending())
+        self.clock.advance(0.1)
+        self.assertEqual(['b', 'e'], self.snapshots)
+        self.clock.pump([0.1, 0.1])
+        self.assertEqual(['b', 'e', 'd', 'a'], self.snapshots)
+        self.assertEqual(0, self.scheduler.get_pending())
+
+        # the next round has nothing to do
+        self.clock.advance(0.2)
+        self.assertEqual(4, len(self.snapshots))
+
+    def testTimeBudget(self):
+        agents = [self.medium(str(x), 1000, duration=0.03)
+                  for x in range(5)]
+        self.scheduler = self.scheduler_for(
+            agents, interval=1, budget=0.05, min_delay=0.5)
+        self.scheduler.start()
+
+        # 3 agents per iteration, but the second one exceeds the budget
+        self.clock.advance(1)
+        self.assertEqual(2, len(self.snapshots))
+        self.assertEqual(3, self.scheduler.get_pending())
+
+        # unregistered agents are skipped
+        dummy = self.scheduler.agency
+        del dummy.agents[self.scheduler._queue[-1].agent_id]
+        # the next iteration comes 0.5s after the end of the first one
+        self.clock.advance(0.49)
+        self.assertEqual(2, len(self.snapshots))
+        self.clock.advance(0.01)
+        self.assertEqual(4, len(self.snapshots))
+        self.assertEqual(0, self.scheduler.get_pending())
+
+    def testMetrics(self):
+        self.scheduler = self.scheduler_for([])
+        self.scheduler.snapshot(
+            self.medium('a', 700, 'host_agent', duration=0.1))
+        self.scheduler.snapshot(
+            self.medium('b', 700, 'host_agent', duration=0.3))
+        self.scheduler.snapshot(self.medium('c', 0, 'dns_agent'))
+        metrics = self.scheduler.get_metrics()
+        self.assertEqual(['dns_agent', 'host_agent'],
+                         [x[0] for x in metrics])
+        self.assertEqual((1, 100, 100), metrics[0][1:4])
+        self.assertEqual((2, 100, 100), metrics[1][1:4])
+        self.assertEqual((0, 0), metrics[0][4:])
+        self.assertAlmostEqual(0.2, metrics[1][4])
+        self.assertAlmostEqual(0.3, metrics[1][5])
+
+
 class UnitTestCase(common.TestCase):
 
     def setUp(self):
@@ -100,13 +241,23 @@ class UnitTestCase(common.TestCase):
         self.assertTrue(hasattr(options, 'msg_port'))
         self.assertTrue(hasattr(options, 'msg_user'))
         self.assertTrue(hasattr(options, 'msg_password'))
+        self.assertTrue(hasattr(options, 'msg_wire_format'))
+        self.assertTrue(hasattr(options, 'msg_commit_interval'))
+        self.assertTrue(hasattr(options, 'msg_commit_size'))
+        self.assertTrue(hasattr(options, 'msg_prefetch'))
         self.assertTrue(hasattr(options, 'db_host'))
         self.assertTrue(hasattr(options, 'db_port'))
         self.assertTrue(hasattr(options, 'db_name'))
+        self.assertTrue(hasattr(options, 'db_pool_size'))
+        self.assertTrue(hasattr(options, 'db_cache_size'))
         self.assertTrue(hasattr(options, 'manhole_public_key'))
         self.assertTrue(hasattr(options, 'manhole_private_key'))
         self.assertTrue(hasattr(options, 'manhole_authorized_keys'))
         self.assertTrue(hasattr(options, 'manhole_port'))
+        self.assertTrue(hasattr(options, 'agency_journal_cache_size'))
+        self.assertTrue(hasattr(options, 'agency_journal_overflow'))
+        self.assertTrue(hasattr(options, 'agency_journal_rotate_size'))
+        self.assertTrue(hasattr(options, 'agency_journal_rotate_age'))
         a = agency.Agency.from_config(dict())
         self.assertEqual(a.config['msg']['host'],
                          options_module.DEFAULT_MSG_HOST)
@@ -116,12 +267,24 @@ class UnitTestCase(common.TestCase):
                          options_module.DEFAULT_MSG_USER)
         self.assertEqual(a.config['msg']['password'],
                          options_module.DEFAULT_MSG_PASSWORD)
+        self.assertEqual(a.config['msg']['wire_format'],
+                         options_module.DEFAULT_MSG_WIRE_FORMAT)
+        self.assertEqual(a.config['msg']['commit_interval'],
+                         options_module.DEFAULT_MSG_COMMIT_INTERVAL)
+        self.assertEqual(a.config['msg']['commit_size'],
+                         options_module.DEFAULT_MSG_COMMIT_SIZE)
+        self.assertEqual(a.config['msg']['prefetch'],
+                         options_module.DEFAULT_MSG_PREFETCH)
         self.assertEqual(a.config['db']['host'],
                          options_module.DEFAULT_DB_HOST)
         self.assertEqual(a.config['db']['port'],
                          options_module.DEFAULT_DB_PORT)
         self.assertEqual(a.config['db']['name'],
                          options_module.DEFAULT_DB_NAME)
+        self.assertEqual(a.config['db']['pool_size'],
+                         options_module.DEFAULT_DB_POOL_SIZE)
+        self.assertEqual(a.config['db']['cache_size'],
+                         options_module.DEFAULT_DB_CACHE_SIZE)
         self.assertEqual(a.config['manhole']['public_key'],
                          options_module.DEFAULT_MH_PUBKEY)
         self.assertEqual(a.config['manhole']['private_key'],
@@ -130,6 +293,38 @@ class UnitTestCase(common.TestCase):
                          options_module.DEFAULT_MH_AUTH)
         self.assertEqual(a.config['manhole']['port'],
                          options_module.DEFAULT_MH_PORT)
+        self.assertEqual(a.config['agency']['journal_cache_size'],
+                         options_module.DEFAULT_JOURNAL_CACHE_SIZE)
+        self.assertEqual(a.config['agency']['journal_overflow'],
+                         options_module.DEFAULT_JOURNAL_OVERFLOW)
+        self.assertEqual(a.config['agency']['journal_rotate_size'],
+                         options_module.DEFAULT_JOURNAL_ROTATE_SIZE)
+        self.assertEqual(a.config['agency']['journal_rotate_age'],
+                         options_module.DEFAULT_JOURNAL_ROTATE_AGE)
+
+    def testJournalRotationConfig(self):
+        parser = optparse.OptionParser()
+        options_module.add_options(parser)
+        options, _ = parser.parse_args(['--journal-rotate-size', '1048576',
+                                        '--journal-rotate-age', '3600'])
+        a = agency.Agency.from_config(dict(), options)
+        self.assertEqual(1048576, a.config['agency']['journal_rotate_size'])
+        self.assertEqual(3600, a.config['agency']['journal_rotate_age'])
+
+    def testJournalCacheConfig(self):
+        parser = optparse.OptionParser()
+        options_module.add_options(parser)
+        options, _ = parser.parse_args(['--journal-cache-size', '1000000',
+                                        '--journal-overflow', 'spill'])
+        a = agency.Agency.from_config(dict(), options)
+        self.assertEqual(1000000, a.config['agency']['journal_cache_size'])
+        self.assertEqual('spill', a.config['agency']['journal_overflow'])
+
+        env = dict()
+        a._store_config(env)
+        a = agency.Agency.from_config(env)
+        self.assertEqual('1000000', a.config['agency']['journal_cache_size'])
+        self.assertEqual('spill', a.config['agency']['journal_overflow'])
 
 
 class StandalonePartners(partners.Partners):
@@ -47,6 +47,19 @@ class DummyAgency(log.LogProxy, manhole.Manhole, log.Logger):
         return iter([])
 
 
+class DummyMedium(manhole.Manhole):
+
+    def __init__(self, agent_id):
+        self.agent_id = agent_id
+
+    def get_agent_id(self):
+        return self.agent_id
+
+    @manhole.expose()
+    def echo(self, text):
+        return text
+
+
 class BrokerTest(common.TestCase):
 
     timeout=3
@@ -259,6 +272,72 @@ class BrokerTest(common.TestCase):
         self.assertEqual(3, slave2.shared_state['a'])
         self.assertEqual(5, slave2.shared_state['b'])
 
+    @defer.inlineCallbacks
+    def testSharedStateBatching(self):
+        master, slave1, slave2 = self.brokers
+        for x in self.brokers:
+            yield x.initiate_broker()
+
+        for index in range(100):
+            slave1.shared_state['key'] = index
+            slave1.shared_state['key%d' % index] = index
+            del slave1.shared_state['key%d' % index]
+        master.shared_state.update(dict(a=1, b=2))
+        master.shared_state['a'] = 3
+        yield common.delay(None, 0.05)
+
+        for x in self.brokers:
+            self.assertEqual(dict(key=99, a=3, b=2), dict(x.shared_state))
+        stats = slave1.get_replication_stats()
+        self.assertEqual(1, stats['deltas sent'])
+        self.assertEqual(2, stats['deltas received'])
+        self.assertEqual(0, stats['pending changes'])
+        stats = master.get_replication_stats()
+        self.assertEqual(1, stats['deltas received'])
+        self.assertEqual(4, stats['deltas sent'])
+        self.assertEqual(2, stats['version'])
+        self.assertEqual(0, stats['max slave lag'])
+        self.assertEqual(2, slave2.get_replication_stats()['version'])
+
+    @defer.inlineCallbacks
+    def testSharedStateConcurrentChanges(self):
+        master, slave1, slave2 = self.brokers
+        for x in self.brokers:
+            yield x.initiate_broker()
+
+        master.shared_state['key'] = 'master'
+        slave1.shared_state['key'] = 'slave1'
+        slave2.shared_state.clear()
+        slave2.shared_state['other'] = 'slave2'
+        yield common.delay(None, 0.05)
+
+        expected = dict(master.shared_state)
+        for x in self.brokers:
+            self.assertEqual(expected, dict(x.shared_state))
+        self.assertEqual('slave2', expected['other'])
+
+    @defer.inlineCallbacks
+    def testSharedStateResync(self):
+        master, slave1, slave2 = self.brokers
+        for x in master, slave1:
+            yield x.initiate_broker()
+        master.shared_state['key'] = 'value'
+        yield common.delay(None, 0.05)
+
+        # simulate a lost delta
+        dict.__setitem__(master.shared_state, 'missed', 'value')
+        master._state_version += 1
+        slave1.shared_state['local'] = 'change'
+        master.shared_state['key'] = 'new value'
+        yield common.delay(None, 0.05)
+
+        expected = dict(key='new value', missed='value', local='change')
+        self.assertEqual(expected, dict(master.shared_state))
+        self.assertEqual(expected, dict(slave1.shared_state))
+        stats = slave1.get_replication_stats()
+        self.assertEqual(1, stats['resyncs'])
+        self.assertEqual(master._state_version, stats['version'])
+
     @defer.inlineCallbacks
     def testFailingEventsMasterToSlaves(self):
         fail = failure.Failure(RuntimeError('failed'))
@@ -299,6 +378,30 @@ class BrokerTest(common.TestCase):
         yield slave2.push_event('some', 'event')
         yield d
 
+    @defer.inlineCallbacks
+    def testAgentIndex(self):
+        master, slave1, slave2 = self.brokers
+        for x in self.brokers:
+            yield x.initiate_broker()
+        medium1, medium2 = DummyMedium('agent1'), DummyMedium('agent2')
+        yield slave1.register_agent(medium1)
+        yield slave2.register_agent(medium2)
+
+        self.assertEqual(None, master.lookup_agent('unknown'))
+        reference = master.lookup_agent('agent1')
+        result = yield reference.callRemote('echo', 'agent1')
+        self.assertEqual('agent1', result)
+        reference = master.lookup_agent('agent2')
+        result = yield reference.callRemote('echo', 'agent2')
+        self.assertEqual('agent2', result)
+
+        yield slave1.unregister_agent(medium1)
+        self.assertEqual(None, master.lookup_agent('agent1'))
+
+        slave2.disconnect()
+        yield common.delay(None, 0.1)
+        self.assertEqual(None, master.lookup_agent('agent2'))
+
     @defer.inlineCallbacks
     def tearDown(self):
         for x in self.brokers:
@@ -0,0 +1,185 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+# -*- Mode: Python -*-
+import json
+
+from twisted.internet import defer
+
+from feat.agencies.net import database
+from feat.agents.base import view
+
+from . import common
+
+
+class SomeView(view.BaseView):
+
+    name = 'some_view'
+
+    def map(doc):
+        yield doc['_id'], None
+
+
+class DummyPaisley(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+
+        def method(*args, **kwargs):
+            d = defer.Deferred()
+            self.calls.append((name, args, d))
+            return d
+
+        return method
+
+    def parseResult(self, result):
+        return json.loads(result)
+
+
+class DummyDatabase(database.Database):
+
+    def __init__(self, pool_size):
+        self.changes = []
+        database.Database.__init__(self, "localhost", 5984, "test",
+                                   pool_size=pool_size)
+
+    def _configure(self, host, port, name):
+        self.host, self.port = host, port
+        self.paisley = DummyPaisley()
+        self.db_name = name
+
+    def _trigger_change(self, doc_id, rev):
+        self.changes.append((doc_id, rev))
+
+
+class TestDatabasePool(common.TestCase):
+
+    def setUp(self):
+        self.db = DummyDatabase(pool_size=2)
+        self.calls = self.db.paisley.calls
+
+    def finish(self, index, result=None):
+        self.calls[index][2].callback(result)
+
+    def testConcurrentRequests(self):
+        results = []
+        for doc_id in ["a", "b", "c"]:
+            self.db.open_doc(doc_id).addCallback(results.append)
+
+        self.assertEqual(["openDoc", "openDoc"], [x[0] for x in self.calls])
+        self.assertEqual(("test", "a"), self.calls[0][1])
+        self.assertEqual(("test", "b"), self.calls[1][1])
+
+        self.finish(1, "B")
+        self.assertEqual(["B"], results)
+        self.assertEqual(3, len(self.calls))
+        self.assertEqual(("test", "c"), self.calls[2][1])
+
+        self.finish(0, "A")
+        self.finish(2, "C")
+        self.assertEqual(["B", "A", "C"], results)
+        self.assertEqual({}, self.db._doc_locks)
+
+    def testDocumentOrdering(self):
+        self.db.save_doc("{}", "a")
+        self.db.open_doc("a")
+        self.db.changed({"id": "a", "changes": [{"rev": "1-x"}]})
+        self.db.query_view(SomeView)
+        self.db.save_doc("{}")
+
+        # the view query and the new document are not blocked by "a"
+        self.assertEqual(["saveDoc", "openView"], [x[0] for x in self.calls])
+        self.assertEqual([], self.db.changes)
+
+        self.finish(1, {"rows": []})
+        self.assertEqual("saveDoc", self.calls[2][0])
+        self.assertEqual(("test", "{}", None), self.calls[2][1])
+
+        self.finish(0)
+        self.assertEqual("openDoc", self.calls[3][0])
+        self.assertEqual([], self.db.changes)
+
+        self.finish(3)
+        self.assertEqual([("a", "1-x")], self.db.changes)
+
+        self.finish(2)
+        self.assertEqual({}, self.db._doc_locks)
+
+    def testStatistics(self):
+        self.db.open_doc("a")
+        self.db.open_doc("b")
+        self.db.open_doc("c")
+        self.db.open_doc("c")
+        self.finish(0)
+
+        status = self.db.show_status()
+        self.assertEqual("Database", status[0])
+        stats = status[5].split("\n")
+        self.assertEqual("in flight: 2/2", stats[0])
+        self.assertEqual("queued: 0", stats[1])
+        self.assertEqual("waiting for documents: 1", stats[2])
+        self.assertTrue(stats[3].startswith("open_doc: 1 ("))
+
+    def testBulkRequests(self):
+        results = []
+        docs = ['{"_id": "b", "field": 1}', '{"field": 2}',
+                '{"_id": "a", "field": 3}']
+        self.db.save_docs(docs).addCallback(results.append)
+        self.db.open_doc("a")
+
+        self.assertEqual(["post"], [x[0] for x in self.calls])
+        self.assertEqual("/test/_bulk_docs", self.calls[0][1][0])
+        self.assertEqual(map(json.loads, docs),
+                         json.loads(self.calls[0][1][1])["docs"])
+
+        self.finish(0, json.dumps([
+            {"id": "b", "rev": "1-b"}, {"id": "c", "rev": "1-c"},
+            {"id": "a", "error": "conflict", "reason": "Conflict"}]))
+        self.assertEqual(["b", "c", "a"], [x["id"] for x in results[0]])
+        self.assertEqual("conflict", results[0][2]["error"])
+        self.assertEqual(["post", "openDoc"], [x[0] for x in self.calls])
+
+        # the bulk fetch waits for the pending request of "a"
+        self.db.open_docs(["a", "x", "y"]).addCallback(results.append)
+        self.assertEqual(2, len(self.calls))
+        self.finish(1)
+        self.assertEqual("/test/_all_docs?include_docs=true",
+                         self.calls[2][1][0])
+        self.assertEqual({"keys": ["a", "x", "y"]},
+                         json.loads(self.calls[2][1][1]))
+
+        self.finish(2, json.dumps({"rows": [
+            {"id": "a", "key": "a", "value": {"rev": "2-a"},
+             "doc": {"_id": "a", "_rev": "2-a"}},
+            {"key": "x", "error": "not_found"},
+            {"id": "y", "key": "y", "value": {"rev": "2-y", "deleted": True},
+             "doc": None}]}))
+        self.assertEqual([{"_id": "a", "_rev": "2-a"}, None, None],
+                         results[1])
+
+        self.db.delete_docs([("a", "2-a")])
+        self.assertEqual({"docs": [{"_id": "a", "_rev": "2-a",
+                                    "_deleted": True}]},
+                         json.loads(self.calls[3][1][1]))
+        self.finish(3, json.dumps([{"id": "a", "rev": "3-a"}]))
+        self.assertEqual({}, self.db._doc_locks)
@@ -0,0 +1,272 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+# -*- Mode: Python -*-
+
+from twisted.internet import defer
+
+from feat.agencies.common import Statistics
+from feat.agencies.net import messaging
+from feat.agents.base import message
+from feat.common import log
+from feat.extern.txamqp.content import Content
+
+from . import common
+
+
+class DummyAMQChannel(object):
+
+    def __init__(self):
+        self.calls = []
+        self.arguments = []
+
+    def __getattr__(self, name):
+
+        def method(*args, **kwargs):
+            self.calls.append(name)
+            self.arguments.append(kwargs)
+            return defer.succeed(None)
+
+        return method
+
+
+class DummyClient(object):
+
+    def __init__(self):
+        self.channel = DummyAMQChannel()
+
+    def get_free_channel(self):
+        return defer.succeed(self.channel)
+
+
+class DummyFactory(object):
+
+    def add_connection_lost_cb(self, cb):
+        pass
+
+
+class DummyMessaging(log.LogProxy, log.Logger, Statistics):
+
+    wire_format = messaging.DEFAULT_WIRE_FORMAT
+
+    def __init__(self, logger, commit_interval=None, commit_size=None,
+                 prefetch_count=None):
+        log.LogProxy.__init__(self, logger)
+        log.Logger.__init__(self, logger)
+        Statistics.__init__(self)
+        self.commit_interval = commit_interval
+        self.commit_size = commit_size
+        self.prefetch_count = prefetch_count
+
+
+class DummyDelivery(object):
+
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+class TestChannelCommits(common.TestCase):
+
+    def setUp(self):
+        self.client = DummyClient()
+
+    def create_channel(self, **kwargs):
+        self.messaging = DummyMessaging(self, **kwargs)
+        return messaging.Channel(self.messaging, defer.succeed(self.client),
+                                 DummyFactory())
+
+    def publish(self, channel, payload):
+        msg = message.BaseMessage(payload=payload)
+        return channel.publish('key', 'shard', msg)
+
+    def get_calls(self, name):
+        return [x for x in self.client.channel.calls if x == name]
+
+    def testCommitEveryMessage(self):
+        channel = self.create_channel()
+        for x in range(3):
+            self.publish(channel, x)
+        channel.ack(DummyDelivery(1))
+
+        self.assertEqual(4, len(self.get_calls('basic_publish')) +
+                         len(self.get_calls('basic_ack')))
+        self.assertEqual(4, len(self.get_calls('tx_commit')))
+        stats = dict(self.messaging.get_stats())
+        self.assertEqual(3, stats['messages published'])
+        self.assertEqual(1, stats['messages acked'])
+        self.assertEqual(4, stats['commits'])
+
+    @defer.inlineCallbacks
+    def testCommitBatchSize(self):
+        channel = self.create_channel(commit_interval=10, commit_size=2)
+        published = []
+        for x in range(3):
+            d = self.publish(channel, x)
+            d.addCallback(published.append)
+
+        self.assertEqual(3, len(self.get_calls('basic_publish')))
+        self.assertEqual(1, len(self.get_calls('tx_commit')))
+        self.assertEqual([0, 1], [x.payload for x in published])
+
+        # The last message is committed when disconnecting
+        yield channel.disconnect()
+        self.assertEqual(2, len(self.get_calls('tx_commit')))
+        self.assertEqual([0, 1, 2], [x.payload for x in published])
+        stats = dict(self.messaging.get_stats())
+        self.assertEqual(3, stats['messages published'])
+        self.assertEqual(2, stats['commits'])
+
+    @defer.inlineCallbacks
+    def testCommitInterval(self):
+        channel = self.create_channel(commit_interval=0.01)
+        published = []
+        for x in range(5):
+            d = self.publish(channel, x)
+            d.addCallback(published.append)
+        d = channel.ack(DummyDelivery(1))
+
+        self.assertEqual([], self.get_calls('tx_commit'))
+        self.assertEqual([], published)
+
+        yield d
+        self.assertEqual(1, len(self.get_calls('tx_commit')))
+        self.assertEqual(range(5), [x.payload for x in published])
+        stats = dict(self.messaging.get_stats())
+        self.assertEqual(5, stats['messages published'])
+        self.assertEqual(1, stats['messages acked'])
+        self.assertEqual(1, stats['commits'])
+
+
+class CountingSerializer(object):
+
+    def __init__(self, serializer):
+        self.serializer = serializer
+        self.converted = 0
+
+    def convert(self, data):
+        self.converted += 1
+        return self.serializer.convert(data)
+
+
+class TestChannelPublishing(common.TestCase):
+
+    def setUp(self):
+        self.client = DummyClient()
+        self.messaging = DummyMessaging(self)
+        self.channel = messaging.Channel(self.messaging,
+                                         defer.succeed(self.client),
+                                         DummyFactory())
+        self.channel.serializer = CountingSerializer(self.channel.serializer)
+
+    @defer.inlineCallbacks
+    def testPublishMany(self):
+        msg = message.BaseMessage(payload='payload')
+        routes = [('shard1', ['a', 'b']), ('shard2', ['c'])]
+        result = yield self.channel.publish_many(routes, msg)
+
+        self.assertEqual([(True, msg)] * 3, result)
+        self.assertEqual(1, self.channel.serializer.converted)
+        amq = self.client.channel
+        published = [kwargs for name, kwargs in zip(amq.calls, amq.arguments)
+                     if name == 'basic_publish']
+        self.assertEqual([('shard1', 'a'), ('shard1', 'b'), ('shard2', 'c')],
+                         [(x['exchange'], x['routing_key'])
+                          for x in published])
+        self.assertEqual(1, len(set(id(x['content']) for x in published)))
+        self.assertEqual(3, dict(self.messaging.get_stats())[
+            'messages published'])
+
+
+class DummyBareQueue(object):
+
+    def __init__(self):
+        self.waiting = []
+
+    def get(self):
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d
+
+
+class DummyAMQMessage(object):
+
+    def __init__(self, delivery_tag, body, content_type):
+        self.delivery_tag = delivery_tag
+        self.content = Content(body)
+        self.content.properties['content type'] = content_type
+
+
+class TestQueuePrefetch(common.TestCase):
+
+    def setUp(self):
+        self.client = DummyClient()
+        self.acks = []
+        self.client.channel.basic_ack = self.basic_ack
+        self.messaging = DummyMessaging(self, prefetch_count=3)
+        self.channel = messaging.Channel(self.messaging,
+                                         defer.succeed(self.client),
+                                         DummyFactory())
+        self.bare = DummyBareQueue()
+        self.queue = messaging.WrappedQueue(self.channel, 'queue')
+        self.queue.configure(self.bare)
+
+    def basic_ack(self, delivery_tag, multiple):
+        d = defer.Deferred()
+        self.acks.append((delivery_tag, multiple, d))
+        return d
+
+    def deliver(self, delivery_tag):
+        body = self.channel.serializer.convert(
+            message.BaseMessage(payload=delivery_tag))
+        msg = DummyAMQMessage(delivery_tag, body, self.channel.content_type)
+        self.bare.waiting[delivery_tag - 1].callback(msg)
+
+    def payloads(self):
+        return [x.payload for x in self.queue._messages]
+
+    def testPrefetchAndGroupedAcks(self):
+        self.assertEqual(1, len(self.bare.waiting))
+        self.deliver(1)
+        self.assertEqual([(1, False)], [x[:2] for x in self.acks])
+        self.assertEqual(2, len(self.bare.waiting))
+
+        self.deliver(2)
+        self.deliver(3)
+        # the window is full and the acks wait for the pending one
+        self.assertEqual(3, len(self.bare.waiting))
+        self.assertEqual(1, len(self.acks))
+        self.assertEqual([], self.payloads())
+
+        self.acks[0][2].callback(None)
+        self.assertEqual([1], self.payloads())
+        self.assertEqual([(3, True)], [x[:2] for x in self.acks[1:]])
+        self.assertEqual(4, len(self.bare.waiting))
+
+        self.deliver(4)
+        self.acks[1][2].callback(None)
+        self.assertEqual([1, 2, 3], self.payloads())
+        self.acks[2][2].callback(None)
+        self.assertEqual([1, 2, 3, 4], self.payloads())
+
+        stats = dict(self.messaging.get_stats())
+        self.assertEqual(4, stats['received by queue'])
+        self.assertEqual(4, stats['messages acked'])
+        self.assertEqual(3, stats['commits'])
@@ -55,7 +55,9 @@ class OtherPartners(partners.Partners):
 
 class DummyDesc(object):
 
-    def __init__(self, partners):
+    def __init__(self, partners, rev=None):
+        self.doc_id = "dummy"
+        self.rev = rev
         self.partners = partners
 
 
@@ -109,6 +111,37 @@ class TestPartners(common.TestCase):
         self.assertIsInstance(specials, list)
         self.assertEqual(3, len(specials))
 
+    def testIndexedLookups(self):
+        first = self._generate_partner(FirstPartner)
+        seconds = [self._generate_partner(SecondPartner, 'special')
+                   for _ in range(3)]
+        self._inject_partners([first] + seconds, rev="1")
+
+        self.assertEqual(first, self.partners.find(first.recipient))
+        self.assertEqual(first, self.partners.find(first.recipient.key))
+        self.assertEqual(seconds[1], self.partners.find(seconds[1].recipient))
+        self.assertEqual(None, self.partners.find(recipient.dummy_agent()))
+        self.assertEqual(seconds, self.partners.second)
+        self.assertEqual(seconds, self.partners.all_with_role("special"))
+        self.assertEqual(first, self.partners.first_with_role(None))
+        self.assertEqual(None, self.partners.first_with_role("special"))
+
+        # a new revision of the descriptor invalidates the index
+        special = self._generate_partner(SpecialPartner, 'special')
+        self._inject_partners(seconds[:1] + [special], rev="2")
+        self.assertEqual(None, self.partners.find(first.recipient))
+        self.assertEqual(special, self.partners.find(special.recipient))
+        self.assertEqual(None, self.partners.first)
+        self.assertEqual(seconds[:1], self.partners.second)
+        self.assertEqual([seconds[0], special],
+                         self.partners.all_with_role("special"))
+
+        duplicated = self._generate_partner(SecondPartner)
+        duplicated.recipient = special.recipient
+        self._inject_partners([special, duplicated], rev="3")
+        self.assertRaises(partners.FindPartnerError,
+                          self.partners.find, special.recipient)
+
     def _generate_partners(self):
         partners = [
             self._generate_partner(FirstPartner),
@@ -119,10 +152,10 @@ class TestPartners(common.TestCase):
 
         self._inject_partners(partners)
 
-    def _inject_partners(self, partners):
+    def _inject_partners(self, partners, rev=None):
 
         def get_descriptor():
-            return DummyDesc(partners)
+            return DummyDesc(list(partners), rev)
 
         setattr(self.agent, 'get_descriptor', get_descriptor)
 
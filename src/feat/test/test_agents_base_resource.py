@@ -156,6 +156,28 @@ class PortResourceTest(common.TestCase, Common):
         self.agent.time += 15
         self._assert_allocated([[1001, 1002, 1003]])
 
+    @defer.inlineCallbacks
+    def testBulkModifing(self):
+        alloc1 = yield self.resources.allocate(streamer=2)
+        self._assert_allocated([[1000, 1001]])
+        mod = yield self.resources.premodify(alloc1.id,
+            streamer=('release', [1000, 1001], 'add_specific', (1003, 1004)))
+        self._assert_allocated([[1000, 1001, 1003, 1004]])
+        # values added by the same modification are not allocated twice
+        n = yield self.resources.premodify(alloc1.id,
+                                           streamer=('add', 1, 'add', 1))
+        self.assertTrue(n is None)
+        yield self.resources.confirm(mod.id)
+        self._assert_allocated([[1003, 1004]])
+
+        n = yield self.resources.premodify(alloc1.id,
+            streamer=('add_specific', [1000, 1004]))
+        self.assertTrue(n is None)
+        d = self.resources.premodify(alloc1.id,
+                                     streamer=('release', [1003, 1002]))
+        self.assertFailure(d, resource.DeclarationError)
+        yield d
+
 
 @common.attr(timescale=0.05)
 class ResourcesTest(common.TestCase, Common):
@@ -488,3 +510,25 @@ class ResourcesTest(common.TestCase, Common):
         unserialize = pytree.unserialize
         Ins = pytree.Instance
         self.assertEqual(allocation, unserialize(serialize(allocation)))
+
+
+@common.attr('slow')
+class BenchmarkTests(common.TestCase):
+
+    def testRangeAllocation(self):
+        definition = resource.Range('ports', 10000, 19999)
+        # 8000 ports allocated by 1600 allocations of 5 ports
+        allocations = [resource.AllocatedRange(range(x, x + 5))
+                       for x in xrange(10000, 18000, 5)]
+
+        start = time.time()
+        for _ in range(100):
+            allocated = definition.allocate(allocations, 2)
+            allocations.append(allocated)
+            definition.modify(allocations, allocated, 'add', 1,
+                              'release', list(allocated.values))
+        definition.reduce(allocations)
+        elapsed = time.time() - start
+        self.info("Performed 100 allocations of a 10000 values range with "
+                  "%d allocated values: %.0f allocations/s",
+                  len(definition.reduce(allocations)), 100 / elapsed)
@@ -23,6 +23,8 @@
 # -*- Mode: Python -*-
 # vi:si:et:sw=4:sts=4:ts=4
 
+import random
+
 from zope.interface import implements
 
 from feat.agents.base import replay
@@ -375,6 +377,29 @@ class TestExpDict(common.TestCase):
                                         "spam": (8001, 3),
                                         "bacon": (8001, 4)})))
 
+    def testReplacedEntries(self):
+        t = DummyTimeProvider(0)
+        d = ExpDict(t)
+        d.set("spam", 1, 10, relative=True)
+        d.set("spam", 2, 30, relative=True)
+        d.set("bacon", 3, 10, relative=True)
+        d["bacon"] = 4
+        t.time += 15
+        self.assertEqual(len(d), 2)
+        self.assertEqual(d["spam"], 2)
+        self.assertEqual(d["bacon"], 4)
+        t.time += 20
+        self.assertEqual(len(d), 1)
+        d.pack()
+        self.assertEqual(d.size(), 1)
+
+        for i in xrange(1000):
+            d.set("eggs", i, 100 + i, relative=True)
+        self.assertEqual(len(d), 2)
+        self.assertEqual(d.get_expiration("eggs"), t.time + 1099)
+        # Replaced entries do not accumulate
+        self.assertTrue(len(d._heap) < 100)
+
 
 class TestExpQueue(common.TestCase):
 
@@ -648,3 +673,43 @@ class TestMroDict(common.TestCase):
         a = A()
         self.assertEqual(a.registry['spam'], 'a')
         self.assertEqual(a.registry['eggs'], 'a')
+
+
+class PlainTimeProvider(object):
+
+    implements(ITimeProvider)
+
+    def __init__(self, current):
+        self.time = current
+
+    ### ITimeProvider ###
+
+    def get_time(self):
+        return self.time
+
+
+@common.attr('slow')
+class BenchmarkTests(common.TestCase):
+
+    def testExpDictThroughput(self):
+        t = PlainTimeProvider(0)
+        d = ExpDict(t)
+        for key in xrange(100000):
+            d.set(key, True, random.uniform(10, 20), relative=True)
+
+        start = time.time()
+        operations = 0
+        key = 100000
+        for _ in range(30):
+            t.time += 1
+            for _ in xrange(5000):
+                key += 1
+                if key not in d:
+                    d.set(key, True, random.uniform(10, 20), relative=True)
+                operations += 1
+            self.assertTrue(len(d) > 0)
+            operations += 1
+        elapsed = time.time() - start
+        self.info("Performed %d operations on an ExpDict of %d items: "
+                  "%.0f operations/s", operations, len(d),
+                  operations / elapsed)
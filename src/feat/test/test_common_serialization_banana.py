@@ -24,6 +24,7 @@
 # vi:si:et:sw=4:sts=4:ts=4
 
 import itertools
+import time
 import types
 
 from twisted.spread import jelly
@@ -31,7 +32,7 @@ from twisted.spread import jelly
 from feat.common.serialization import banana
 from feat.interface.serialization import *
 
-from . import common_serialization
+from . import common, common_serialization
 
 
 class BananaConvertersTest(common_serialization.ConverterTest):
@@ -44,3 +45,41 @@ class BananaConvertersTest(common_serialization.ConverterTest):
 
     def testHelperFunctions(self):
         self.checkSymmetry(banana.serialize, banana.unserialize)
+
+    def testChunkedDecoding(self):
+        data = [dict(("key%d" % i, ["value %d" % j for j in range(10)])
+                     for i in range(100)) for _ in range(3)]
+        blob = banana.serialize(data)
+        self.assertTrue(len(blob) > banana.DECODING_CHUNK_SIZE)
+        self.assertEqual(banana.unserialize(blob), data)
+        for size in (1, 7, 4096):
+            chunks = banana.iter_chunks(blob, size)
+            self.assertEqual(banana.unserialize(chunks), data)
+        # The unserializer is still usable after a truncated stream
+        self.assertRaises(IndexError, banana.unserialize,
+                          iter([blob[:len(blob) / 2]]))
+        self.assertEqual(banana.unserialize(blob), data)
+
+
+@common.attr('slow')
+class BenchmarkTests(common.TestCase):
+
+    def testLargeBlobDecoding(self):
+        # Fed in a single call Banana copies the rest of its buffer
+        # for every token and the decoding time is quadratic
+        data = [dict(("key%d" % i, ["value %d" % j for j in range(10)])
+                     for i in range(2000)) for _ in range(2)]
+        blob = banana.serialize(data)
+        codec = banana.BananaCodec()
+
+        start = time.time()
+        decoded = codec.decode(blob)
+        chunked = time.time() - start
+
+        start = time.time()
+        self.assertEqual(codec.decode([blob]), decoded)
+        whole = time.time() - start
+
+        self.info("Decoding %d bytes: %.2fs chunked, %.2fs whole",
+                  len(blob), chunked, whole)
+        self.assertTrue(chunked < whole)
@@ -23,10 +23,12 @@
 # -*- Mode: Python -*-
 # vi:si:et:sw=4:sts=4:ts=4
 
+import time
+
 from twisted.spread import jelly
 
 from feat.common import serialization
-from feat.common.serialization import base
+from feat.common.serialization import base, banana, json, pytree, sexp
 from feat.interface.serialization import *
 
 from . import common
@@ -304,3 +306,76 @@ class TestVersionAdapter(common.TestCase):
 
         self.check_combinations(DummyVerAdapter2, range(1, 10), expected)
         self.check_combinations(DummyVerAdapter2(), range(1, 10), expected)
+
+
+class VersionedA(A):
+
+    type_name = "Versioned"
+
+    @staticmethod
+    def upgrade_to_2(snapshot):
+        snapshot["x"] += 1
+        return snapshot
+
+
+class VersionedB(A):
+
+    type_name = "Versioned"
+
+    @classmethod
+    def adapt_version(cls, snapshot, source_ver, target_ver):
+        snapshot["x"] = (source_ver, target_ver)
+        return snapshot
+
+
+class TestRegistry(common.TestCase):
+
+    def testRestorePlan(self):
+        registry = base.Registry()
+        self.assertEqual(None, registry.lookup_plan("Versioned"))
+
+        registry.register(VersionedA)
+        plan = registry.lookup_plan("Versioned")
+        self.assertTrue(plan.restorator is VersionedA)
+        self.assertEqual(plan.adapt({"x": 1}), {"x": 1})
+        self.assertTrue(plan is registry.lookup_plan("Versioned"))
+
+        plan = registry.lookup_plan("Versioned", 1, 2)
+        self.assertEqual(plan.adapt({"x": 1}), {"x": 2})
+        self.assertTrue(plan is registry.lookup_plan("Versioned", 1, 2))
+        self.assertFalse(plan is registry.lookup_plan("Versioned", 2, 1))
+
+        a = plan.restore(plan.adapt({"x": 1}))
+        self.assertTrue(isinstance(a, VersionedA))
+        self.assertEqual(a.x, 2)
+
+        # Registering a new restorator discards the cached plans
+        registry.register(VersionedB)
+        plan = registry.lookup_plan("Versioned", 1, 2)
+        self.assertTrue(plan.restorator is VersionedB)
+        self.assertEqual(plan.adapt({"x": 1}), {"x": (1, 2)})
+
+
+@common.attr('slow')
+class BenchmarkTests(common.TestCase):
+
+    def testSerializationThroughput(self):
+        items = [{"name": "item%d" % i, "value": i, "tags": ["x", "y"],
+                  "ok": True, "none": None} for i in range(20)]
+        data = {"message_id": "a" * 36, "protocol_id": "contract",
+                "expiration_time": 1234.5, "payload": {"items": items},
+                "reply_to": ("shard", "key"), "count": 10}
+        for module in (json, banana, sexp, pytree):
+            for acyclic in (False, True):
+                serializer = module.Serializer(acyclic=acyclic)
+                self.assertEqual(serializer.convert(data),
+                                 module.Serializer().convert(data))
+                rate = self._measure(serializer.convert, data)
+                self.info("%s serializer (acyclic: %s): %.0f messages/s",
+                          module.__name__, acyclic, rate)
+
+    def _measure(self, fun, value, count=1000):
+        start = time.time()
+        for _ in xrange(count):
+            fun(value)
+        return count / (time.time() - start)
@@ -0,0 +1,175 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+# Headers in this file shall remain intact.
+# -*- coding: utf-8 -*-
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+from feat.common import serialization
+from feat.common.serialization import banana, binary
+from feat.interface.serialization import *
+
+from . import common, common_serialization
+
+
+@serialization.register
+class StreamDummy(serialization.Serializable):
+
+    def restored(self):
+        self.was_restored = True
+
+
+class BinaryConvertersTest(common_serialization.ConverterTest):
+
+    def setUp(self):
+        common_serialization.ConverterTest.setUp(self)
+        ext = self.externalizer
+        self.serializer = binary.Serializer(externalizer = ext)
+        self.unserializer = binary.Unserializer(externalizer = ext)
+
+    def testHelperFunctions(self):
+        self.checkSymmetry(binary.serialize, binary.unserialize)
+
+
+class BinaryCodecTest(common.TestCase):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.codec = binary.BinaryCodec()
+
+    def testEncoding(self):
+        self.assertEqual(self.codec.encode(42), "\xfe\x01\xaa")
+        self.assertEqual(self.codec.encode(64), "\xfe\x01\x05\x40")
+        self.assertEqual(self.codec.encode(-1), "\xfe\x01\x06\x01")
+        self.assertEqual(self.codec.encode(300L), "\xfe\x01\x07\xac\x02")
+        self.assertEqual(self.codec.encode(["a", "a", "b"]),
+                         "\xfe\x01\xc3\x03\x01a\xd0\x03\x01b")
+        self.assertEqual(self.codec.encode("x" * 100),
+                         "\xfe\x01\x02\x64" + "x" * 100)
+
+    def testSymmetry(self):
+        names = ["name%d" % i for i in range(100)]
+        values = [0, 63, 64, 2 ** 31, -2 ** 31, 2 ** 100, -2 ** 100, 0L,
+                  -5L, 0.0, -3.5, 1e300, "", "\x00\xff", "x" * 1000,
+                  [], [[[]]], range(100), names + names,
+                  ["dictionary", ["key", 1], ["key", [2.5, "key"]]]]
+        for value in values:
+            result = self.codec.decode(self.codec.encode(value))
+            self.assertEqual(value, result)
+            self.assertEqual(type(value), type(result))
+
+    def testInvalidData(self):
+        data = self.codec.encode(["spam", ["spam", 2 ** 70, 4.2]])
+        for index in range(len(data)):
+            self.assertRaises(ValueError, self.codec.decode, data[:index])
+        self.assertRaises(ValueError, self.codec.decode, data + "\x80")
+        self.assertRaises(ValueError, self.codec.decode, "\xfe\x01\xd0")
+        self.assertRaises(ValueError, self.codec.decode, "\xfe\x01\x0a")
+        self.assertRaises(ValueError, self.codec.decode, "\xfe\x02\x80")
+        self.assertRaises(TypeError, self.codec.decode, u"\xfe\x01\x80")
+        self.assertRaises(TypeError, self.codec.encode, (1, 2))
+
+    def testCompactness(self):
+        value = {"spam": [u"bacon", None, True, 2 ** 40, 3.14],
+                 "eggs": [{"spam": i, "bacon": "eggs"} for i in range(10)]}
+        data = binary.serialize(value)
+        self.assertEqual(value, binary.unserialize(data))
+        self.assertTrue(binary.is_binary(data))
+        self.assertFalse(binary.is_binary(banana.serialize(value)))
+        self.assertTrue(len(data) < len(banana.serialize(value)))
+
+
+class StreamUnserializerTest(common.TestCase):
+
+    def testChunks(self):
+        a = StreamDummy()
+        b = StreamDummy()
+        a.ref = b
+        b.ref = a
+        a.name = "a" * 100
+        shared = {"spam": [1, 2]}
+        names = ["item%d" % i for i in range(60)]
+        value = [a, shared, b, shared, (1, 2L, u"x"), [shared]] + names
+        data = binary.serialize(value)
+
+        for size in (1, 3, 64, len(data)):
+            chunks = [data[i:i + size] for i in range(0, len(data), size)]
+            items = list(binary.unserialize_stream(iter(chunks)))
+            self.assertEqual(len(value), len(items))
+            self.assertTrue(items[0].ref is items[2])
+            self.assertTrue(items[2].ref is items[0])
+            self.assertTrue(items[0].was_restored)
+            self.assertTrue(items[1] is items[3])
+            self.assertTrue(items[5][0] is items[1])
+            self.assertEqual((1, 2L, u"x"), items[4])
+            self.assertEqual(names, items[6:])
+
+    def testItemsAsSoonAsComplete(self):
+        data = binary.serialize(("x" * 100, "y" * 100))
+        stream = binary.StreamUnserializer()
+        self.assertEqual([], list(stream.feed(data[:50])))
+        self.assertEqual(["x" * 100], list(stream.feed(data[50:150])))
+        self.assertEqual(["y" * 100], list(stream.feed(data[150:])))
+        stream.close()
+
+    def testReferencesAcrossItems(self):
+        a = StreamDummy()
+        a.items = {"spam": [1, 2]}
+        b = StreamDummy()
+        b.ref = a
+        b.items = a.items
+        value = (a, "x" * 100, b, a.items)
+        data = binary.serialize(value)
+        split = data.index("x" * 100) + 50
+
+        stream = binary.StreamUnserializer()
+        first = list(stream.feed(data[:split]))
+        # the first item is fully restored before the others are read
+        self.assertEqual(1, len(first))
+        restored = first[0]
+        self.assertTrue(restored.was_restored)
+        self.assertEqual({"spam": [1, 2]}, restored.items)
+
+        rest = list(stream.feed(data[split:]))
+        stream.close()
+        self.assertEqual(3, len(rest))
+        self.assertEqual("x" * 100, rest[0])
+        self.assertTrue(rest[1].was_restored)
+        self.assertTrue(rest[1].ref is restored)
+        self.assertTrue(rest[1].items is restored.items)
+        self.assertTrue(rest[2] is restored.items)
+
+    def testInvalidStreams(self):
+
+        def feed(stream, data):
+            return list(stream.feed(data))
+
+        stream = binary.StreamUnserializer()
+        feed(stream, binary.serialize([1, 2, 3])[:-1])
+        self.assertRaises(ValueError, stream.close)
+
+        for value in ({"spam": 1}, 42):
+            data = binary.serialize(value)
+            stream = binary.StreamUnserializer()
+            self.assertRaises(ValueError, feed, stream, data)
+
+        stream = binary.StreamUnserializer()
+        data = binary.serialize([1, 2])
+        self.assertRaises(ValueError, feed, stream, data + "\x80")
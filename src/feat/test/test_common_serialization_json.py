@@ -33,7 +33,7 @@ from feat.common import reflect, serialization
 from feat.common.serialization import base, json
 from feat.interface.serialization import *
 
-from . import common_serialization
+from . import common, common_serialization
 
 
 @serialization.register
@@ -277,3 +277,39 @@ class JSONConvertersTest(common_serialization.ConverterTest):
                      '"ref": [".deref", 1]}}]') % (name, name)], True)
             yield (Klass, [c], str, [('[".ref", 1, {".type": "%s", "ref": '
                                       '[".deref", 1]}]') % (name, )], True)
+
+
+class JSONAcyclicTest(common.TestCase):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.serializer = json.Serializer()
+        self.acyclic = json.Serializer(acyclic=True)
+        self.unserializer = json.Unserializer()
+
+    def testTreeConvertion(self):
+        o = DummyClass()
+        o.value = {"spam": [1, 2.5, u"\xe9", None], "bacon": (True, "egg")}
+        values = [42, "dummy", u"dummy", [1, [2, 3]], (1, (2, 3)),
+                  {"a": {"b": ["c"]}, "d": 1}, set([1, 2]), o]
+        for value in values:
+            self.assertEqual(self.serializer.convert(value),
+                             self.acyclic.convert(value))
+            self.assertEqual(self.serializer.freeze(value),
+                             self.acyclic.freeze(value))
+
+    def testSharedReferences(self):
+        shared = [1, 2]
+        value = [shared, shared]
+        self.assertEqual('[[".ref", 1, [1, 2]], [".deref", 1]]',
+                         self.serializer.convert(value))
+        # Acyclic serializer duplicates the shared container
+        data = self.acyclic.convert(value)
+        self.assertEqual('[[1, 2], [1, 2]]', data)
+        result = self.unserializer.convert(data)
+        self.assertEqual(value, result)
+        self.assertIsNot(result[0], result[1])
+
+    def testCapabilities(self):
+        self.assertRaises(TypeError, self.acyclic.convert, {(1, 2): 3})
+        self.assertRaises(TypeError, self.acyclic.convert, {None: 1})
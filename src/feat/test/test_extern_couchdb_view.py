@@ -0,0 +1,119 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+import json
+import time
+from cStringIO import StringIO
+
+from feat.extern.couchdb import view
+
+from . import common
+
+
+MAP_SOURCE = u'''\
+def map(doc):
+    if doc['.type'] == 'item':
+        yield doc['group'], doc['value']
+'''
+
+LOGGING_MAP_SOURCE = u'''\
+log('compiled')
+def map(doc):
+    yield doc['_id'], None
+'''
+
+REDUCE_SOURCE = u'''\
+def reduce(keys, values, rereduce):
+    return sum(values)
+'''
+
+COUNT_SOURCE = u'''\
+def reduce(keys, values):
+    return len(values)
+'''
+
+
+def run(*commands):
+    input = StringIO("".join(json.dumps(x) + "\n" for x in commands))
+    output = StringIO()
+    view.run(input, output)
+    return [json.loads(x) for x in output.getvalue().splitlines()]
+
+
+class TestViewServer(common.TestCase):
+
+    def testCompiledFunctionsAreCached(self):
+        result = run(["add_fun", LOGGING_MAP_SOURCE],
+                     ["map_doc", {"_id": "a"}],
+                     ["reset"],
+                     ["add_fun", LOGGING_MAP_SOURCE],
+                     ["map_doc", {"_id": "b"}],
+                     ["add_fun", u"x = 1"])
+        self.assertEqual([{"log": "compiled"}, True, [[["a", None]]],
+                          True, True, [[["b", None]]]], result[:6])
+        self.assertEqual("map_compilation_error", result[6]["error"]["id"])
+
+    def testMapDocs(self):
+        docs = [{"_id": "a", ".type": "item", "group": 1, "value": 2},
+                {"_id": "b", ".type": "other"},
+                {"_id": "c", ".type": "item", "group": 2, "value": 3}]
+        result = run(["add_fun", MAP_SOURCE],
+                     ["map_docs", docs])
+        self.assertEqual([[[[1, 2]]], [[]], [[[2, 3]]]], result[1])
+
+    def testReduce(self):
+        rows = [[[1, "a"], 2], [[2, "c"], 3]]
+        result = run(["reduce", [REDUCE_SOURCE, COUNT_SOURCE], rows],
+                     ["rereduce", [REDUCE_SOURCE], [5, 7]],
+                     ["reduce", [u"def broken("], rows])
+        self.assertEqual([True, [5, 2]], result[0])
+        self.assertEqual([True, [12]], result[1])
+        self.assertEqual("reduce_compilation_error",
+                         result[2]["error"]["id"])
+
+
+@common.attr('slow')
+class BenchmarkTests(common.TestCase):
+
+    def testViewBuild(self):
+        # Imitates CouchDB building a view with a reduce function
+        # over a database of 100k documents, reducing by 100 rows.
+        count = 100000
+        commands = [["reset"], ["add_fun", MAP_SOURCE]]
+        for i in xrange(count):
+            commands.append(["map_doc", {"_id": "doc%d" % i, "_rev": "1-x",
+                                         ".type": "item", "group": i % 50,
+                                         "value": i}])
+        for i in xrange(0, count, 100):
+            rows = [[[j % 50, "doc%d" % j], j] for j in xrange(i, i + 100)]
+            commands.append(["reduce", [REDUCE_SOURCE], rows])
+        for i in xrange(0, count / 100, 100):
+            commands.append(["rereduce", [REDUCE_SOURCE], range(i, i + 100)])
+        input = StringIO("".join(json.dumps(x) + "\n" for x in commands))
+        output = StringIO()
+
+        start = time.time()
+        view.run(input, output)
+        elapsed = time.time() - start
+        self.info("Built a view over %d documents in %.2fs", count, elapsed)
+        self.assertEqual(len(commands), len(output.getvalue().splitlines()))
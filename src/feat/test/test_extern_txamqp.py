@@ -0,0 +1,213 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+import os
+import random
+import time
+from cStringIO import StringIO
+
+from feat.agencies import net
+from feat.extern.txamqp import spec, codec, protocol
+from feat.extern.txamqp.connection import Frame, Method, Header, Body
+from feat.extern.txamqp.connection import Heartbeat
+
+from . import common
+
+
+SPEC = spec.load(os.path.join(os.path.dirname(net.__file__),
+                              'amqp0-8.xml'))
+
+
+class FrameReceiver(protocol.FrameReceiver):
+
+    def __init__(self, spec):
+        protocol.FrameReceiver.__init__(self, spec)
+        self.frames = []
+        self.setFrameMode()
+
+    def frameReceived(self, frame):
+        self.frames.append(frame)
+
+
+def random_value(rand, type):
+    if type == "bit":
+        return rand.choice([True, False])
+    if type == "octet":
+        return rand.randint(0, 255)
+    if type == "short":
+        return rand.randint(0, 2 ** 16 - 1)
+    if type == "long":
+        return rand.randint(0, 2 ** 32 - 1)
+    if type == "longlong":
+        return rand.randint(0, 2 ** 64 - 1)
+    if type == "shortstr":
+        return "x" * rand.randint(0, 255)
+    if type == "longstr":
+        return "y" * rand.randint(0, 1000)
+    if type == "table":
+        return {"text": "value", "number": rand.randint(0, 1000)}
+
+
+def generic_encode(method, args):
+    stream = StringIO()
+    c = codec.Codec(stream)
+    c.encode_short(method.klass.id)
+    c.encode_short(method.id)
+    for field, arg in zip(method.fields, args):
+        c.encode(field.type, arg)
+    c.flush()
+    return stream.getvalue()
+
+
+def pack_frames(frames):
+    receiver = FrameReceiver(SPEC)
+    return "".join(receiver._packFrame(frame) for frame in frames)
+
+
+class TestCompiledCodec(common.TestCase):
+
+    def testAllMethods(self):
+        rand = random.Random(42)
+        for klass in SPEC.classes:
+            for method in klass.methods:
+                encoder, decoder = method.get_codec()
+                for _ in range(10):
+                    args = tuple(random_value(rand, f.type)
+                                 for f in method.fields)
+                    data = encoder(args)
+                    self.assertEqual(generic_encode(method, args), data)
+                    self.assertEqual(args, decoder(data, 4))
+
+    def testUnicodeStrings(self):
+        method = SPEC.parse_method("basic.publish")
+        args = (1, u"exchange", u"key", True, False)
+        encoder, decoder = method.get_codec()
+        self.assertEqual(generic_encode(method, args), encoder(args))
+        self.assertRaises(UnicodeEncodeError, encoder,
+                          (1, u"\xe9", u"key", True, False))
+
+    def testUnsupportedTypes(self):
+        self.assertEqual(None, codec.compile_codec(["bit", "unknown"]))
+
+
+class TestFrameReceiver(common.TestCase):
+
+    def testChunkedFrames(self):
+        publish = SPEC.parse_method("basic.publish")
+        body = "".join(chr(i % 256) for i in range(100000))
+        frames = [Frame(1, Method(publish, 1, "exchange", "key",
+                                  False, True)),
+                  Frame(1, Header(publish.klass, 0, len(body),
+                                  **{'delivery mode': 2, 'priority': 1})),
+                  Frame(1, Body(body)),
+                  Frame(0, Heartbeat()),
+                  Frame(2, Body(""))]
+        data = pack_frames(frames)
+        expected = map(str, frames)
+
+        for chunk_size in (1, 7, 8, 1000, 4096, len(data)):
+            receiver = FrameReceiver(SPEC)
+            receiver.MAX_LENGTH = len(body) + 100
+            for index in range(0, len(data), chunk_size):
+                receiver.dataReceived(data[index:index + chunk_size])
+            self.assertEqual(expected, map(str, receiver.frames))
+            self.assertEqual(body, receiver.frames[2].payload.content)
+
+    def testFrameLengthExceeded(self):
+        frame = Frame(1, Body("x" * 10000))
+        data = pack_frames([frame, frame])
+        exceeded = []
+        receiver = FrameReceiver(SPEC)
+        receiver.frameLengthExceeded = exceeded.append
+        receiver.dataReceived(data[:4000])
+        self.assertEqual([], exceeded)
+        receiver.dataReceived(data[4000:6000])
+        self.assertEqual([data[:6000]], exceeded)
+        self.assertEqual([], receiver.frames)
+
+        receiver = FrameReceiver(SPEC)
+        receiver.MAX_LENGTH = 10008
+        receiver.dataReceived(data)
+        self.assertEqual(2, len(receiver.frames))
+
+    def testRawMode(self):
+        frame = Frame(1, Body("body"))
+        data = pack_frames([frame])
+        raw = []
+        receiver = FrameReceiver(SPEC)
+        receiver.rawDataReceived = raw.append
+        receiver.dataReceived(data + "raw")
+        self.assertEqual(1, len(receiver.frames))
+        self.assertEqual([], raw)
+        receiver.setRawMode()
+        receiver.dataReceived(" data")
+        self.assertEqual(["raw data"], raw)
+
+
+@common.attr('slow')
+class BenchmarkTests(common.TestCase):
+
+    def testLargeMessageStream(self):
+        # Imitates receiving messages of 1MB arriving in 4KB TCP chunks,
+        # split in 128KB frames as negotiated with RabbitMQ or sent in
+        # a single frame when the frame size is not limited.
+        for frame_size in (128 * 1024, 1024 * 1024):
+            elapsed, rate = self._receive_messages(50, 1024 * 1024,
+                                                   frame_size, 4096)
+            self.info("Received 50 messages of 1MB in %dKB frames "
+                      "in %.2fs: %.1f MB/s", frame_size / 1024,
+                      elapsed, rate)
+
+    def testMethodFrames(self):
+        publish = SPEC.parse_method("basic.publish")
+        frame = Frame(1, Method(publish, 0, "exchange", "routing.key",
+                                False, False))
+        count = 50000
+        receiver = FrameReceiver(SPEC)
+        start = time.time()
+        for _ in range(count):
+            receiver.dataReceived(receiver._packFrame(frame))
+        elapsed = time.time() - start
+        self.info("Packed and parsed %d method frames in %.2fs: "
+                  "%.0f frames/s", count, elapsed, count / elapsed)
+        self.assertEqual(count, len(receiver.frames))
+
+    def _receive_messages(self, count, size, frame_size, chunk_size):
+        deliver = SPEC.parse_method("basic.deliver")
+        body = "x" * size
+        frames = [Frame(1, Method(deliver, "tag", 1, False, "exchange",
+                                  "key")),
+                  Frame(1, Header(deliver.klass, 0, len(body)))]
+        for index in range(0, len(body), frame_size):
+            frames.append(Frame(1, Body(body[index:index + frame_size])))
+        message = pack_frames(frames)
+
+        receiver = FrameReceiver(SPEC)
+        receiver.MAX_LENGTH = frame_size + 100
+        start = time.time()
+        for _ in range(count):
+            for index in range(0, len(message), chunk_size):
+                receiver.dataReceived(message[index:index + chunk_size])
+        elapsed = time.time() - start
+        self.assertEqual(count * len(frames), len(receiver.frames))
+        return elapsed, count * len(message) / elapsed / 1024 / 1024
@@ -0,0 +1,118 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+import os
+import tempfile
+
+from feat.test import common
+from feat.agencies import journaler
+from feat.common import defer
+from feat.utils import jourtools
+
+
+class TestCompacting(common.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield common.TestCase.setUp(self)
+        fd, self.filename = tempfile.mkstemp(suffix='_journal.sqlite')
+        os.close(fd)
+        os.remove(self.filename)
+        self.addCleanup(self._remove, self.filename)
+
+        writer = journaler.SqliteWriter(self, filename=self.filename)
+        yield writer.initiate()
+        entries = [
+            self._entry('agent1', 'before'),
+            self._entry('agent1', 'snapshot'),
+            self._entry('agent1', 'after'),
+            self._entry('agent2', 'first'),
+            self._entry('agent2', 'second'),
+            self._entry('agent3', 'snapshot'),
+            self._entry('agent3', 'snapshot'),
+            self._log(10),
+            self._log(20)]
+        yield writer.insert_entries(entries)
+        yield writer.close()
+
+    @defer.inlineCallbacks
+    def testCompactInPlace(self):
+        removed = jourtools.compact(self.filename, logs_since=15)
+        self.assertEqual((2, 1), removed)
+
+        entries = yield self._get_entries(self.filename)
+        self.assertEqual({'agent1': ['snapshot', 'after'],
+                          'agent2': ['first', 'second'],
+                          'agent3': ['snapshot']}, entries)
+
+    @defer.inlineCallbacks
+    def testCompactToDestination(self):
+        fd, destination = tempfile.mkstemp(suffix='_journal.sqlite')
+        os.close(fd)
+        self.addCleanup(self._remove, destination)
+
+        removed = jourtools.compact(self.filename, destination)
+        self.assertEqual((2, 0), removed)
+
+        entries = yield self._get_entries(destination)
+        self.assertEqual(['snapshot', 'after'], entries['agent1'])
+        entries = yield self._get_entries(self.filename)
+        self.assertEqual(['before', 'snapshot', 'after'], entries['agent1'])
+
+    @defer.inlineCallbacks
+    def _get_entries(self, filename):
+        writer = journaler.SqliteWriter(self, filename=filename)
+        yield writer.initiate()
+        result = dict()
+        histories = yield writer.get_histories()
+        for history in histories:
+            entries = yield writer.get_entries(history)
+            result[history.agent_id] = [x[3] for x in entries]
+        yield writer.close()
+        defer.returnValue(result)
+
+    def _remove(self, filename):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    def _entry(self, agent_id, function_id):
+        return {'entry_type': 'journal',
+                'agent_id': agent_id,
+                'instance_id': 1,
+                'journal_id': 'some journal id',
+                'function_id': function_id,
+                'args': '',
+                'kwargs': '',
+                'fiber_id': 'some fiber id',
+                'fiber_depth': 1,
+                'result': '',
+                'side_effects': '',
+                'timestamp': 1}
+
+    def _log(self, timestamp):
+        return {'entry_type': 'log',
+                'level': 3,
+                'log_name': 'some name',
+                'category': 'some category',
+                'file_path': 'some_file.py',
+                'line_num': 42,
+                'message': 'some message',
+                'timestamp': timestamp}
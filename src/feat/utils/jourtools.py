@@ -0,0 +1,106 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+import optparse
+import shutil
+import sqlite3
+
+from feat.common import log, text_helper, time
+
+
+def compact(filename, destination=None, logs_since=None):
+    '''
+    Removes the journal entries which are not needed to replay the agents.
+    For every history only the entries starting from the latest agent
+    snapshot are kept. Histories without any snapshot are left untouched.
+
+    This works on the file directly, the journal should not be opened
+    by the agency at the same time (use the rotated files).
+
+    @param filename: Journal file to compact.
+    @param destination: Optional path to write the compacted journal to,
+                        by default the file is compacted in place.
+    @param logs_since: Optional epoch time, log entries older than this
+                       are removed as well.
+    @returns: tuple of (removed journal entries, removed log entries)
+    '''
+    if destination is not None:
+        shutil.copyfile(filename, destination)
+        filename = destination
+
+    connection = sqlite3.connect(filename)
+    try:
+        cursor = connection.cursor()
+        cursor.execute(text_helper.format_block("""
+        DELETE FROM entries
+          WHERE rowid < (SELECT max(snapshots.rowid)
+                           FROM entries AS snapshots
+                           WHERE snapshots.history_id = entries.history_id
+                             AND snapshots.function_id = 'snapshot')
+        """))
+        entries = cursor.rowcount
+        logs = 0
+        if logs_since is not None:
+            cursor.execute("DELETE FROM logs WHERE timestamp < ?",
+                           (int(logs_since), ))
+            logs = cursor.rowcount
+        cursor.execute(text_helper.format_block("""
+        DELETE FROM histories
+          WHERE id NOT IN (SELECT DISTINCT history_id FROM entries)
+        """))
+        connection.commit()
+        # VACUUM cannot run inside a transaction
+        connection.isolation_level = None
+        connection.execute("VACUUM")
+    finally:
+        connection.close()
+
+    return entries, logs
+
+
+def parse_options():
+    parser = optparse.OptionParser(
+        usage="%prog [options] JOURNAL [DESTINATION]")
+    parser.add_option('-l', '--keep-logs', dest="keep_logs", type="int",
+                      help=("remove log entries older than this number of "
+                            "days (default: keep all)"),
+                      metavar="DAYS", default=None)
+    opts, args = parser.parse_args()
+    if len(args) not in (1, 2):
+        parser.error("Expected the journal file and optional destination.")
+    return opts, args
+
+
+def script():
+    opts, args = parse_options()
+    log.FluLogKeeper.init()
+    log.FluLogKeeper.set_debug('4')
+
+    logs_since = None
+    if opts.keep_logs is not None:
+        logs_since = time.time() - opts.keep_logs * 24 * 3600
+
+    filename = args[0]
+    destination = args[1] if len(args) > 1 else None
+    log.info('script', "Compacting journal %s.", filename)
+    entries, logs = compact(filename, destination, logs_since)
+    log.info('script', "Removed %d journal entries and %d log entries.",
+             entries, logs)